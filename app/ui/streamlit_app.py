@@ -3,10 +3,15 @@ import os
 import requests
 import streamlit as st
 import psycopg2
+import psycopg2.pool
 import pandas as pd
 import numpy as np
 import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from psycopg2.extras import RealDictCursor
+from pgvector.psycopg2 import register_vector
+from requests.adapters import HTTPAdapter
 
 # ===============================
 # CONFIGURATION
@@ -22,6 +27,10 @@ OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.1:8b")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
 
+# Session HTTP partagée vers Ollama : keep-alive, pas de handshake TCP par appel
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
 # ===============================
 # SQL : FILTRAGE STRICT ET PROFIL
 # ===============================
@@ -37,58 +46,111 @@ GROUP BY fg.genre_id;
 """
 
 SQL_HYBRID_SEARCH = """
-WITH semantic_search AS (
-    SELECT film_id, (1.0 - (embedding <=> %(qvec)s::vector)) AS similarity
+WITH shortlist AS (
+    -- étage 1 : présélection binaire (Hamming), très peu coûteuse
+    SELECT film_id, embedding_h
     FROM film_embedding
+    ORDER BY emb_bin <~> binary_quantize(%(qvec)s::vector) LIMIT 500
+),
+semantic_search AS (
+    -- étage 2 : rerank exact (cosinus) sur la présélection
+    SELECT film_id, (1.0 - (embedding_h <=> %(qvec)s::halfvec(768))) AS similarity
+    FROM shortlist
     ORDER BY similarity DESC LIMIT 150
+),
+profile AS (
+    SELECT genre_id, avg_rating
+    FROM unnest(%(profile_gids)s::int[], %(profile_avgs)s::float[]) AS p(genre_id, avg_rating)
 )
-SELECT DISTINCT f.film_id, f.title, f.year, f.runtime_min, f.overview, s.similarity
+SELECT f.film_id, f.title, f.year, f.runtime_min, f.overview, s.similarity,
+       0.7 * sg.s_gen + 3.0 * s.similarity AS score
 FROM film f
 JOIN semantic_search s ON f.film_id = s.film_id
-JOIN film_genre fg ON f.film_id = fg.film_id
-JOIN genre g ON fg.genre_id = g.genre_id
+CROSS JOIN LATERAL (
+    -- score genre par film sans fan-out : pas de GROUP BY/DISTINCT en aval
+    SELECT COALESCE(AVG(COALESCE(p.avg_rating, 5.0)), 5.0) AS s_gen
+    FROM film_genre fg
+    LEFT JOIN profile p ON p.genre_id = fg.genre_id
+    WHERE fg.film_id = f.film_id
+) sg
 LEFT JOIN user_film uf ON uf.film_id = f.film_id AND uf.user_id = %(user_id)s
 WHERE (uf.status IS NULL OR uf.status != 'SEEN')
   AND (uf.last_seen_at IS NULL OR uf.last_seen_at < NOW() - INTERVAL '6 months')
-  AND f.title ~ '^[\\x00-\\x7F]+$' 
-  AND g.name = ANY(%(genres)s)
+  AND f.title_is_ascii
+  AND (%(max_duration)s::int IS NULL OR COALESCE(f.runtime_min, 0) <= %(max_duration)s::int)
+  AND EXISTS (
+      SELECT 1 FROM film_genre fg
+      JOIN genre g ON g.genre_id = fg.genre_id
+      WHERE fg.film_id = f.film_id AND g.name = ANY(%(genres)s)
+  )
+ORDER BY score DESC
+LIMIT 3
 """
 
 # ===============================
 # UTILS & OLLAMA
 # ===============================
 
-def get_conn():
-    return psycopg2.connect(host=PG_HOST, dbname=PG_DB, user=PG_USER, password=PG_PWD, port=PG_PORT)
+@st.cache_resource
+def get_pool():
+    # Pool persistant : évite un handshake TCP+auth Postgres à chaque interaction
+    return psycopg2.pool.ThreadedConnectionPool(
+        1, 8, host=PG_HOST, dbname=PG_DB, user=PG_USER, password=PG_PWD, port=PG_PORT
+    )
+
+@contextmanager
+def conn_ctx():
+    pool = get_pool()
+    conn = pool.getconn()
+    register_vector(conn)  # adaptateur binaire pgvector (numpy <-> vector)
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
 
 def fetch_df(conn, sql, params=None):
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute(sql, params or {})
         return pd.DataFrame(cur.fetchall())
 
-def ollama_embed(text: str):
-    r = requests.post(f"{OLLAMA_URL}/api/embeddings", json={"model": EMBED_MODEL, "prompt": text}, timeout=90)
-    return r.json().get("embedding")
+@st.cache_data(ttl=3600, max_entries=1024, show_spinner=False)
+def ollama_embed(texts: list[str]) -> list[list[float]]:
+    # Endpoint batch /api/embed : une seule requête HTTP pour N textes
+    r = SESSION.post(f"{OLLAMA_URL}/api/embed", json={"model": EMBED_MODEL, "input": texts}, timeout=60)
+    embeddings = r.json().get("embeddings")
+    if embeddings is None:
+        # Fallback : ancien endpoint /api/embeddings (un appel par texte)
+        embeddings = []
+        for text in texts:
+            r = SESSION.post(f"{OLLAMA_URL}/api/embeddings", json={"model": EMBED_MODEL, "prompt": text}, timeout=90)
+            embeddings.append(r.json().get("embedding"))
+    return embeddings
 
+def ollama_embed_one(text: str) -> np.ndarray:
+    return np.asarray(ollama_embed([text])[0], dtype=np.float32)
+
+@st.cache_data(ttl=3600, max_entries=1024, show_spinner=False)
 def extract_intent(user_text, available_genres):
-    # Prompt avec instruction de secours
+    # Préfixe invariant en tête (genres + consignes), texte utilisateur en fin :
+    # Ollama réutilise le cache KV du préfixe au lieu de tout re-traiter
     prompt = f"""
-    Analyse : "{user_text}"
+    Genres autorisés : {sorted(available_genres)}
     Extraire en JSON uniquement :
     {{
-      "genres": [], 
-      "max_duration": null, 
+      "genres": [],
+      "max_duration": null,
       "style": "ambiance en 3 mots"
     }}
-    Genres autorisés : {available_genres}
+    Analyse : "{user_text}"
     """
     # Valeurs par défaut au cas où le JSON est incomplet
     default_intent = {"genres": [], "max_duration": None, "style": user_text}
-    
+
     try:
-        r = requests.post(f"{OLLAMA_URL}/api/chat", json={
-            "model": OLLAMA_MODEL, "messages": [{"role": "user", "content": prompt}], 
-            "stream": False, "format": "json"
+        r = SESSION.post(f"{OLLAMA_URL}/api/chat", json={
+            "model": OLLAMA_MODEL, "messages": [{"role": "user", "content": prompt}],
+            "stream": False, "format": "json",
+            "options": {"num_ctx": 2048, "cache_prompt": True}
         }, timeout=30)
         
         extracted = json.loads(r.json()["message"]["content"])
@@ -109,13 +171,42 @@ def generate_narrative(title, year, overview, query):
     4. Ton chaleureux, 3 phrases max.
     """
     try:
-        r = requests.post(f"{OLLAMA_URL}/api/chat", json={
+        r = SESSION.post(f"{OLLAMA_URL}/api/chat", json={
             "model": OLLAMA_MODEL, "messages": [{"role": "user", "content": prompt}], "stream": False
         }, timeout=30)
         return r.json()["message"]["content"].strip()
     except:
         return "Ce film correspond à vos critères et propose une intrigue captivante."
 
+def generate_narratives(films, query):
+    # Une seule requête LLM pour les 3 films (JSON) au lieu de 3 appels /api/chat
+    liste = "\n".join(f'- "{t}" ({y}) : "{o}"' for t, y, o in films)
+    prompt = f"""
+    Pour la demande "{query}", explique pourquoi recommander chacun de ces films :
+    {liste}
+    CONSIGNES :
+    1. Une phrase sur pourquoi ça matche l'ambiance.
+    2. Une phrase résumant l'intrigue (sans spoiler).
+    3. Pas de mention du réalisateur.
+    4. Ton chaleureux, 3 phrases max par film.
+    Réponds en JSON : {{"narratives": [{{"title": "...", "text": "..."}}]}}
+    """
+    try:
+        r = SESSION.post(f"{OLLAMA_URL}/api/chat", json={
+            "model": OLLAMA_MODEL, "messages": [{"role": "user", "content": prompt}],
+            "stream": False, "format": "json"
+        }, timeout=60)
+        narratives = json.loads(r.json()["message"]["content"])["narratives"]
+        out = {n["title"]: n["text"].strip() for n in narratives}
+        if all(t in out for t, _, _ in films):
+            return out
+    except:
+        pass
+    # Fallback : appels individuels, mais en parallèle
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        descs = list(ex.map(lambda f: generate_narrative(f[0], f[1], f[2], query), films))
+    return {t: d for (t, _, _), d in zip(films, descs)}
+
 # ===============================
 # INTERFACE STREAMLIT
 # ===============================
@@ -124,16 +215,22 @@ st.title("🎬 Votre Assistant Vidéothèque Personnel")
 
 @st.cache_data
 def load_base_data():
-    conn = get_conn()
-    g_df = fetch_df(conn, "SELECT name FROM genre")
-    fg_df = fetch_df(conn, "SELECT film_id, genre_id FROM film_genre")
-    profile = fetch_df(conn, SQL_GENRE_PROFILE, {"user_id": DEFAULT_USER_ID})
-    conn.close()
-    
+    with conn_ctx() as conn:
+        g_df = fetch_df(conn, "SELECT name FROM genre")
+        profile = fetch_df(conn, SQL_GENRE_PROFILE, {"user_id": DEFAULT_USER_ID})
+
+    # Profil en SoA : deux tableaux parallèles prêts à passer à unnest() côté SQL,
+    # construits une seule fois au lieu d'être reconstruits à chaque tour de chat
+    if profile.empty:
+        gids, avgs = [], []
+    else:
+        gids = profile["genre_id"].astype(int).tolist()
+        avgs = profile["avg_rating"].astype(float).tolist()
+
     return {
         "genre_names": [r['name'] for r in g_df.to_dict('records')],
-        "film_genres": fg_df.groupby("film_id")["genre_id"].apply(list).to_dict(),
-        "profile": {int(r['genre_id']): float(r['avg_rating']) for r in profile.to_dict('records')}
+        "profile_gids": gids,
+        "profile_avgs": avgs,
     }
 
 data = load_base_data()
@@ -143,58 +240,42 @@ if prompt := st.chat_input("Ex: Une comédie légère et courte..."):
 
     with st.spinner("Recherche dans votre collection..."):
         # 1. Extraction d'intention
-        intent = extract_intent(prompt, data["genre_names"])
+        # (tuple hashable => la même demande ne repart pas vers Ollama)
+        intent = extract_intent(prompt, tuple(data["genre_names"]))
         style_query = intent.get('style') or prompt # Fallback sur le texte original si vide
-        qvec = ollama_embed(style_query)
+        qvec = ollama_embed_one(style_query)
         
         # 2. SQL avec filtrage strict (Genre)
         genres_to_filter = intent['genres'] if intent['genres'] else data["genre_names"]
-        conn = get_conn()
-        results = fetch_df(conn, SQL_HYBRID_SEARCH, {
-            "user_id": DEFAULT_USER_ID, 
-            "qvec": "[" + ",".join(map(str, qvec)) + "]",
-            "genres": genres_to_filter
-        })
-        conn.close()
-
-        # 3. Scoring Hybride et protection KeyError
-        rows = []
-        top_recos = pd.DataFrame() # Initialisation vide par sécurité
-
-        if not results.empty:
-            # Filtre additionnel Durée
-            if intent['max_duration']:
-                results = results[results['runtime_min'].fillna(999) <= intent['max_duration']]
-            
-            for r in results.itertuples():
-                # Score Genre (Profil historique) - 70%
-                g_ids = data["film_genres"].get(r.film_id, [])
-                s_gen = np.mean([data["profile"].get(gid, 5.0) for gid in g_ids]) if g_ids else 5.0
-                
-                # Score Sémantique (0 à 10) - 30%
-                s_sem = float(r.similarity) * 10.0
-                
-                final_score = (0.7 * s_gen) + (0.3 * s_sem)
-                
-                rows.append({
-                    "title": r.title, "year": r.year, "runtime": r.runtime_min, 
-                    "overview": r.overview, "score": final_score
-                })
-
-            if rows:
-                top_recos = pd.DataFrame(rows).sort_values("score", ascending=False).head(3)
+        with conn_ctx() as conn:
+            with conn.cursor() as cur:
+                # Rappel/vitesse de l'index HNSW pour la durée de la transaction
+                cur.execute("SET LOCAL hnsw.ef_search = 60;")
+            results = fetch_df(conn, SQL_HYBRID_SEARCH, {
+                "user_id": DEFAULT_USER_ID,
+                "qvec": qvec,
+                "genres": genres_to_filter,
+                "max_duration": intent['max_duration'],
+                "profile_gids": data["profile_gids"],
+                "profile_avgs": data["profile_avgs"],
+            })
+
+        # 3. Scoring hybride, filtre durée et top 3 déjà calculés côté SQL :
+        #    Postgres ne renvoie que 3 lignes au lieu de 150
+        top_recos = results.rename(columns={"runtime_min": "runtime"})
 
     # 4. Affichage des résultats
     with st.chat_message("assistant"):
         if top_recos.empty:
             st.warning("⚠️ Aucun film ne correspond (essayez d'enlever des filtres de durée ou de genre).")
         else:
+            films = [(r.title, r.year, r.overview) for r in top_recos.itertuples()]
+            with st.spinner("Rédaction des recommandations..."):
+                descs = generate_narratives(films, prompt)
+
             for r in top_recos.itertuples():
                 with st.container():
                     st.subheader(f"{r.title} ({int(r.year)})")
                     st.caption(f"⏱️ {int(r.runtime) if pd.notnull(r.runtime) else '??'} min | ⭐ Score : {r.score:.1f}/10")
-                    
-                    with st.spinner(f"Réflexion sur {r.title}..."):
-                        desc = generate_narrative(r.title, r.year, r.overview, prompt)
-                    st.write(desc)
+                    st.write(descs[r.title])
                     st.divider()
\ No newline at end of file
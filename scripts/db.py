@@ -0,0 +1,44 @@
+# Accès Postgres partagé par les scripts : un pool de connexions par
+# processus au lieu d'un psycopg2.connect par invocation/worker.
+import os
+from contextlib import contextmanager
+
+import psycopg2.pool
+from psycopg2.extras import DictCursor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB = dict(
+    host=os.getenv("POSTGRES_HOST", "localhost"),
+    port=int(os.getenv("POSTGRES_PORT", "5432")),
+    dbname=os.getenv("POSTGRES_DB", "videotheque"),
+    user=os.getenv("POSTGRES_USER", "postgres"),
+    password=os.getenv("POSTGRES_PASSWORD", "postgres"),
+)
+
+_POOL = None
+
+def get_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """Pool paresseux : créé au premier usage, partagé ensuite."""
+    global _POOL
+    if _POOL is None:
+        _POOL = psycopg2.pool.ThreadedConnectionPool(1, 8, **DB)
+    return _POOL
+
+@contextmanager
+def connection(autocommit: bool = False):
+    pool = get_pool()
+    conn = pool.getconn()
+    conn.autocommit = autocommit
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+@contextmanager
+def cursor(dict_cursor: bool = False):
+    """Curseur prêt à l'emploi ; commit à la sortie, rollback sur exception."""
+    with connection() as conn:
+        with conn, conn.cursor(cursor_factory=DictCursor if dict_cursor else None) as cur:
+            yield cur
@@ -0,0 +1,109 @@
+-- Optimisations de performance à appliquer sur une base existante.
+-- Toutes les commandes sont idempotentes (IF NOT EXISTS).
+
+-- Filtre ASCII : colonne générée persistée + index partiel, au lieu de
+-- ré-exécuter la regex '^[\x00-\x7F]+$' sur chaque titre candidat à chaque requête.
+ALTER TABLE film ADD COLUMN IF NOT EXISTS title_is_ascii boolean
+  GENERATED ALWAYS AS (title ~ '^[[:ascii:]]+$') STORED;
+CREATE INDEX IF NOT EXISTS idx_film_title_is_ascii ON film(title_is_ascii) WHERE title_is_ascii;
+
+-- Index ANN HNSW (cosinus) pour le CTE sémantique : sans lui le
+-- ORDER BY embedding <=> ... est un scan séquentiel de film_embedding.
+-- Penser à monter maintenance_work_mem pendant la construction.
+CREATE INDEX IF NOT EXISTS film_embedding_hnsw ON film_embedding
+  USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+
+-- Quantification FP16 (halfvec) : moitié moins de stockage et de bande
+-- passante pour la traversée HNSW, perte de rappel négligeable en 768D.
+ALTER TABLE film_embedding ADD COLUMN IF NOT EXISTS embedding_h halfvec(768);
+UPDATE film_embedding SET embedding_h = embedding::halfvec(768) WHERE embedding_h IS NULL;
+CREATE INDEX IF NOT EXISTS film_embedding_hnsw_h ON film_embedding
+  USING hnsw (embedding_h halfvec_cosine_ops) WITH (m = 16, ef_construction = 64);
+
+-- Quantification binaire : présélection par distance de Hamming (un popcount
+-- par mot de 64 bits), puis rerank exact sur les vecteurs pleins.
+ALTER TABLE film_embedding ADD COLUMN IF NOT EXISTS emb_bin bit(768);
+UPDATE film_embedding SET emb_bin = binary_quantize(embedding) WHERE emb_bin IS NULL;
+CREATE INDEX IF NOT EXISTS film_embedding_hnsw_bin ON film_embedding
+  USING hnsw (emb_bin bit_hamming_ops) WITH (m = 16, ef_construction = 64);
+
+-- Recherche trigramme : l'opérateur % de pg_trgm s'appuie sur un index GIN,
+-- là où ORDER BY similarity(...) seul force un scan séquentiel de film.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS idx_film_title_trgm ON film USING gin (title gin_trgm_ops);
+
+-- Jointure du rapport NAS : le DISTINCT ON (raw_file_path ... created_at DESC)
+-- devient un parcours d'index au lieu d'un tri complet de import_nas.
+CREATE INDEX IF NOT EXISTS idx_import_nas_path_created
+  ON import_nas (raw_file_path, created_at DESC);
+
+-- Agrégation des réalisateurs : index partiel limité aux lignes job='Director'.
+CREATE INDEX IF NOT EXISTS idx_film_credit_director
+  ON film_credit (film_id) WHERE job = 'Director';
+
+-- Fallback plein-texte quand pg_trgm n'est pas disponible : index GIN sur le
+-- tsvector du titre (unaccent via wrapper immutable, requis pour l'index).
+CREATE EXTENSION IF NOT EXISTS unaccent;
+CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS
+$$ SELECT public.unaccent('public.unaccent', $1) $$
+LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+CREATE INDEX IF NOT EXISTS film_title_fts ON film
+  USING gin (to_tsvector('simple', f_unaccent(title)));
+
+-- Réclamation de lots par les workers apply (FOR UPDATE SKIP LOCKED) :
+-- index partiels pour que la requête d'éligibilité ne parcoure que le
+-- backlog encore à appliquer.
+CREATE INDEX IF NOT EXISTS idx_import_seen_apply_pending
+  ON import_seen_sc (import_seen_id)
+  WHERE match_status = 'MATCHED'
+    AND (match_note IS NULL OR match_note NOT LIKE '%applied%');
+CREATE INDEX IF NOT EXISTS idx_import_watchlist_apply_pending
+  ON import_watchlist_sc (import_id)
+  WHERE match_status = 'MATCHED'
+    AND (match_note IS NULL OR match_note NOT LIKE '%applied%');
+
+-- Colonne booléenne `applied` à la place du filtre LIKE '%applied%' sur
+-- match_note : l'éligibilité devient un test indexable O(backlog) et le flip
+-- de fin de lot n'agrandit plus le TEXT à chaque rejeu.
+ALTER TABLE import_seen_sc      ADD COLUMN IF NOT EXISTS applied boolean NOT NULL DEFAULT FALSE;
+ALTER TABLE import_watchlist_sc ADD COLUMN IF NOT EXISTS applied boolean NOT NULL DEFAULT FALSE;
+ALTER TABLE import_br           ADD COLUMN IF NOT EXISTS applied boolean NOT NULL DEFAULT FALSE;
+ALTER TABLE import_nas          ADD COLUMN IF NOT EXISTS applied boolean NOT NULL DEFAULT FALSE;
+
+-- Migration des lignes historiques marquées dans match_note.
+UPDATE import_seen_sc      SET applied = TRUE WHERE NOT applied AND match_note LIKE '%applied%';
+UPDATE import_watchlist_sc SET applied = TRUE WHERE NOT applied AND match_note LIKE '%applied%';
+UPDATE import_br           SET applied = TRUE WHERE NOT applied AND match_note LIKE '%applied%';
+UPDATE import_nas          SET applied = TRUE WHERE NOT applied AND match_note LIKE '%applied%';
+
+-- Les index de claim se rebasent sur le booléen.
+DROP INDEX IF EXISTS idx_import_seen_apply_pending;
+CREATE INDEX IF NOT EXISTS idx_import_seen_apply_pending
+  ON import_seen_sc (import_seen_id)
+  WHERE applied = FALSE AND match_status = 'MATCHED';
+DROP INDEX IF EXISTS idx_import_watchlist_apply_pending;
+CREATE INDEX IF NOT EXISTS idx_import_watchlist_apply_pending
+  ON import_watchlist_sc (import_id)
+  WHERE applied = FALSE AND match_status = 'MATCHED';
+CREATE INDEX IF NOT EXISTS idx_import_br_apply_pending
+  ON import_br (import_br_id)
+  WHERE applied = FALSE AND match_status = 'MATCHED';
+CREATE INDEX IF NOT EXISTS idx_import_nas_apply_pending
+  ON import_nas (import_nas_id)
+  WHERE applied = FALSE AND match_status = 'MATCHED';
+
+-- Fiche TMDb choisie persistée au match : la phase apply relit ce JSONB au
+-- lieu de rappeler /movie/{id} (fallback HTTP seulement si la fiche stockée
+-- est incomplète, p.ex. runtime absent des résultats de /search).
+ALTER TABLE import_seen_sc      ADD COLUMN IF NOT EXISTS raw_tmdb_json jsonb;
+ALTER TABLE import_watchlist_sc ADD COLUMN IF NOT EXISTS raw_tmdb_json jsonb;
+
+-- Réalisateurs matérialisés au premier fetch credits : les runs suivants
+-- (match_nas, match_br, match_seen) départagent les candidats par un SELECT
+-- local au lieu de rappeler TMDb. On stocke les noms bruts TMDb ; chaque
+-- script applique sa propre normalisation à la lecture.
+CREATE TABLE IF NOT EXISTS film_directors (
+  tmdb_id bigint NOT NULL,
+  name    text   NOT NULL,
+  PRIMARY KEY (tmdb_id, name)
+);
@@ -1,9 +1,11 @@
 import os
 import re
+import csv
+import io
 import argparse
 import pandas as pd
 import psycopg2
-from psycopg2.extras import execute_values
+from functools import lru_cache
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -18,17 +20,24 @@ DB = dict(
 
 # --- parsing formats from brackets ------------------------------------------------
 
+# Regex compilées une fois au chargement du module (appelées par ligne de CSV)
+_BRACKETS = re.compile(r"\[([^\]]+)\]")
+_TOK_SPLIT = re.compile(r"[+,/&]| et ", re.IGNORECASE)
+_TRAIL_BRACKETS = re.compile(r"\s*(\[[^\]]+\]\s*)+$")
+_WS = re.compile(r"\s+")
+
 def extract_brackets(title: str) -> list[str]:
     """Return tokens found inside all [...] occurrences."""
     if not title:
         return []
-    return re.findall(r"\[([^\]]+)\]", title)
+    return _BRACKETS.findall(title)
 
-def normalize_tokens(tokens: list[str]) -> list[str]:
+@lru_cache(maxsize=1024)
+def normalize_tokens(tokens: tuple[str, ...]) -> list[str]:
     out = []
     for block in tokens:
         # split by + / , / / / &
-        parts = re.split(r"[+,/&]| et ", block, flags=re.IGNORECASE)
+        parts = _TOK_SPLIT.split(block)
         for p in parts:
             t = p.strip().upper()
             if not t:
@@ -54,52 +63,102 @@ def clean_title(title: str) -> str:
     if not title:
         return title
     # remove trailing bracket groups like " [BR]" or " [BR + DVD]" etc. (one or more)
-    t = re.sub(r"\s*(\[[^\]]+\]\s*)+$", "", title).strip()
-    t = re.sub(r"\s+", " ", t).strip()
+    t = _TRAIL_BRACKETS.sub("", title).strip()
+    t = _WS.sub(" ", t).strip()
     return t
 
-def as_text_ean(x):
-    if pd.isna(x) or x == "":
-        return None
-    s = str(x).strip()
-    if re.match(r"^\d+(\.\d+)?E\+\d+$", s, flags=re.IGNORECASE):
-        try:
-            return f"{int(float(s))}"
-        except Exception:
-            return s
-    try:
-        if re.match(r"^\d+(\.0+)?$", s):
-            return str(int(float(s)))
-    except Exception:
-        pass
-    return s
-
-def parse_date(s):
-    if s is None or pd.isna(s) or str(s).strip() == "":
-        return None
-    txt = str(s).strip()
-    # Si format ISO YYYY-MM-DD
-    if re.match(r"^\d{4}-\d{2}-\d{2}$", txt):
-        d = pd.to_datetime(txt, format="%Y-%m-%d", errors="coerce")
-    else:
-        d = pd.to_datetime(txt, dayfirst=True, errors="coerce")
-    return None if pd.isna(d) else d.date()
-
-def parse_int(s):
-    if s is None or pd.isna(s) or str(s).strip() == "":
-        return None
-    try:
-        return int(float(s))
-    except Exception:
-        return None
-
-def parse_num(s):
-    if s is None or pd.isna(s) or str(s).strip() == "":
-        return None
-    try:
-        return float(s)
-    except Exception:
-        return None
+def copy_rows(cur, table: str, columns: list[str], rows: list[tuple]) -> None:
+    """Insertion en masse via COPY FROM STDIN, le chemin le plus rapide de Postgres.
+
+    None -> NULL (champ vide non quoté), list -> littéral tableau {A,B}.
+    """
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    for row in rows:
+        w.writerow([
+            "{" + ",".join(v) + "}" if isinstance(v, list) else v
+            for v in row
+        ])
+    buf.seek(0)
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf
+    )
+
+def build_rows(df: pd.DataFrame) -> list[tuple]:
+    """Transforme le DataFrame en lignes à insérer, colonne par colonne.
+
+    Les conversions (dates, entiers, numériques, EAN) sont vectorisées :
+    une passe pandas/C par colonne au lieu d'un appel Python par cellule.
+    """
+    n = len(df)
+
+    def col(name):
+        if name in df.columns:
+            return df[name].fillna("")
+        return pd.Series([""] * n, index=df.index, dtype=str)
+
+    def text_col(name):
+        return [v or None for v in col(name).tolist()]
+
+    def date_col(name):
+        d = pd.to_datetime(col(name).replace("", None), dayfirst=True,
+                           errors="coerce", format="mixed")
+        return [None if pd.isna(v) else v.date() for v in d]
+
+    def int_col(name):
+        v = pd.to_numeric(col(name).replace("", None), errors="coerce")
+        return [None if pd.isna(x) else int(x) for x in v]
+
+    def num_col(name):
+        v = pd.to_numeric(col(name).replace("", None), errors="coerce")
+        return [None if pd.isna(x) else float(x) for x in v]
+
+    def ean_col(name):
+        s = col(name).str.strip()
+        # notation scientifique ou entier déguisé en float -> texte int
+        numlike = s.str.match(r"^\d+(\.\d+)?E\+\d+$|^\d+(\.0+)?$", case=False)
+        conv = pd.to_numeric(s.where(numlike, None), errors="coerce")
+        return [str(int(c)) if pd.notna(c) else (v or None)
+                for v, c in zip(s.tolist(), conv.tolist())]
+
+    titles = col("title").tolist()
+    formats = [normalize_tokens(tuple(extract_brackets(t))) for t in titles]
+    titles_clean = [clean_title(t) for t in titles]
+
+    return list(zip(
+        text_col("item_type"),
+        titles,
+        text_col("creators"),
+        text_col("first_name"),
+        text_col("last_name"),
+        ean_col("ean_isbn13"),
+        text_col("upc_isbn10"),
+        text_col("description"),
+        text_col("publisher"),
+        date_col("publish_date"),
+        text_col("raw_group"),
+        text_col("tags"),
+        text_col("notes"),
+        num_col("price"),
+        int_col("length"),
+        int_col("number_of_discs"),
+        int_col("number_of_players"),
+        text_col("age_group"),
+        text_col("ensemble"),
+        text_col("aspect_ratio"),
+        text_col("esrb"),
+        text_col("rating"),
+        text_col("review"),
+        date_col("review_date"),
+        text_col("status"),
+        date_col("began"),
+        date_col("completed"),
+        date_col("added"),
+        int_col("copies"),
+        titles_clean,
+        [True] * n,    # is_physical
+        formats,       # formats text[]
+    ))
 
 def main():
     ap = argparse.ArgumentParser()
@@ -120,73 +179,35 @@ def main():
     elif sample.count(",") > sample.count("\t") and sample.count(",") > sample.count(";"):
         sep = ","
 
-    df = pd.read_csv(args.csv, sep=sep, dtype=str, keep_default_na=False, encoding="utf-8-sig")
-    print(f"[import_br] Detected separator: {repr(sep)} | columns={list(df.columns)[:8]} ...")
-
-    def col(name):
-        return df[name] if name in df.columns else [""] * len(df)
-
-    rows = []
-    for i in range(len(df)):
-        raw_title = col("title")[i]
-        tokens = extract_brackets(raw_title)
-        formats = normalize_tokens(tokens)
-        title_clean = clean_title(raw_title)
-
-        rows.append((
-            col("item_type")[i] or None,
-            raw_title,
-            col("creators")[i] or None,
-            col("first_name")[i] or None,
-            col("last_name")[i] or None,
-            as_text_ean(col("ean_isbn13")[i]),
-            col("upc_isbn10")[i] or None,
-            col("description")[i] or None,
-            col("publisher")[i] or None,
-            parse_date(col("publish_date")[i]),
-            col("raw_group")[i] or None,
-            col("tags")[i] or None,
-            col("notes")[i] or None,
-            parse_num(col("price")[i]),
-            parse_int(col("length")[i]),
-            parse_int(col("number_of_discs")[i]),
-            parse_int(col("number_of_players")[i]),
-            col("age_group")[i] or None,
-            col("ensemble")[i] or None,
-            col("aspect_ratio")[i] or None,
-            col("esrb")[i] or None,
-            col("rating")[i] or None,
-            col("review")[i] or None,
-            parse_date(col("review_date")[i]),
-            col("status")[i] or None,
-            parse_date(col("began")[i]),
-            parse_date(col("completed")[i]),
-            parse_date(col("added")[i]),
-            parse_int(col("copies")[i]),
-            title_clean,
-            True,          # is_physical
-            formats,       # formats text[]
-        ))
-
     conn = psycopg2.connect(**DB)
+    total = 0
     with conn, conn.cursor() as cur:
         if args.truncate:
             cur.execute("TRUNCATE TABLE import_br;")
 
-        sql = """
-        INSERT INTO import_br (
-          item_type, raw_title, raw_creators, raw_first_name, raw_last_name,
-          ean_isbn13, upc_isbn10, description, publisher, publish_date, raw_group,
-          tags, notes, price, length_min, number_of_discs, number_of_players,
-          age_group, ensemble, aspect_ratio, esrb, rating, review, review_date,
-          status, began, completed, added, copies,
-          raw_title_clean, is_physical, formats
-        ) VALUES %s
-        """
-        execute_values(cur, sql, rows, page_size=500)
+        # Lecture par morceaux : le DataFrame complet et la liste de tuples
+        # ne vivent jamais ensemble en mémoire, et le COPY démarre tout de suite
+        # dtype_backend="pyarrow" : colonnes texte en Arrow, les kernels .str
+        # tournent en C++ et la RAM chute (~3x) sur les colonnes larges
+        reader = pd.read_csv(args.csv, sep=sep, dtype=str, keep_default_na=False,
+                             encoding="utf-8-sig", chunksize=10_000,
+                             dtype_backend="pyarrow")
+        for i, chunk in enumerate(reader):
+            if i == 0:
+                print(f"[import_br] Detected separator: {repr(sep)} | columns={list(chunk.columns)[:8]} ...")
+            rows = build_rows(chunk)
+            copy_rows(cur, "import_br", [
+                "item_type", "raw_title", "raw_creators", "raw_first_name", "raw_last_name",
+                "ean_isbn13", "upc_isbn10", "description", "publisher", "publish_date", "raw_group",
+                "tags", "notes", "price", "length_min", "number_of_discs", "number_of_players",
+                "age_group", "ensemble", "aspect_ratio", "esrb", "rating", "review", "review_date",
+                "status", "began", "completed", "added", "copies",
+                "raw_title_clean", "is_physical", "formats",
+            ], rows)
+            total += len(rows)
 
     conn.close()
-    print(f"OK - import_br rempli: {len(rows)} lignes")
+    print(f"OK - import_br rempli: {total} lignes")
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,6 @@
 import os
+import csv
+import io
 import argparse
 import pandas as pd
 import psycopg2
@@ -7,6 +9,31 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
+def build_rows(df: pd.DataFrame) -> list[tuple]:
+    # Normalisation vectorisée (kernels pandas, plus de boucle itertuples)
+    year = pd.to_numeric(df["year"], errors="coerce")
+    date_added = pd.to_datetime(df["date_added"], errors="coerce")
+
+    lang = df["language"].astype("string").str.strip()
+    lang = lang.where(lang.str.len() >= 2).str[:2].str.lower()
+
+    def text_list(name):
+        return [v if isinstance(v, str) else None for v in df[name].tolist()]
+
+    return list(zip(
+        df["title"].tolist(),
+        [int(y) if pd.notna(y) else None for y in year],
+        text_list("director"),
+        [v if pd.notna(v) else None for v in lang],
+        text_list("actors"),
+        text_list("synopsis"),
+        text_list("poster_url"),
+        text_list("file"),
+        text_list("file_path"),
+        [d.to_pydatetime() if pd.notna(d) else None for d in date_added],
+    ))
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--csv", required=True, help="Path to NAS_export_videotheque_*.csv")
@@ -18,59 +45,44 @@ def main():
     ap.add_argument("--truncate", action="store_true", help="Empty import_nas before import")
     args = ap.parse_args()
 
-    # Lecture CSV NAS (ton export est en ; et souvent en utf-8-sig)
-    df = pd.read_csv(args.csv, sep=";", encoding="utf-8-sig")
-
-    # Colonnes attendues dans ton export
-    # title;year;director;language;actors;synopsis;poster_url;file;file_path;date_added
-    for col in ["title", "year", "director", "language", "actors", "synopsis", "poster_url", "file", "file_path", "date_added"]:
-        if col not in df.columns:
-            raise ValueError(f"Colonne manquante dans le CSV: {col}. Colonnes trouvées: {list(df.columns)}")
-
-    # Normalisation
-    df["year"] = pd.to_numeric(df["year"], errors="coerce").astype("Int64")
-    df["date_added"] = pd.to_datetime(df["date_added"], errors="coerce")
-
-    def norm_lang(x):
-        if isinstance(x, str):
-            x = x.strip()
-            return x[:2].lower() if len(x) >= 2 else None
-        return None
-
-    rows = []
-    for r in df.itertuples(index=False):
-        rows.append((
-            r.title,
-            int(r.year) if pd.notna(r.year) else None,
-            r.director if isinstance(r.director, str) else None,
-            norm_lang(r.language),
-            r.actors if isinstance(r.actors, str) else None,
-            r.synopsis if isinstance(r.synopsis, str) else None,
-            r.poster_url if isinstance(r.poster_url, str) else None,
-            r.file if isinstance(r.file, str) else None,
-            r.file_path if isinstance(r.file_path, str) else None,
-            r.date_added.to_pydatetime() if pd.notna(r.date_added) else None
-        ))
-
     conn = psycopg2.connect(
         host=args.host, port=args.port, dbname=args.db, user=args.user, password=args.password
     )
 
+    total = 0
     with conn, conn.cursor() as cur:
         if args.truncate:
             cur.execute("TRUNCATE TABLE import_nas;")
 
-        cur.executemany("""
-            INSERT INTO import_nas (
-                raw_title, raw_year, raw_director, raw_language, raw_actors,
-                raw_synopsis, raw_poster_url, raw_file, raw_file_path, date_added
-            )
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """, rows)
+        # Lecture CSV NAS par morceaux (ton export est en ; et souvent en utf-8-sig) :
+        # la transformation et le COPY s'enchaînent sans tout charger en RAM
+        # dtype_backend="pyarrow" : chaînes Arrow, parsing et .str plus rapides
+        reader = pd.read_csv(args.csv, sep=";", encoding="utf-8-sig", chunksize=10_000,
+                             dtype_backend="pyarrow")
+        for i, df in enumerate(reader):
+            if i == 0:
+                # Colonnes attendues dans ton export
+                # title;year;director;language;actors;synopsis;poster_url;file;file_path;date_added
+                for col in ["title", "year", "director", "language", "actors", "synopsis", "poster_url", "file", "file_path", "date_added"]:
+                    if col not in df.columns:
+                        raise ValueError(f"Colonne manquante dans le CSV: {col}. Colonnes trouvées: {list(df.columns)}")
+
+            rows = build_rows(df)
+            # COPY FROM STDIN : une seule commande au lieu d'un INSERT par ligne
+            buf = io.StringIO()
+            csv.writer(buf).writerows(rows)
+            buf.seek(0)
+            cur.copy_expert("""
+                COPY import_nas (
+                    raw_title, raw_year, raw_director, raw_language, raw_actors,
+                    raw_synopsis, raw_poster_url, raw_file, raw_file_path, date_added
+                ) FROM STDIN WITH (FORMAT csv)
+            """, buf)
+            total += len(rows)
 
     conn.commit()
     conn.close()
-    print(f"OK - import_nas rempli: {len(rows)} lignes")
+    print(f"OK - import_nas rempli: {total} lignes")
 
 if __name__ == "__main__":
     main()
@@ -1,14 +1,30 @@
 # -*- coding: utf-8 -*-
 import os
+import io
 import re
+import atexit
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional, Tuple, List
 
-import requests
+import httpx
+import numpy as np
 import pandas as pd
+import pyarrow.csv as pa_csv
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from pgvector.psycopg2 import register_vector
+
+
+# Client HTTP partagé : keep-alive + multiplexage HTTP/2, pas de
+# handshake TCP/TLS à chaque appel d'embedding.
+_CLIENT = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=40, keepalive_expiry=30),
+    timeout=httpx.Timeout(300.0, connect=10.0),
+)
+atexit.register(_CLIENT.close)
 
 
 # -----------------------------
@@ -16,6 +32,7 @@ from psycopg2.extras import RealDictCursor
 # -----------------------------
 RE_REWATCH = re.compile(r"(?i)\brevu\s+le\s+(\d{1,2})/(\d{1,2})/(\d{4})")
 RE_SC_ID = re.compile(r"/(\d+)(?:\?|$)")
+RE_LEAD_PUNCT = re.compile(r"^[\s\.\-\:\n\r]+")
 
 
 def extract_sc_id(url: str) -> Optional[str]:
@@ -45,7 +62,7 @@ def parse_annotation(annotation: str) -> Tuple[Optional[str], Optional[str]]:
         # Remove the matched part and leading punctuation/newlines
         start, end = m.span()
         txt = (txt[:start] + txt[end:]).strip()
-        txt = re.sub(r"^[\s\.\-\:\n\r]+", "", txt).strip()
+        txt = RE_LEAD_PUNCT.sub("", txt).strip()
 
     # Clean doubled quotes from CSV exports
     txt = txt.replace('""', '"').strip()
@@ -70,7 +87,7 @@ def get_conn(host: str, port: int, db: str, user: str, pwd: str):
 
 
 def ollama_embed(ollama_url: str, model: str, text: str, timeout: int = 120) -> List[float]:
-    r = requests.post(
+    r = _CLIENT.post(
         f"{ollama_url}/api/embeddings",
         json={"model": model, "prompt": text},
         timeout=timeout,
@@ -86,27 +103,70 @@ def ollama_embed(ollama_url: str, model: str, text: str, timeout: int = 120) ->
 # -----------------------------
 # SQL (assumes you created film_external_id)
 # -----------------------------
-SQL_GET_FILM_ID = """
-SELECT film_id
-FROM film_external_id
-WHERE provider = %(provider)s
-  AND external_key = %(external_key)s
-LIMIT 1;
+# Table de staging : une seule passe COPY, puis des statements ensemblistes
+# (INSERT ... SELECT) au lieu de 3-4 cur.execute par ligne de CSV.
+SQL_CREATE_STAGE = """
+CREATE TEMP TABLE stage_comment (
+  sc_id           text,
+  user_id         bigint,
+  comment_text    text,
+  raw_annotation  text,
+  rewatch_iso     date
+) ON COMMIT DROP;
 """
 
-SQL_INSERT_WATCH_EVENT = """
+SQL_COUNT_NOT_FOUND = """
+SELECT COUNT(*) AS n
+FROM stage_comment s
+WHERE NOT EXISTS (
+  SELECT 1 FROM film_external_id fe
+  WHERE fe.provider = %(provider)s AND fe.external_key = s.sc_id
+);
+"""
+
+SQL_INSERT_WATCH_EVENTS = """
 INSERT INTO watch_event (user_id, film_id, watched_at, context, notes)
-VALUES (%(user_id)s, %(film_id)s, %(watched_at)s::timestamp, %(context)s, %(notes)s);
+SELECT s.user_id, fe.film_id, s.rewatch_iso::timestamp,
+       'rewatch (senscritique)', 'parsed from annotation'
+FROM stage_comment s
+JOIN film_external_id fe
+  ON fe.provider = %(provider)s AND fe.external_key = s.sc_id
+WHERE s.rewatch_iso IS NOT NULL;
 """
 
 # robust upsert: ensure row exists + update last_seen_at + rewatch_count
+# (GROUP BY pour ne produire qu'une ligne par (user, film) dans l'INSERT)
 SQL_UPSERT_USER_FILM_REWATCH = """
 INSERT INTO user_film (user_id, film_id, status, last_seen_at, rewatch_count)
-VALUES (%(user_id)s, %(film_id)s, 'SEEN', %(seen_at)s::date, 1)
+SELECT s.user_id, fe.film_id, 'SEEN', MAX(s.rewatch_iso), COUNT(*)
+FROM stage_comment s
+JOIN film_external_id fe
+  ON fe.provider = %(provider)s AND fe.external_key = s.sc_id
+WHERE s.rewatch_iso IS NOT NULL
+GROUP BY s.user_id, fe.film_id
 ON CONFLICT (user_id, film_id)
 DO UPDATE SET
   last_seen_at = GREATEST(user_film.last_seen_at, EXCLUDED.last_seen_at),
-  rewatch_count = COALESCE(user_film.rewatch_count, 0) + 1;
+  rewatch_count = COALESCE(user_film.rewatch_count, 0) + EXCLUDED.rewatch_count;
+"""
+
+SQL_INSERT_COMMENTS = """
+INSERT INTO user_comment (user_id, film_id, source, comment_text, raw_annotation)
+SELECT s.user_id, fe.film_id, %(source)s, s.comment_text, s.raw_annotation
+FROM stage_comment s
+JOIN film_external_id fe
+  ON fe.provider = %(provider)s AND fe.external_key = s.sc_id
+WHERE s.comment_text IS NOT NULL
+RETURNING comment_id, film_id, comment_text;
+"""
+
+# Films dont un commentaire de ce user/source est déjà vectorisé : inutile
+# de rappeler Ollama pour eux lors d'un re-run
+SQL_ALREADY_EMBEDDED = """
+SELECT DISTINCT uc.film_id
+FROM user_comment uc
+JOIN comment_embedding ce USING (comment_id)
+WHERE uc.user_id = %(user_id)s AND uc.source = %(source)s;
 """
 
 # user_comment table (we'll create if missing)
@@ -124,17 +184,13 @@ CREATE INDEX IF NOT EXISTS idx_user_comment_user ON user_comment(user_id);
 CREATE INDEX IF NOT EXISTS idx_user_comment_film ON user_comment(film_id);
 """
 
-SQL_INSERT_COMMENT = """
-INSERT INTO user_comment (user_id, film_id, source, comment_text, raw_annotation)
-VALUES (%(user_id)s, %(film_id)s, %(source)s, %(comment_text)s, %(raw_annotation)s)
-RETURNING comment_id;
-"""
-
 # pgvector extension + embedding table (vector(dim))
 # We'll create with dim inferred at runtime the first time if needed.
 SQL_CREATE_VECTOR_EXT = "CREATE EXTENSION IF NOT EXISTS vector;"
 
 def sql_create_comment_embedding(dim: int) -> str:
+    # L'index ivfflat est (re)construit après le chargement, pas ici :
+    # le maintenir pendant les INSERT coûte une mise à jour du quantizer par ligne.
     return f"""
 CREATE TABLE IF NOT EXISTS comment_embedding (
   comment_id bigserial PRIMARY KEY REFERENCES user_comment(comment_id) ON DELETE CASCADE,
@@ -142,17 +198,59 @@ CREATE TABLE IF NOT EXISTS comment_embedding (
   embedding  vector({dim}) NOT NULL,
   created_at timestamp without time zone DEFAULT now()
 );
--- index approximate cosine
-CREATE INDEX IF NOT EXISTS idx_comment_embedding_ivfflat
-ON comment_embedding USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
 """
 
 
-SQL_INSERT_EMBEDDING = """
+SQL_INSERT_EMBEDDINGS = """
 INSERT INTO comment_embedding (comment_id, model, embedding)
-VALUES (%(comment_id)s, %(model)s, %(embedding)s);
+VALUES %s;
 """
 
+EMBED_FLUSH_SIZE = 500
+
+
+def _copy_escape(v) -> str:
+    """Échappe une valeur pour COPY FROM STDIN (FORMAT text), None -> \\N."""
+    if v is None:
+        return r"\N"
+    return (str(v)
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r"))
+
+
+def copy_stage_rows(cur, rows) -> None:
+    """COPY des lignes parsées (sc_id, user_id, comment, annotation, rewatch) en une passe."""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(_copy_escape(v) for v in row))
+        buf.write("\n")
+    buf.seek(0)
+    cur.copy_expert("COPY stage_comment FROM STDIN WITH (FORMAT text)", buf)
+
+
+def _load_and_clean_csv(csv_path: str, limit: int) -> pd.DataFrame:
+    """Lecture + nettoyage du CSV, isolés pour tourner dans un sous-processus."""
+    # Parsing C multi-threadé via pyarrow ; self_destruct libère les buffers
+    # Arrow au fil de la conversion vers pandas
+    table_arrow = pa_csv.read_csv(csv_path)
+    df = table_arrow.to_pandas(split_blocks=True, self_destruct=True)
+
+    required = {"title", "film_url", "annotation"}
+    missing = required - set(df.columns)
+    if missing:
+        raise SystemExit(f"[ERROR] Colonnes manquantes: {missing}. Colonnes={list(df.columns)}")
+
+    df["annotation"] = df["annotation"].fillna("").astype(str)
+    df = df[df["annotation"].str.strip() != ""].copy()  # ✅ seulement annotation non vide
+    df["sc_id"] = df["film_url"].apply(extract_sc_id)
+    df = df[df["sc_id"].notna()].copy()
+
+    if limit and limit > 0:
+        df = df.head(limit)
+    return df
+
 
 # -----------------------------
 # Main
@@ -177,39 +275,45 @@ def main():
     user_id = args.user_id
 
     print(f"[INFO] CSV: {csv_path}")
-    df = pd.read_csv(csv_path)
-
-    required = {"title", "film_url", "annotation"}
-    missing = required - set(df.columns)
-    if missing:
-        raise SystemExit(f"[ERROR] Colonnes manquantes: {missing}. Colonnes={list(df.columns)}")
-
-    df["annotation"] = df["annotation"].fillna("").astype(str)
-    df = df[df["annotation"].str.strip() != ""].copy()  # ✅ seulement annotation non vide
-    df["sc_id"] = df["film_url"].apply(extract_sc_id)
-    df = df[df["sc_id"].notna()].copy()
-
-    if args.limit and args.limit > 0:
-        df = df.head(args.limit)
+    # Le parsing CSV part dans un sous-processus pendant que la connexion
+    # Postgres s'établit : deux chemins d'I/O indépendants recouverts
+    conn = None
+    with ProcessPoolExecutor(max_workers=1) as ex:
+        df_fut = ex.submit(_load_and_clean_csv, csv_path, args.limit)
+        if not args.dry_run:
+            conn = get_conn(args.pg_host, args.pg_port, args.pg_db,
+                            args.pg_user, args.pg_password)
+            conn.autocommit = False
+        df = df_fut.result()
 
     if df.empty:
         print("[INFO] Rien à traiter (annotation vide ou sc_id absent).")
+        if conn is not None:
+            conn.close()
         return
 
     print(f"[INFO] Lignes à traiter: {len(df)}")
 
-    conn = get_conn(args.pg_host, args.pg_port, args.pg_db, args.pg_user, args.pg_password)
-    conn.autocommit = False
+    # Parsing en amont : une passe Python, le reste part en SQL ensembliste
+    stage_rows = []
+    rewatch_events = 0
+    for row in df.itertuples(index=False):
+        sc_id = str(getattr(row, "sc_id")).strip()
+        annotation = str(getattr(row, "annotation")).strip()
+        rewatch_iso, comment_text = parse_annotation(annotation)
+        if rewatch_iso:
+            rewatch_events += 1
+        stage_rows.append((sc_id, user_id, comment_text, annotation, rewatch_iso))
+
+    if args.dry_run:
+        print("[DRY-RUN] aucune écriture en base")
+        print(f"staged_rows={len(stage_rows)}")
+        print(f"rewatch_events={rewatch_events}")
+        print(f"comments={sum(1 for r in stage_rows if r[2])}")
+        return
 
-    created_embedding_table = False
     embedding_dim = None
-
-    imported = 0
-    comments_inserted = 0
     embeddings_inserted = 0
-    rewatch_events = 0
-    not_found = 0
-    skipped = 0
 
     try:
         with conn:
@@ -217,95 +321,113 @@ def main():
                 # Ensure tables/ext exist
                 cur.execute(SQL_CREATE_VECTOR_EXT)
                 cur.execute(SQL_CREATE_USER_COMMENT)
-
-                for row in df.itertuples(index=False):
-                    sc_id = str(getattr(row, "sc_id")).strip()
-                    film_url = str(getattr(row, "film_url")).strip()
-                    annotation = str(getattr(row, "annotation")).strip()
-
-                    # Find film_id via film_external_id
-                    cur.execute(SQL_GET_FILM_ID, {"provider": args.provider, "external_key": sc_id})
-                    r = cur.fetchone()
-                    if not r:
-                        not_found += 1
-                        continue
-                    film_id = int(r["film_id"])
-
-                    rewatch_iso, comment_text = parse_annotation(annotation)
-
-                    # 1) Rewatch -> watch_event + user_film aggregate
-                    if rewatch_iso:
-                        if not args.dry_run:
-                            cur.execute(SQL_INSERT_WATCH_EVENT, {
-                                "user_id": user_id,
-                                "film_id": film_id,
-                                "watched_at": f"{rewatch_iso} 00:00:00",
-                                "context": "rewatch (senscritique)",
-                                "notes": "parsed from annotation"
-                            })
-                            cur.execute(SQL_UPSERT_USER_FILM_REWATCH, {
-                                "user_id": user_id,
-                                "film_id": film_id,
-                                "seen_at": rewatch_iso
-                            })
-                        rewatch_events += 1
-
-                    # 2) Comment -> user_comment + embedding
-                    if comment_text:
-                        if not args.dry_run:
-                            cur.execute(SQL_INSERT_COMMENT, {
-                                "user_id": user_id,
-                                "film_id": film_id,
-                                "source": args.provider,
-                                "comment_text": comment_text,
-                                "raw_annotation": annotation
-                            })
-                            comment_id = int(cur.fetchone()["comment_id"])
-                        else:
-                            comment_id = -1
-
-                        comments_inserted += 1
-
-                        # embedding
+                register_vector(conn)  # adaptateur numpy <-> vector (encodage compact)
+
+                # 1) COPY vers le staging : une seule passe réseau pour tout le CSV
+                cur.execute(SQL_CREATE_STAGE)
+                copy_stage_rows(cur, stage_rows)
+
+                cur.execute(SQL_COUNT_NOT_FOUND, {"provider": args.provider})
+                not_found = int(cur.fetchone()["n"])
+
+                # 2) Rewatch -> watch_event + user_film, en deux statements ensemblistes
+                cur.execute(SQL_INSERT_WATCH_EVENTS, {"provider": args.provider})
+                cur.execute(SQL_UPSERT_USER_FILM_REWATCH, {"provider": args.provider})
+
+                # 3) Commentaires : INSERT ... SELECT, les ids reviennent via RETURNING
+                cur.execute(SQL_INSERT_COMMENTS, {
+                    "provider": args.provider,
+                    "source": args.provider,
+                })
+                inserted_comments = cur.fetchall()
+                comments_inserted = len(inserted_comments)
+
+                # Pré-filtre : films déjà couverts par un embedding (re-runs idempotents)
+                cur.execute("SELECT to_regclass('comment_embedding') AS t;")
+                already_embedded = frozenset()
+                if cur.fetchone()["t"]:
+                    cur.execute(SQL_ALREADY_EMBEDDED,
+                                {"user_id": user_id, "source": args.provider})
+                    already_embedded = frozenset(int(r["film_id"]) for r in cur.fetchall())
+
+                # 4) Embeddings : seconde passe sur les comment_id retournés,
+                #    insérés par pages de EMBED_FLUSH_SIZE via execute_values
+                embedding_rows = []
+
+                def flush_embeddings():
+                    nonlocal embeddings_inserted
+                    if embedding_rows:
+                        execute_values(cur, SQL_INSERT_EMBEDDINGS, embedding_rows,
+                                       page_size=EMBED_FLUSH_SIZE)
+                        embeddings_inserted += len(embedding_rows)
+                        embedding_rows.clear()
+                        print(f"[INFO] progress emb={embeddings_inserted}/{comments_inserted}")
+
+                # Chargement sans index ANN : drop avant, rebuild après
+                cur.execute("DROP INDEX IF EXISTS idx_comment_embedding_ivfflat;")
+
+                embeddings_skipped = 0
+                pending_recs = []
+                for rec in inserted_comments:
+                    if int(rec["film_id"]) in already_embedded:
+                        embeddings_skipped += 1
+                    else:
+                        pending_recs.append(rec)
+
+                # Les appels Ollama partent d'un petit pool de threads et
+                # recouvrent les INSERT ; les écritures psycopg2 restent sur
+                # le fil principal (connexion non thread-safe)
+                with ThreadPoolExecutor(max_workers=4) as pool:
+                    futures = [
+                        pool.submit(ollama_embed, args.ollama_url,
+                                    args.embed_model, rec["comment_text"], 120)
+                        for rec in pending_recs
+                    ]
+                    for rec, fut in zip(pending_recs, futures):
+                        comment_id = int(rec["comment_id"])
                         try:
-                            emb = ollama_embed(args.ollama_url, args.embed_model, comment_text, timeout=120)
+                            emb = fut.result()
 
                             if embedding_dim is None:
                                 embedding_dim = len(emb)
                                 # Create embedding table with right dim (once)
-                                if not args.dry_run:
-                                    cur.execute(sql_create_comment_embedding(embedding_dim))
-                                created_embedding_table = True
-
-                            # Insert embedding as pgvector literal: '[0.1,0.2,...]'
-                            emb_str = "[" + ",".join(f"{float(x):.8f}" for x in emb) + "]"
-
-                            if not args.dry_run:
-                                cur.execute(SQL_INSERT_EMBEDDING, {
-                                    "comment_id": comment_id,
-                                    "model": args.embed_model,
-                                    "embedding": emb_str
-                                })
-                            embeddings_inserted += 1
-                        except Exception as e:
-                            print(f"[WARN] embedding failed sc_id={sc_id} film_id={film_id}: {e}")
-
-                    imported += 1
+                                cur.execute(sql_create_comment_embedding(embedding_dim))
 
-                    if imported % 50 == 0:
-                        print(f"[INFO] progress imported={imported} comments={comments_inserted} emb={embeddings_inserted} rewatch={rewatch_events} not_found={not_found}")
-
-                # Improve ivfflat stats
-                if not args.dry_run and created_embedding_table:
+                            embedding_rows.append(
+                                (comment_id, args.embed_model, np.asarray(emb, dtype=np.float32))
+                            )
+                        except Exception as e:
+                            print(f"[WARN] embedding failed comment_id={comment_id}: {e}")
+
+                        if len(embedding_rows) >= EMBED_FLUSH_SIZE:
+                            flush_embeddings()
+
+                flush_embeddings()
+
+                # Rebuild ivfflat une fois la table remplie, lists ~ sqrt(N)
+                cur.execute("SELECT to_regclass('comment_embedding') AS t;")
+                if cur.fetchone()["t"]:
+                    cur.execute("SELECT COUNT(*) AS n FROM comment_embedding;")
+                    n = int(cur.fetchone()["n"])
+                    if n:
+                        lists = max(100, int(n ** 0.5))
+                        cur.execute("SET maintenance_work_mem = '1GB';")
+                        cur.execute(
+                            "CREATE INDEX IF NOT EXISTS idx_comment_embedding_ivfflat "
+                            "ON comment_embedding USING ivfflat (embedding vector_cosine_ops) "
+                            f"WITH (lists = {lists});"
+                        )
                     cur.execute("ANALYZE comment_embedding;")
 
+        imported = len(stage_rows) - not_found
+
         print("[DONE]")
         print(f"imported_rows={imported}")
         print(f"rewatch_events={rewatch_events}")
         print(f"comments_inserted={comments_inserted}")
         print(f"embeddings_inserted={embeddings_inserted}")
+        print(f"embeddings_skipped={embeddings_skipped}")
         print(f"film_not_found={not_found}")
-        print(f"skipped={skipped}")
         if embedding_dim:
             print(f"embedding_dim={embedding_dim} model={args.embed_model}")
 
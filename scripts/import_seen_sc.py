@@ -1,7 +1,9 @@
 # scripts/import_seen_sc.py
 import os
 import re
+import csv
 import argparse
+import charset_normalizer
 import pandas as pd
 import psycopg2
 from psycopg2.extras import execute_values
@@ -17,64 +19,36 @@ DB = dict(
     password=os.getenv("POSTGRES_PASSWORD", "postgres"),
 )
 
+# Regex compilées une fois au chargement du module
+_RE_WS = re.compile(r"\s+")
+_RE_BRACKET = re.compile(r"\[[^\]]*\]")
+_RE_YEAR = re.compile(r"\b((?:18|19|20)\d{2})\b")
+
 def detect_sep_and_encoding(csv_path: str):
-    # detect delimiter from first bytes; handle BOM
+    # csv.Sniffer gère les champs quotés (vs comptage naïf de séparateurs)
+    # et charset_normalizer détecte l'encodage sur le même buffer de 64 Ko
     with open(csv_path, "rb") as f:
-        raw = f.read(4096)
-    sample = raw.decode("utf-8-sig", errors="replace")
-
-    # rough delimiter detection
-    counts = {
-        "\t": sample.count("\t"),
-        ";": sample.count(";"),
-        ",": sample.count(","),
-    }
-    sep = max(counts, key=counts.get) if max(counts.values()) > 0 else ","
-    return sep, "utf-8-sig"
+        raw = f.read(65536)
+
+    if raw.startswith(b"\xef\xbb\xbf"):
+        enc = "utf-8-sig"  # BOM : pandas doit le sauter
+    else:
+        best = charset_normalizer.from_bytes(raw).best()
+        enc = best.encoding if best else "utf-8"
+
+    sample = raw.decode(enc, errors="replace")
+    try:
+        sep = csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+    except csv.Error:
+        sep = ","
+    return sep, enc
 
 def norm_col(s: str) -> str:
     s = (s or "").strip().lower()
-    s = re.sub(r"\s+", "_", s)
+    s = _RE_WS.sub("_", s)
     s = s.replace("-", "_")
     return s
 
-def clean_title(title: str) -> str:
-    t = (title or "").strip()
-    # remove bracket blocks like [BR], [4K + DVD], etc.
-    t = re.sub(r"\[[^\]]*\]", "", t)
-    t = re.sub(r"\s+", " ", t).strip()
-    return t
-
-def parse_year(x):
-    if x is None or pd.isna(x):
-        return None
-    s = str(x).strip()
-    if not s:
-        return None
-    m = re.search(r"\b(18|19|20)\d{2}\b", s)
-    return int(m.group(0)) if m else None
-
-def parse_rating_10(x):
-    if x is None or pd.isna(x):
-        return None
-    s = str(x).strip().replace(",", ".")
-    if not s:
-        return None
-    try:
-        v = float(s)
-        return v
-    except Exception:
-        return None
-
-def parse_date(x):
-    if x is None or pd.isna(x):
-        return None
-    s = str(x).strip()
-    if not s:
-        return None
-    d = pd.to_datetime(s, dayfirst=True, errors="coerce")
-    return None if pd.isna(d) else d.date()
-
 def pick_col(df_cols_norm, *candidates):
     """Return actual df column name that matches any normalized candidate."""
     for cand in candidates:
@@ -100,11 +74,12 @@ def main():
     args = ap.parse_args()
 
     sep, enc = detect_sep_and_encoding(args.csv)
-    df = pd.read_csv(args.csv, sep=sep, encoding=enc, dtype=str, keep_default_na=False)
-    df.columns = [c.strip() for c in df.columns]
+    # En-tête seule pour le mapping de colonnes ; le corps est streamé par chunks
+    header = pd.read_csv(args.csv, sep=sep, encoding=enc, dtype=str, nrows=0)
+    header_cols = [c.strip() for c in header.columns]
 
     # map normalized -> actual
-    df_cols_norm = {norm_col(c): c for c in df.columns}
+    df_cols_norm = {norm_col(c): c for c in header_cols}
 
     # Guess SensCritique columns (robust to variations)
     title_col = pick_col(df_cols_norm, "title", "titre")
@@ -115,15 +90,47 @@ def main():
     notes_col = pick_col(df_cols_norm, "notes", "comment", "commentaire", "review", "critique")  # (sera None ici)
 
 
-    print(f"[import_seen_sc] Detected separator: {repr(sep)} | columns={list(df.columns)[:12]} ...")
+    print(f"[import_seen_sc] Detected separator: {repr(sep)} | columns={header_cols[:12]} ...")
     print("[import_seen_sc] Mapped columns:",
           {"title": title_col, "year": year_col, "rating": rating_col, "notes": notes_col, "seen_date": seen_date_col})
 
     if not title_col:
         raise SystemExit("Impossible de trouver une colonne titre. Renomme une colonne en 'title'/'titre' ou adapte le mapping.")
 
-    if args.limit:
-        df = df.head(args.limit)
+    def build_values(df):
+        # Conversions vectorisées colonne par colonne : mêmes sémantiques que les
+        # anciens helpers par cellule (parse_year, parse_date...), mais une passe
+        # C/pandas par colonne au lieu d'un iterrows qui boxe chaque ligne
+        def text_series(col):
+            if col:
+                return df[col].fillna("").str.strip()
+            return pd.Series([""] * len(df), index=df.index, dtype=str)
+
+        titles = text_series(title_col)
+        keep = titles != ""
+        k = int(keep.sum())
+        if not k:
+            return {}
+
+        years = pd.to_numeric(
+            text_series(year_col).str.extract(_RE_YEAR, expand=False),
+            errors="coerce")[keep]
+        ratings = pd.to_numeric(
+            text_series(rating_col).str.replace(",", ".", regex=False).replace("", None),
+            errors="coerce")[keep]
+        dates = pd.to_datetime(text_series(seen_date_col).replace("", None),
+                               dayfirst=True, errors="coerce", format="mixed")[keep]
+
+        return {
+            "raw_title": titles[keep].tolist(),
+            "raw_year": [None if pd.isna(v) else int(v) for v in years],
+            "raw_directors": text_series(director_col)[keep].tolist() if director_col else [None] * k,
+            "rating_10": [None if pd.isna(v) else float(v) for v in ratings],
+            "raw_notes": text_series(notes_col)[keep].tolist() if notes_col else [None] * k,  # sera vide pour ce CSV
+            "watched_date": [None if pd.isna(v) else v.date() for v in dates],
+            "match_status": ["PENDING"] * k,
+            "match_note": [None] * k,
+        }
 
     conn = psycopg2.connect(**DB)
     conn.autocommit = False
@@ -131,52 +138,44 @@ def main():
     with conn, conn.cursor() as cur:
         table = "import_seen_sc"
         table_cols = get_table_columns(cur, table)
-        table_colset = set(table_cols)
 
         if args.truncate:
             cur.execute(f"TRUNCATE TABLE {table};")
 
-        # Build row dicts with common staging fields
-        rows = []
-        for _, r in df.iterrows():
-            raw_title = (r.get(title_col) or "").strip()
-            if not raw_title:
+        # Lecture en streaming : le CSV complet n'est jamais chargé en mémoire,
+        # et les INSERT démarrent dès le premier chunk
+        reader = pd.read_csv(args.csv, sep=sep, encoding=enc, dtype=str,
+                             keep_default_na=False, chunksize=10_000)
+        total = 0
+        consumed = 0
+        insert_cols = None
+        for chunk in reader:
+            if args.limit:
+                if consumed >= args.limit:
+                    break
+                chunk = chunk.head(args.limit - consumed)
+            consumed += len(chunk)
+            chunk.columns = [c.strip() for c in chunk.columns]
+            col_values = build_values(chunk)
+            if not col_values:
                 continue
 
-            row = {
-                "raw_title": raw_title,
-                "raw_year": parse_year(r.get(year_col)) if year_col else None,
-                "raw_directors": (r.get(director_col) or "").strip() if director_col else None,
-                "rating_10": parse_rating_10(r.get(rating_col)) if rating_col else None,
-                "raw_notes": (r.get(notes_col) or "").strip() if notes_col else None,   # sera vide pour ce CSV
-                "watched_date": parse_date(r.get(seen_date_col)) if seen_date_col else None,
-                "match_status": "PENDING",
-                "match_note": None,
-            }
-
-            # Keep only columns that exist in your table
-            filtered = {k: v for k, v in row.items() if k in table_colset}
-            rows.append(filtered)
-
-        if not rows:
+            if insert_cols is None:
+                # Keep only columns that exist in your table (stable order by table definition)
+                insert_cols = [c for c in table_cols if c in col_values]
+
+            values = list(zip(*(col_values[c] for c in insert_cols)))
+            sql = f"INSERT INTO {table} ({', '.join(insert_cols)}) VALUES %s;"
+            execute_values(cur, sql, values, page_size=1000)
+            total += len(values)
+
+        if not total:
             conn.rollback()
             print("Aucune ligne importable (titre vide ?).")
             return
 
-        # Determine insert columns = union of keys (stable order by table definition)
-        insert_cols = [c for c in table_cols if c in rows[0].keys() or any(c in rr for rr in rows)]
-        # Ensure we don't insert columns that are entirely missing
-        insert_cols = [c for c in insert_cols if any(c in rr for rr in rows)]
-
-        values = []
-        for rr in rows:
-            values.append(tuple(rr.get(c) for c in insert_cols))
-
-        sql = f"INSERT INTO {table} ({', '.join(insert_cols)}) VALUES %s;"
-        execute_values(cur, sql, values, page_size=1000)
         conn.commit()
-
-        print(f"OK - import_seen_sc rempli: {len(values)} lignes")
+        print(f"OK - import_seen_sc rempli: {total} lignes")
 
     conn.close()
 
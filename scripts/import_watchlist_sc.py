@@ -1,5 +1,6 @@
 import os
 import re
+import csv
 import argparse
 import pandas as pd
 import psycopg2
@@ -16,16 +17,23 @@ DB = dict(
     password=os.getenv("POSTGRES_PASSWORD", "postgres"),
 )
 
+# Regex compilées une fois au chargement du module (appelées par ligne de CSV)
+_RE_NORM = re.compile(r"[^a-z0-9]+")
+_RE_BRACKET = re.compile(r"\[[^\]]*\]")
+_RE_WS = re.compile(r"\s+")
+
 def sniff_sep(path: str) -> str:
+    # csv.Sniffer gère les champs quotés et couvre aussi tab/pipe
     with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        head = f.read(4096)
-    if head.count(";") > head.count(","):
-        return ";"
-    return ","
+        head = f.read(65536)
+    try:
+        return csv.Sniffer().sniff(head, delimiters=",;\t|").delimiter
+    except csv.Error:
+        return ","
 
 def norm_col(s: str) -> str:
     s = (s or "").strip().lower()
-    s = re.sub(r"[^a-z0-9]+", "", s)
+    s = _RE_NORM.sub("", s)
     return s
 
 def pick_col(cols_norm_map: dict, *cands):
@@ -35,21 +43,6 @@ def pick_col(cols_norm_map: dict, *cands):
             return cols_norm_map[k]
     return None
 
-def parse_int(x):
-    if pd.isna(x) or x is None:
-        return None
-    try:
-        return int(str(x).strip())
-    except Exception:
-        return None
-
-def clean_title(t: str) -> str:
-    t = (t or "").strip()
-    # enlève crochets (formats etc.) si jamais
-    t = re.sub(r"\[[^\]]*\]", "", t)
-    t = re.sub(r"\s+", " ", t).strip()
-    return t
-
 def get_table_columns(cur, table_name: str):
     cur.execute("""
         SELECT column_name
@@ -66,11 +59,12 @@ def main():
     args = ap.parse_args()
 
     sep = sniff_sep(args.csv)
-    df = pd.read_csv(args.csv, sep=sep, dtype=str).fillna(pd.NA)
+    # En-tête seule pour le mapping de colonnes ; le corps est streamé par chunks
+    header = pd.read_csv(args.csv, sep=sep, dtype=str, nrows=0)
 
-    print(f"[import_watchlist_sc] Detected separator: {sep!r} | columns={list(df.columns)[:12]} ...")
+    print(f"[import_watchlist_sc] Detected separator: {sep!r} | columns={list(header.columns)[:12]} ...")
 
-    cols_norm_map = {norm_col(c): c for c in df.columns}
+    cols_norm_map = {norm_col(c): c for c in header.columns}
 
     title_col = pick_col(cols_norm_map, "Title", "Titre", "raw_title")
     year_col = pick_col(cols_norm_map, "Year", "Annee", "Année", "raw_year")
@@ -107,40 +101,53 @@ def main():
             cur.execute(f"TRUNCATE TABLE {table} RESTART IDENTITY;")
             conn.commit()
 
-        rows = []
-        for _, r in df.iterrows():
-            raw_title = clean_title(r.get(title_col))
-            if not raw_title:
-                continue
-            raw_year = parse_int(r.get(year_col)) if year_col else None
-            raw_directors = (r.get(director_col) or "").strip() if director_col else None
-            raw_notes = (r.get(notes_col) or "").strip() if notes_col else None
-
-            values = []
-            for c in insert_cols:
-                if c == col_raw_title:
-                    values.append(raw_title)
-                elif c == col_raw_year:
-                    values.append(raw_year)
-                elif c == col_raw_directors:
-                    values.append(raw_directors if raw_directors else None)
-                elif c == col_raw_notes:
-                    values.append(raw_notes if raw_notes else None)
-                elif c == col_tmdb_id:
-                    values.append(None)
-                elif c == col_match_status:
-                    values.append("PENDING")
-                elif c == col_match_note:
-                    values.append(None)
-                else:
-                    values.append(None)
-            rows.append(tuple(values))
-
+        def build_rows(df):
+            # Conversions vectorisées : nettoyage des titres et parsing des années
+            # en kernels pandas plutôt qu'en helpers Python appelés par ligne
+            titles = (df[title_col].fillna("")
+                      .str.replace(_RE_BRACKET, "", regex=True)
+                      .str.replace(_RE_WS, " ", regex=True)
+                      .str.strip())
+            keep = titles != ""
+            k = int(keep.sum())
+
+            def text_list(col):
+                if not col:
+                    return [None] * k
+                return [v or None for v in df[col].fillna("").str.strip()[keep]]
+
+            if year_col:
+                years = pd.to_numeric(df[year_col].fillna("").str.strip().replace("", None),
+                                      errors="coerce")[keep]
+                year_list = [None if pd.isna(v) else int(v) for v in years]
+            else:
+                year_list = [None] * k
+
+            value_map = {
+                col_raw_title: titles[keep].tolist(),
+                col_raw_year: year_list,
+                col_raw_directors: text_list(director_col),
+                col_raw_notes: text_list(notes_col),
+                col_tmdb_id: [None] * k,
+                col_match_status: ["PENDING"] * k,
+                col_match_note: [None] * k,
+            }
+            value_map.pop(None, None)  # colonnes absentes de la table
+
+            return list(zip(*(value_map[c] for c in insert_cols)))
+
+        # Lecture en streaming : le CSV complet n'est jamais chargé en mémoire,
+        # et les INSERT démarrent dès le premier chunk
         sql = f"INSERT INTO {table} ({', '.join(insert_cols)}) VALUES %s"
-        execute_values(cur, sql, rows, page_size=1000)
+        total = 0
+        for chunk in pd.read_csv(args.csv, sep=sep, dtype=str, chunksize=10_000):
+            rows = build_rows(chunk)
+            if rows:
+                execute_values(cur, sql, rows, page_size=1000)
+                total += len(rows)
         conn.commit()
 
-        print(f"OK - import_watchlist_sc rempli: {len(rows)} lignes")
+        print(f"OK - import_watchlist_sc rempli: {total} lignes")
 
     conn.close()
 
@@ -1,8 +1,12 @@
 import os
+import asyncio
+import aiohttp
+import numpy as np
 import psycopg2
 import requests
 import json
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from pgvector.psycopg2 import register_vector
 
 # --- CONFIGURATION ---
 PG_HOST = os.getenv("POSTGRES_HOST", "localhost")
@@ -13,6 +17,10 @@ PG_PORT = os.getenv("POSTGRES_PORT", "5432")
 
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
 EMBED_MODEL = "nomic-embed-text"
+BATCH_SIZE = 64
+COMMIT_EVERY = 200
+# Nombre de lots en vol : aligner sur OLLAMA_NUM_PARALLEL côté serveur Ollama
+EMBED_CONCURRENCY = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
 
 def get_conn():
     return psycopg2.connect(
@@ -20,7 +28,7 @@ def get_conn():
     )
 
 def ollama_embed(text):
-    """Génère l'embedding d'un texte via Ollama."""
+    """Génère l'embedding d'un texte via Ollama (fallback synchrone)."""
     try:
         r = requests.post(
             f"{OLLAMA_URL}/api/embeddings",
@@ -33,28 +41,113 @@ def ollama_embed(text):
         print(f"Erreur Ollama : {e}")
         return None
 
-def to_pgvector_literal(vec):
-    """Convertit une liste de float en format literal PGVector."""
-    return "[" + ",".join(f"{float(x):.8f}" for x in vec) + "]"
+async def ollama_embed_batch(session, texts):
+    """Génère les embeddings d'un lot de textes en une seule requête HTTP."""
+    try:
+        async with session.post(
+            f"{OLLAMA_URL}/api/embed",
+            json={"model": EMBED_MODEL, "input": texts}
+        ) as r:
+            r.raise_for_status()
+            data = await r.json()
+        embeddings = data.get("embeddings")
+        if embeddings is not None:
+            return embeddings
+    except Exception as e:
+        print(f"Erreur Ollama (batch) : {e}")
+    # Fallback : ancien endpoint /api/embeddings, un appel par texte
+    return [ollama_embed(t) for t in texts]
+
+async def embed_producer(films_to_process, queue):
+    """Lance les lots en parallèle (bornés par un sémaphore) vers Ollama."""
+    sem = asyncio.Semaphore(EMBED_CONCURRENCY)
+    batches = [films_to_process[i:i + BATCH_SIZE]
+               for i in range(0, len(films_to_process), BATCH_SIZE)]
+
+    # Une seule ClientSession pour toute l'exécution : connexions TCP réutilisées
+    timeout = aiohttp.ClientTimeout(total=300)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async def run_batch(batch):
+            async with sem:
+                # Nettoyage rapide du texte (limite Ollama)
+                texts = [f['overview'].replace("\x00", "").strip() for f in batch]
+                embeddings = await ollama_embed_batch(session, texts)
+                for film, emb in zip(batch, embeddings):
+                    await queue.put((film['film_id'], emb))
+
+        await asyncio.gather(*(run_batch(b) for b in batches))
+    await queue.put(None)  # signal de fin pour le writer
+
+async def db_writer(conn, queue, total):
+    """Consommateur unique : toutes les écritures psycopg2 restent sur un seul fil.
+
+    Un commit (= un fsync WAL) tous les COMMIT_EVERY films au lieu d'un par
+    ligne ; le job est re-runnable, donc synchronous_commit peut être coupé.
+    """
+    count = 0
+    pending = []
+
+    def flush():
+        nonlocal count
+        if pending:
+            with conn.cursor() as cur:
+                execute_values(
+                    cur,
+                    "INSERT INTO film_embedding (film_id, embedding) VALUES %s",
+                    pending
+                )
+            conn.commit()
+            count += len(pending)
+            pending.clear()
+            print(f"🔄 Progress: {count}/{total} films indexés...")
+
+    with conn.cursor() as cur:
+        cur.execute("SET synchronous_commit = off;")
+
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+        film_id, embedding = item
+        if embedding:
+            # L'adaptateur pgvector encode le ndarray directement, sans passer
+            # par un literal texte de ~7 Ko reparsé côté serveur
+            pending.append((film_id, np.asarray(embedding, dtype=np.float32)))
+            if len(pending) >= COMMIT_EVERY:
+                flush()
+        else:
+            print(f"⚠️ Échec pour le film {film_id}")
+
+    flush()
+    return count
+
+async def run(conn, films_to_process):
+    queue = asyncio.Queue(maxsize=EMBED_CONCURRENCY * BATCH_SIZE)
+    _, count = await asyncio.gather(
+        embed_producer(films_to_process, queue),
+        db_writer(conn, queue, len(films_to_process)),
+    )
+    return count
 
 def main():
     print(f"🚀 Démarrage de l'indexation avec {EMBED_MODEL}...")
     conn = get_conn()
-    
+    register_vector(conn)  # adaptateur numpy <-> vector
+
     # 1. Identifier les films sans embedding
     query_todo = """
-        SELECT f.film_id, f.overview 
-        FROM film f 
-        LEFT JOIN film_embedding fe ON f.film_id = fe.film_id 
-        WHERE f.overview IS NOT NULL 
-          AND f.overview <> '' 
+        SELECT f.film_id, f.overview
+        FROM film f
+        LEFT JOIN film_embedding fe ON f.film_id = fe.film_id
+        WHERE f.overview IS NOT NULL
+          AND f.overview <> ''
           AND fe.film_id IS NULL;
     """
-    
+
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute(query_todo)
         films_to_process = cur.fetchall()
-    
+
     total = len(films_to_process)
     print(f"📈 {total} films à traiter.")
 
@@ -62,33 +155,11 @@ def main():
         print("✅ Tout est déjà à jour.")
         return
 
-    # 2. Boucle de traitement
-    count = 0
-    for film in films_to_process:
-        film_id = film['film_id']
-        overview = film['overview']
-        
-        # Nettoyage rapide du texte (limite Ollama)
-        clean_text = overview.replace("\x00", "").strip()
-        
-        embedding = ollama_embed(clean_text)
-        
-        if embedding:
-            vec_lit = to_pgvector_literal(embedding)
-            with conn.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO film_embedding (film_id, embedding) VALUES (%s, %s::vector)",
-                    (film_id, vec_lit)
-                )
-            conn.commit()
-            count += 1
-            if count % 10 == 0:
-                print(f"🔄 Progress: {count}/{total} films indexés...")
-        else:
-            print(f"⚠️ Échec pour le film {film_id}")
+    # 2. Pipeline asynchrone : lots d'embeddings en parallèle, écritures sérialisées
+    count = asyncio.run(run(conn, films_to_process))
 
     conn.close()
     print(f"✨ Terminé ! {count} embeddings ajoutés à la table film_embedding.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,8 +1,10 @@
 import os
 import argparse
-import requests
-import psycopg2
-from psycopg2.extras import DictCursor
+import requests_cache
+import db
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter, Retry
+from psycopg2.extras import DictCursor, execute_values
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,22 +12,27 @@ load_dotenv()
 TMDB_KEY = os.environ["TMDB_API_KEY"]
 TMDB_BASE = "https://api.themoviedb.org/3"
 
-DB = dict(
-    host=os.getenv("POSTGRES_HOST", "localhost"),
-    port=int(os.getenv("POSTGRES_PORT", "5432")),
-    dbname=os.getenv("POSTGRES_DB", "videotheque"),
-    user=os.getenv("POSTGRES_USER", "postgres"),
-    password=os.getenv("POSTGRES_PASSWORD", "postgres"),
+# Session partagée avec cache disque : les fiches /movie déjà vues ne
+# repartent pas sur le réseau pendant 24h (et on évite le rate limit 429)
+SESSION = requests_cache.CachedSession(
+    cache_name=".tmdb_cache", backend="sqlite",
+    expire_after=86400, allowable_methods=("GET",),
 )
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16, pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504]),
+))
 
 def tmdb_get(path, params=None):
     params = params or {}
     params["api_key"] = TMDB_KEY
-    r = requests.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
+    r = SESSION.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
     r.raise_for_status()
     return r.json()
 
 def directors(tmdb_id: int):
+    # fallback si la réponse fusionnée ne contient pas les credits
     c = tmdb_get(f"/movie/{tmdb_id}/credits", {"language": "en-US"})
     return [x["name"] for x in c.get("crew", []) if x.get("job") == "Director"]
 
@@ -39,7 +46,7 @@ def main():
 
     film_ids = [int(x) for x in args.ids]
 
-    conn = psycopg2.connect(**DB)
+    conn = db.get_pool().getconn()
     conn.autocommit = False
 
     with conn, conn.cursor(cursor_factory=DictCursor) as cur:
@@ -59,13 +66,28 @@ def main():
         print("="*80)
 
         # 2) preview TMDb + confirmation
+        # Préchargement parallèle des fiches avant les prompts interactifs :
+        # l'utilisateur ne paie plus la latence réseau entre deux questions
+        def fetch_preview(tmdb_id):
+            # fiche + credits fusionnés en un seul appel TMDb
+            d = tmdb_get(f"/movie/{tmdb_id}",
+                         {"language": "fr-FR", "append_to_response": "credits"})
+            crew = (d.get("credits") or {}).get("crew")
+            if crew is None:
+                dirs = directors(tmdb_id)
+            else:
+                dirs = [c["name"] for c in crew if c.get("job") == "Director"]
+            return tmdb_id, d, dirs
+
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            previews = {tid: (d, dirs) for tid, d, dirs in ex.map(fetch_preview, film_ids)}
+
         to_insert = []
         for tmdb_id in film_ids:
-            d = tmdb_get(f"/movie/{tmdb_id}", {"language": "fr-FR"})
+            d, dirs = previews[tmdb_id]
             title = d.get("title") or ""
             release_date = d.get("release_date") or ""
             year = release_date[:4] if release_date else ""
-            dirs = directors(tmdb_id)
             print(f"- TMDb {tmdb_id}: {title} ({year}) | Dir: {', '.join(dirs) if dirs else '(?)'}")
 
             ans = input("  -> importer ce film dans staging BR ? [y/N] ").strip().lower()
@@ -84,65 +106,11 @@ def main():
             conn.rollback()
             return
 
-        # 3) insérer une ligne import_br par film confirmé (copie des infos physiques du coffret)
-        for (tmdb_id, title, overview) in to_insert:
-            cur.execute("""
-                INSERT INTO import_br (
-                  item_type,
-                  raw_title,
-                  raw_creators,
-                  description,
-                  publish_date,
-                  tags,
-                  notes,
-                  price,
-                  length_min,
-                  number_of_discs,
-                  ensemble,
-                  aspect_ratio,
-                  rating,
-                  review,
-                  review_date,
-                  status,
-                  began,
-                  completed,
-                  added,
-                  copies,
-                  raw_title_clean,
-                  is_physical,
-                  formats,
-                  tmdb_id,
-                  match_status,
-                  match_note
-                ) VALUES (
-                  'movie',
-                  %s,
-                  NULL,
-                  %s,
-                  %s,
-                  %s,
-                  %s,
-                  %s,
-                  NULL,
-                  %s,
-                  NULL,
-                  %s,
-                  %s,
-                  %s,
-                  %s,
-                  %s,
-                  %s,
-                  %s,
-                  %s,
-                  %s,
-                  %s,
-                  TRUE,
-                  %s,
-                  %s,
-                  'MATCHED',
-                  %s
-                );
-            """, (
+        # 3) insérer une ligne import_br par film confirmé (copie des infos
+        #    physiques du coffret), en un seul execute_values au lieu d'un
+        #    aller-retour INSERT par film
+        rows = [
+            (
                 title,                               # raw_title
                 overview,                            # description (TMDb)
                 box["publish_date"],
@@ -163,7 +131,21 @@ def main():
                 box["formats"],
                 tmdb_id,
                 f"manual_boxset_replace:{box['raw_title_clean']}"
-            ))
+            )
+            for (tmdb_id, title, overview) in to_insert
+        ]
+        execute_values(cur, """
+            INSERT INTO import_br (
+              item_type, raw_title, raw_creators, description, publish_date,
+              tags, notes, price, length_min, number_of_discs, ensemble,
+              aspect_ratio, rating, review, review_date, status, began,
+              completed, added, copies, raw_title_clean, is_physical, formats,
+              tmdb_id, match_status, match_note
+            ) VALUES %s;
+        """, rows, template="""
+            ('movie', %s, NULL, %s, %s, %s, %s, %s, NULL, %s, NULL, %s, %s, %s,
+             %s, %s, %s, %s, %s, %s, %s, TRUE, %s, %s, 'MATCHED', %s)
+        """, page_size=100)
 
         # 4) supprimer ou archiver la ligne coffret
         if args.delete_boxset:
@@ -179,7 +161,7 @@ def main():
         conn.commit()
         print("OK: films ajoutés au staging et coffret traité.")
 
-    conn.close()
+    db.get_pool().putconn(conn)
 
 if __name__ == "__main__":
     main()
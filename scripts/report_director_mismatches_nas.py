@@ -1,5 +1,4 @@
 import os
-import re
 import csv
 import argparse
 import psycopg2
@@ -16,15 +15,6 @@ DB = dict(
     password=os.getenv("POSTGRES_PASSWORD", "postgres"),
 )
 
-def norm_name(s: str) -> str:
-    """Normalize names for comparison (casefold + remove punctuation/extra spaces)."""
-    if s is None:
-        return ""
-    s = s.strip().casefold()
-    # keep letters/numbers/space/'- to be permissive with accents
-    s = re.sub(r"[^\w\s'-]", " ", s, flags=re.UNICODE)
-    s = re.sub(r"\s+", " ", s, flags=re.UNICODE).strip()
-    return s
 
 def main():
     ap = argparse.ArgumentParser()
@@ -39,7 +29,9 @@ def main():
     # 1) Pull NAS-linked films and their raw_director (staging) via path join
     # We use DISTINCT ON (path) to avoid duplicates if staging accidentally has duplicates.
     # If you want the newest staging row per path, ORDER BY created_at DESC.
-    sql = """
+    # La normalisation (casefold + ponctuation + espaces) et la comparaison se
+    # font côté Postgres : seuls les mismatches traversent le réseau.
+    sql = r"""
     WITH nas_map AS (
       SELECT DISTINCT ON (i.raw_file_path)
         i.raw_file_path AS path,
@@ -54,7 +46,9 @@ def main():
     directors AS (
       SELECT
         fc.film_id,
-        array_agg(DISTINCT p.name) AS directors_db
+        array_agg(DISTINCT p.name) AS directors_db,
+        array_agg(DISTINCT trim(regexp_replace(regexp_replace(lower(p.name),
+          '[^[:alnum:][:space:]''-]', ' ', 'g'), '\s+', ' ', 'g'))) AS directors_norm
       FROM film_credit fc
       JOIN person p ON p.person_id = fc.person_id
       WHERE fc.job = 'Director'
@@ -67,81 +61,62 @@ def main():
       f.year,
       na.path,
       nm.import_nas_id,
-      nm.raw_director,
-      d.directors_db
+      trim(nm.raw_director) AS raw_director,
+      d.directors_db,
+      CASE WHEN d.directors_db IS NULL THEN 'NO_DIRECTOR_IN_DB'
+           ELSE 'DIRECTOR_MISMATCH' END AS reason
     FROM nas_asset na
     JOIN film f ON f.film_id = na.film_id
     LEFT JOIN nas_map nm ON nm.path = na.path
     LEFT JOIN directors d ON d.film_id = f.film_id
+    WHERE COALESCE(trim(nm.raw_director), '') <> ''
+      AND (d.directors_db IS NULL
+           OR trim(regexp_replace(regexp_replace(lower(nm.raw_director),
+                 '[^[:alnum:][:space:]''-]', ' ', 'g'), '\s+', ' ', 'g'))
+               <> ALL(d.directors_norm))
     ORDER BY f.film_id;
     """
 
-    mismatches = []
-    with conn, conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute(sql)
-        rows = cur.fetchall()
-
-        for r in rows:
-            raw_dir = (r["raw_director"] or "").strip()
-            dirs_db = r["directors_db"] or []
-
-            # If no raw director, skip (cannot compare)
-            if not raw_dir:
-                continue
-
-            raw_n = norm_name(raw_dir)
-            db_norms = [norm_name(x) for x in dirs_db if x]
-
-            # If DB has no director imported yet, count as mismatch (optional)
-            # Here: we flag it as mismatch because it indicates missing credits.
-            if not db_norms:
-                mismatches.append({
-                    "film_id": r["film_id"],
-                    "tmdb_id": r["tmdb_id"],
-                    "title": r["title"],
-                    "year": r["year"],
-                    "path": r["path"],
-                    "import_nas_id": r["import_nas_id"],
-                    "raw_director": raw_dir,
-                    "directors_db": "",
-                    "reason": "NO_DIRECTOR_IN_DB"
-                })
-                continue
-
-            # Match if raw director is contained in any DB director (or exact match)
-            # (helps when raw has "Nom Prénom" and DB has same; we keep it strict-ish)
-            match = any(raw_n == dn for dn in db_norms)
-
-            if not match:
-                mismatches.append({
-                    "film_id": r["film_id"],
-                    "tmdb_id": r["tmdb_id"],
-                    "title": r["title"],
-                    "year": r["year"],
-                    "path": r["path"],
-                    "import_nas_id": r["import_nas_id"],
-                    "raw_director": raw_dir,
-                    "directors_db": " | ".join(dirs_db),
-                    "reason": "DIRECTOR_MISMATCH"
-                })
+    # Curseur serveur + écriture CSV au fil de l'eau : on ne matérialise
+    # jamais la liste complète des mismatches en mémoire Python.
+    fieldnames = ["film_id", "tmdb_id", "title", "year", "path", "import_nas_id", "raw_director", "directors_db", "reason"]
+    total = 0
+    preview = []
+    preview_max = args.limit if args.limit > 0 else 20
+    # csv.writer sur tuples (pas de hachage dict par ligne) + gros buffer
+    # d'écriture : le coût Python par ligne se réduit au strict minimum.
+    with open(args.out, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
+        w = csv.writer(f)
+        w.writerow(fieldnames)
+        with conn, conn.cursor(name="mm_cur", cursor_factory=DictCursor) as cur:
+            cur.itersize = 2000
+            cur.arraysize = 2000
+            cur.execute(sql)
+            for r in cur:
+                directors_db = " | ".join(r["directors_db"] or [])
+                w.writerow((r["film_id"], r["tmdb_id"], r["title"], r["year"],
+                            r["path"], r["import_nas_id"], r["raw_director"],
+                            directors_db, r["reason"]))
+                total += 1
+                if len(preview) < preview_max:
+                    preview.append({
+                        "film_id": r["film_id"],
+                        "tmdb_id": r["tmdb_id"],
+                        "title": r["title"],
+                        "year": r["year"],
+                        "path": r["path"],
+                        "raw_director": r["raw_director"],
+                        "directors_db": directors_db,
+                        "reason": r["reason"],
+                    })
 
     conn.close()
 
-    # Write CSV
-    fieldnames = ["film_id", "tmdb_id", "title", "year", "path", "import_nas_id", "raw_director", "directors_db", "reason"]
-    with open(args.out, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames)
-        w.writeheader()
-        for m in mismatches:
-            w.writerow(m)
-
     # Print summary + a preview
-    print(f"Found {len(mismatches)} mismatches. CSV written to: {args.out}")
-    if mismatches:
+    print(f"Found {total} mismatches. CSV written to: {args.out}")
+    if preview:
         print("\nPreview:")
-        n = len(mismatches) if args.limit == 0 else min(args.limit, len(mismatches))
-        for i in range(n):
-            m = mismatches[i]
+        for m in preview:
             print(f"- film_id={m['film_id']} tmdb_id={m['tmdb_id']} | {m['title']} ({m['year']})")
             print(f"  raw_director: {m['raw_director']}")
             print(f"  directors_db: {m['directors_db']}")
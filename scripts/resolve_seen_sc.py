@@ -1,6 +1,9 @@
-import os, re, time, argparse, requests
-import psycopg2
+import os, re, time, argparse, requests_cache
+import db
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from psycopg2.extras import DictCursor
+from requests.adapters import HTTPAdapter, Retry
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -8,19 +11,23 @@ load_dotenv()
 TMDB_KEY = os.environ["TMDB_API_KEY"]
 TMDB_BASE = "https://api.themoviedb.org/3"
 
-DB = dict(
-    host=os.getenv("POSTGRES_HOST", "localhost"),
-    port=int(os.getenv("POSTGRES_PORT", "5432")),
-    dbname=os.getenv("POSTGRES_DB", "videotheque"),
-    user=os.getenv("POSTGRES_USER", "postgres"),
-    password=os.getenv("POSTGRES_PASSWORD", "postgres"),
+# Session partagée avec cache disque : les credits/recherches déjà vus ne
+# repartent pas sur le réseau pendant 24h (le 429 reste géré dans tmdb_get)
+SESSION = requests_cache.CachedSession(
+    cache_name=".tmdb_cache", backend="sqlite",
+    expire_after=86400, allowable_methods=("GET",),
 )
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16, pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5,
+                      status_forcelist=[500, 502, 503, 504]),
+))
 
 def tmdb_get(path, params=None, retry=3):
     params = params or {}
     params["api_key"] = TMDB_KEY
     for i in range(retry):
-        r = requests.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
+        r = SESSION.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
         if r.status_code == 429:
             time.sleep(1.5 + i)
             continue
@@ -28,23 +35,35 @@ def tmdb_get(path, params=None, retry=3):
         return r.json()
     raise RuntimeError("TMDb rate limit")
 
+# Motifs compilés une fois : évite le lookup du cache re à chaque appel
+_BRACKETS = re.compile(r"\[[^\]]*\]")
+_NONALNUM = re.compile(r"[^a-z0-9 ]+")
+_SPACES = re.compile(r"\s+")
+_SPLIT = re.compile(r"[:–\-]")
+_WORDS = re.compile(r"[a-z0-9]+")
+
+@lru_cache(maxsize=1024)
 def norm(s: str) -> str:
     s = (s or "").lower()
-    s = re.sub(r"\[[^\]]*\]", "", s)
-    s = re.sub(r"[^a-z0-9 ]+", " ", s)
-    return re.sub(r"\s+", " ", s).strip()
+    s = _BRACKETS.sub("", s)
+    s = _NONALNUM.sub(" ", s)
+    return _SPACES.sub(" ", s).strip()
 
+# Mémoïsation : le même candidat TMDb revient souvent d'un item brut à
+# l'autre, inutile de re-payer l'appel /credits (même en cache disque).
+@lru_cache(maxsize=4096)
 def get_directors(tmdb_id: int):
     credits = tmdb_get(f"/movie/{tmdb_id}/credits")
     return [norm(c.get("name","")) for c in credits.get("crew", []) if c.get("job") == "Director"]
 
+@lru_cache(maxsize=1024)
 def simplify_title(title: str) -> str:
     # agressif mais efficace pour NOT_FOUND
     stop = {"le","la","les","un","une","the","a","an","of"}
     t = title.lower()
-    t = re.sub(r"\[[^\]]*\]", "", t)
-    t = re.split(r"[:–\-]", t)[0]
-    words = [w for w in re.findall(r"[a-z0-9]+", t) if w not in stop]
+    t = _BRACKETS.sub("", t)
+    t = _SPLIT.split(t)[0]
+    words = [w for w in _WORDS.findall(t) if w not in stop]
     return " ".join(words[:5]).strip()
 
 def search_candidates(raw_title: str):
@@ -66,7 +85,7 @@ def main():
 
     wanted = tuple(s.strip().upper() for s in args.statuses.split(",") if s.strip())
 
-    conn = psycopg2.connect(**DB)
+    conn = db.get_pool().getconn()
     conn.autocommit = False
 
     with conn, conn.cursor(cursor_factory=DictCursor) as cur:
@@ -79,8 +98,31 @@ def main():
         """, (list(wanted), args.limit))
         rows = cur.fetchall()
 
+        # Statement préparé côté serveur : parse/plan une seule fois au lieu
+        # d'une analyse complète de l'UPDATE à chaque choix utilisateur.
+        cur.execute("""
+            PREPARE upd_seen(int, int) AS
+            UPDATE import_seen_sc
+            SET tmdb_id = $1,
+                match_status = 'MATCHED',
+                match_note = COALESCE(match_note,'') || ' | manual_fix'
+            WHERE import_seen_id = $2;
+        """)
+
         print(f"[resolve] items: {len(rows)} statuses={wanted}")
 
+        # Commits groupés : un fsync toutes les COMMIT_EVERY décisions au lieu
+        # d'un par choix ; le `with conn:` commet le reliquat en sortie.
+        COMMIT_EVERY = 10
+        uncommitted = 0
+
+        def maybe_commit():
+            nonlocal uncommitted
+            uncommitted += 1
+            if uncommitted >= COMMIT_EVERY:
+                conn.commit()
+                uncommitted = 0
+
         for r in rows:
             iid = r["import_seen_id"]
             title = r["raw_title"]
@@ -96,16 +138,24 @@ def main():
             if not cands:
                 print("No candidates found. Enter 's' to skip or a TMDb id if you already know it.")
             else:
+                # Préchargement concurrent des /credits : la latence d'affichage
+                # des candidats passe de 8 allers-retours séquentiels à un seul.
+                def safe_directors(tmdb_id):
+                    try:
+                        return get_directors(tmdb_id)
+                    except Exception:
+                        return []
+                with ThreadPoolExecutor(max_workers=8) as ex:
+                    dirs_map = dict(zip(
+                        (c["id"] for c in cands),
+                        ex.map(safe_directors, (c["id"] for c in cands)),
+                    ))
                 for idx, c in enumerate(cands, start=1):
                     tmdb_id = c["id"]
                     rel = c.get("release_date") or ""
                     t = c.get("title") or ""
                     ot = c.get("original_title") or ""
-                    dirs = []
-                    try:
-                        dirs = get_directors(tmdb_id)
-                    except Exception:
-                        pass
+                    dirs = dirs_map.get(tmdb_id, [])
                     dmatch = "DIRECTOR_MATCH" if any(director_q in d or d in director_q for d in dirs) else ""
                     print(f"{idx:>2}. id={tmdb_id} | {t} / {ot} | {rel} {dmatch}")
 
@@ -120,7 +170,7 @@ def main():
                         match_note=COALESCE(match_note,'') || ' | manual_not_found'
                     WHERE import_seen_id=%s;
                 """, (iid,))
-                conn.commit()
+                maybe_commit()
                 continue
 
             chosen_id = None
@@ -143,17 +193,11 @@ def main():
                 print("No id chosen.")
                 continue
 
-            cur.execute("""
-                UPDATE import_seen_sc
-                SET tmdb_id=%s,
-                    match_status='MATCHED',
-                    match_note=COALESCE(match_note,'') || ' | manual_fix'
-                WHERE import_seen_id=%s;
-            """, (chosen_id, iid))
-            conn.commit()
+            cur.execute("EXECUTE upd_seen(%s, %s);", (chosen_id, iid))
+            maybe_commit()
             time.sleep(args.sleep)
 
-    conn.close()
+    db.get_pool().putconn(conn)
     print("\nDone.")
 
 if __name__ == "__main__":
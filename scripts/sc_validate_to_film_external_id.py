@@ -4,16 +4,10 @@ import re
 import argparse
 import pandas as pd
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 
 RE_SC_ID = re.compile(r"/(\d+)(?:\?|$)")
 
-def extract_sc_id(url: str):
-    if not url or not isinstance(url, str):
-        return None
-    m = RE_SC_ID.search(url.strip())
-    return m.group(1) if m else None
-
 def get_conn(host: str, port: int, db: str, user: str, pwd: str):
     return psycopg2.connect(
         host=host, port=port, dbname=db, user=user, password=pwd,
@@ -24,30 +18,32 @@ def has_pg_trgm(cur) -> bool:
     cur.execute("SELECT 1 FROM pg_extension WHERE extname='pg_trgm'")
     return cur.fetchone() is not None
 
-SQL_IS_ALREADY_MAPPED = """
-SELECT 1
+SQL_ALREADY_MAPPED_BULK = """
+SELECT external_key
 FROM film_external_id
-WHERE provider = %(provider)s AND external_key = %(external_key)s
-LIMIT 1;
+WHERE provider = %(provider)s AND external_key = ANY(%(keys)s);
 """
 
-SQL_SUGGEST_TRGM = """
-SELECT film_id, title, year, similarity(title, %(title)s) AS sim
-FROM film
-WHERE (%(year)s IS NULL OR year BETWEEN %(year)s - 1 AND %(year)s + 1)
-ORDER BY similarity(title, %(title)s) DESC
-LIMIT 5;
+SQL_SUGGEST_TRGM_BATCH = """
+SELECT q.i, f.film_id, f.title, f.year, similarity(f.title, q.title) AS sim
+FROM unnest(%(idx)s::int[], %(titles)s::text[], %(years)s::int[]) AS q(i, title, year)
+JOIN LATERAL (
+  SELECT film_id, title, year
+  FROM film
+  WHERE title %% q.title
+    AND (q.year IS NULL OR year BETWEEN q.year - 1 AND q.year + 1)
+  ORDER BY title <-> q.title
+  LIMIT 5
+) f ON true;
 """
 
-SQL_SUGGEST_ILIKE = """
+SQL_SUGGEST_FTS = """
 SELECT film_id, title, year,
-       CASE
-         WHEN title = %(title)s THEN 1.0
-         WHEN title ILIKE %(title_like)s THEN 0.7
-         ELSE 0.4
-       END AS sim
+       ts_rank(to_tsvector('simple', f_unaccent(title)),
+               plainto_tsquery('simple', f_unaccent(%(title)s))) AS sim
 FROM film
-WHERE title ILIKE %(title_like)s
+WHERE to_tsvector('simple', f_unaccent(title))
+      @@ plainto_tsquery('simple', f_unaccent(%(title)s))
   AND (%(year)s IS NULL OR year BETWEEN %(year)s - 1 AND %(year)s + 1)
 ORDER BY sim DESC, year DESC NULLS LAST
 LIMIT 5;
@@ -55,13 +51,15 @@ LIMIT 5;
 
 SQL_UPSERT_EXTERNAL_ID = """
 INSERT INTO film_external_id (film_id, provider, external_key, external_url)
-VALUES (%(film_id)s, %(provider)s, %(external_key)s, %(external_url)s)
+VALUES %s
 ON CONFLICT (provider, external_key)
 DO UPDATE SET
   film_id = EXCLUDED.film_id,
   external_url = EXCLUDED.external_url;
 """
 
+FLUSH_EVERY = 200
+
 def prompt_choice():
     return input("Choix (1-5 / s=skip / q=quit) > ").strip().lower()
 
@@ -75,20 +73,32 @@ def main():
     parser.add_argument("--pg-user", default=os.getenv("PG_USER", "postgres"))
     parser.add_argument("--pg-password", default=os.getenv("PG_PASSWORD", "postgres"))
     parser.add_argument("--limit", type=int, default=0, help="Limiter le nb de lignes (0=all)")
+    parser.add_argument("--auto-threshold", type=float, default=0.0,
+                        help="Auto-accepter la meilleure suggestion si sim >= seuil (0=off, ex: 0.95)")
     parser.add_argument("--dry-run", action="store_true")
     args = parser.parse_args()
 
-    df = pd.read_csv(args.csv)
-
     required = {"title", "year", "film_url", "annotation"}
-    missing = required - set(df.columns)
+    header = pd.read_csv(args.csv, nrows=0)
+    missing = required - set(header.columns)
     if missing:
-        raise SystemExit(f"[ERROR] Colonnes manquantes CSV: {missing}. Colonnes={list(df.columns)}")
+        raise SystemExit(f"[ERROR] Colonnes manquantes CSV: {missing}. Colonnes={list(header.columns)}")
+
+    # On ne parse que les 4 colonnes utiles, avec le moteur pyarrow
+    # (multithreadé) : démarrage bien plus rapide sur un gros export.
+    df = pd.read_csv(
+        args.csv,
+        usecols=["title", "year", "film_url", "annotation"],
+        dtype={"title": "string", "film_url": "string", "annotation": "string"},
+        engine="pyarrow",
+    )
 
+    # Extraction vectorisée du sc_id + filtre combiné en une seule passe
+    # (annotation non vide ET sc_id présent) : aucun objet Python par ligne.
     df["annotation"] = df["annotation"].fillna("").astype(str)
-    df = df[df["annotation"].str.strip() != ""].copy()  # ✅ uniquement annotation non vide
-    df["sc_id"] = df["film_url"].apply(extract_sc_id)
-    df = df[df["sc_id"].notna()].copy()
+    df["sc_id"] = df["film_url"].astype(str).str.extract(RE_SC_ID, expand=False)
+    mask = df["annotation"].str.strip().ne("") & df["sc_id"].notna()
+    df = df.loc[mask, ["title", "year", "film_url", "annotation", "sc_id"]].copy()
 
     if args.limit and args.limit > 0:
         df = df.head(args.limit)
@@ -111,7 +121,67 @@ def main():
                 trgm = has_pg_trgm(cur)
                 print(f"[INFO] pg_trgm={'ON' if trgm else 'OFF'}")
 
+                # Pré-filtre "déjà mappé" en une seule requête au lieu d'un
+                # SELECT par ligne dans la boucle interactive.
+                cur.execute(SQL_ALREADY_MAPPED_BULK, {
+                    "provider": args.provider,
+                    "keys": df["sc_id"].astype(str).tolist(),
+                })
+                mapped = {r["external_key"] for r in cur.fetchall()}
+
+                # Suggestions trigramme pré-calculées pour toutes les lignes
+                # restantes en UNE requête (unnest + LATERAL LIMIT 5), au lieu
+                # d'un aller-retour par ligne dans la boucle interactive.
+                suggestions_by_idx = {}
+                if trgm:
+                    todo = df[~df["sc_id"].astype(str).isin(mapped)]
+                    if not todo.empty:
+                        years = [
+                            int(y) if pd.notna(y) and str(y).strip() != "" else None
+                            for y in todo["year"]
+                        ]
+                        cur.execute(SQL_SUGGEST_TRGM_BATCH, {
+                            "idx": [int(i) for i in todo.index],
+                            "titles": [str(t).strip() for t in todo["title"]],
+                            "years": years,
+                        })
+                        for r in cur.fetchall():
+                            suggestions_by_idx.setdefault(r["i"], []).append(r)
+
+                # Choix confirmés bufferisés puis upsertés par paquets via
+                # execute_values : moins d'allers-retours et de commits qu'un
+                # INSERT par validation.
+                pending = []
+
+                def flush_pending():
+                    if not pending or args.dry_run:
+                        pending.clear()
+                        return
+                    execute_values(cur, SQL_UPSERT_EXTERNAL_ID, pending,
+                                   page_size=FLUSH_EVERY)
+                    pending.clear()
+
+                # Mode auto : les lignes dont la meilleure suggestion dépasse
+                # le seuil partent directement dans le batch d'upsert, sans
+                # prompt — seul le résidu reste interactif.
+                auto_idx = set()
+                if trgm and args.auto_threshold > 0:
+                    for i, sugg in suggestions_by_idx.items():
+                        best = sugg[0]
+                        if float(best.get("sim") or 0.0) < args.auto_threshold:
+                            continue
+                        row = df.loc[i]
+                        pending.append((int(best["film_id"]), args.provider,
+                                        str(row["sc_id"]).strip(),
+                                        str(row["film_url"]).strip()))
+                        auto_idx.add(i)
+                        saved += 1
+                    flush_pending()
+                    print(f"[INFO] auto-accept (sim>={args.auto_threshold}): {len(auto_idx)}")
+
                 for idx, row in df.iterrows():
+                    if int(idx) in auto_idx:
+                        continue
                     title = str(row["title"]).strip()
                     year_raw = row["year"]
                     year = int(year_raw) if pd.notna(year_raw) and str(year_raw).strip() != "" else None
@@ -120,17 +190,16 @@ def main():
                     ann = str(row["annotation"]).strip()
 
                     # Already mapped?
-                    cur.execute(SQL_IS_ALREADY_MAPPED, {"provider": args.provider, "external_key": sc_id})
-                    if cur.fetchone():
+                    if sc_id in mapped:
                         already += 1
                         continue
 
                     # Suggestions
                     if trgm:
-                        cur.execute(SQL_SUGGEST_TRGM, {"title": title, "year": year})
+                        suggestions = suggestions_by_idx.get(int(idx), [])
                     else:
-                        cur.execute(SQL_SUGGEST_ILIKE, {"title": title, "title_like": f"%{title}%", "year": year})
-                    suggestions = cur.fetchall()
+                        cur.execute(SQL_SUGGEST_FTS, {"title": title, "year": year})
+                        suggestions = cur.fetchall()
 
                     print("\n" + "="*90)
                     print(f"[{idx}] SC id={sc_id} | {title} ({year})")
@@ -164,13 +233,9 @@ def main():
                         k = int(choice)
                         if 1 <= k <= len(suggestions):
                             film_id = int(suggestions[k-1]["film_id"])
-                            if not args.dry_run:
-                                cur.execute(SQL_UPSERT_EXTERNAL_ID, {
-                                    "film_id": film_id,
-                                    "provider": args.provider,
-                                    "external_key": sc_id,
-                                    "external_url": film_url
-                                })
+                            pending.append((film_id, args.provider, sc_id, film_url))
+                            if len(pending) >= FLUSH_EVERY:
+                                flush_pending()
                             saved += 1
                             print(f"[OK] Enregistré: ({args.provider}, {sc_id}) -> film_id={film_id}")
                         else:
@@ -180,6 +245,8 @@ def main():
                         print("[WARN] Choix invalide -> skip")
                         skipped += 1
 
+                flush_pending()
+
         print("\n[DONE]")
         print(f"saved={saved}")
         print(f"skipped={skipped}")
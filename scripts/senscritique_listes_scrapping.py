@@ -1,13 +1,26 @@
 import re
-import time
+import asyncio
 import argparse
 from dataclasses import dataclass, asdict
 from typing import Optional, List, Dict, Tuple
 from urllib.parse import urlparse, urlunparse, parse_qs, urlencode, urljoin
 
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter, Retry
 from bs4 import BeautifulSoup
 
+# Motifs compilés une seule fois : la boucle de parsing les applique sur
+# chaque entrée de chaque page.
+_YEAR_RE = re.compile(r"^(.*)\s+\((\d{4})\)\s*$")
+_WS_RE = re.compile(r"\s+")
+_ANN_LOOSE_RE = re.compile(r"\bAnnotation\b", re.IGNORECASE)
+_ANN_FULL_RE = re.compile(r"Annotation\s*:?", re.IGNORECASE)
+_RATING_RE = re.compile(r"\ba mis\s+(\d{1,2}/10)\b")
+# Vraies fiches film : /film/<slug>/<id numérique>, sans query string.
+# Écarte en O(1) les ancres affiche/“voir la fiche” avant tout find_parent.
+_FILM_HREF_RE = re.compile(r"/film/[^/?#]+/\d+/?$")
+
 
 @dataclass
 class ListEntry:
@@ -32,8 +45,15 @@ class SensCritiqueListScraper:
             {
                 "User-Agent": self.USER_AGENT,
                 "Accept-Language": "fr-FR,fr;q=0.9,en;q=0.8",
+                # compression explicite : 3-5x moins d'octets par page HTML
+                "Accept-Encoding": "gzip, br",
             }
         )
+        self.sess.mount("https://", HTTPAdapter(
+            pool_connections=4, pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.5,
+                              status_forcelist=[429, 500, 502, 503, 504]),
+        ))
 
     @staticmethod
     def _set_page(url: str, page: int) -> str:
@@ -47,7 +67,11 @@ class SensCritiqueListScraper:
     def _fetch_soup(self, url: str) -> BeautifulSoup:
         r = self.sess.get(url, timeout=self.timeout_s)
         r.raise_for_status()
-        return BeautifulSoup(r.text, "html.parser")
+        # Parseur lxml (C) sur les octets bruts : ~5-10x plus rapide que
+        # html.parser, et from_encoding évite le sniffing d'encodage
+        # (fallback utf-8 si le serveur omet le charset, pour court-circuiter
+        # chardet même dans ce cas).
+        return BeautifulSoup(r.content, "lxml", from_encoding=r.encoding or "utf-8")
 
     @staticmethod
     def _extract_year_from_title(raw: str) -> Tuple[str, Optional[int]]:
@@ -56,7 +80,7 @@ class SensCritiqueListScraper:
         On sépare proprement.
         """
         raw = (raw or "").strip()
-        m = re.match(r"^(.*)\s+\((\d{4})\)\s*$", raw)
+        m = _YEAR_RE.match(raw)
         if m:
             return m.group(1).strip(), int(m.group(2))
         return raw, None
@@ -65,163 +89,205 @@ class SensCritiqueListScraper:
     def _clean_text(s: Optional[str]) -> Optional[str]:
         if not s:
             return None
-        s = re.sub(r"\s+", " ", s).strip()
+        s = _WS_RE.sub(" ", s).strip()
         return s or None
 
     @staticmethod
-    def _find_annotation_in_container(container) -> Optional[str]:
+    def _extract_meta(strings) -> Tuple[Optional[str], Optional[str]]:
         """
-        Repère le bloc:
-            "Annotation :" puis le texte juste après.
-        Sur ta page, c'est visible en clair dans le HTML rendu serveur. :contentReference[oaicite:2]{index=2}
+        Une seule passe sur les textes de l'item (stripped_strings) pour
+        récupérer à la fois:
+        - la note "<pseudo> a mis 6/10."
+        - le commentaire qui suit le marqueur "Annotation :"
+        au lieu de deux parcours séparés du conteneur.
         """
-        if not container:
-            return None
-
-        # Cherche un noeud texte qui contient "Annotation"
-        ann_node = container.find(string=re.compile(r"^\s*Annotation\s*:\s*$"))
-        if not ann_node:
-            # parfois le ":" n'est pas exactement au même endroit -> plus tolérant
-            ann_node = container.find(string=re.compile(r"\bAnnotation\b", re.IGNORECASE))
-            if not ann_node:
-                return None
-
-        # Le commentaire est généralement le prochain texte significatif après "Annotation :"
-        nxt = ann_node
-        for _ in range(20):
-            nxt = nxt.find_next(string=True)
-            if nxt is None:
-                break
-            txt = SensCritiqueListScraper._clean_text(str(nxt))
+        rating = None
+        annotation = None
+        want_annotation = False
+        for raw in strings:
+            txt = SensCritiqueListScraper._clean_text(raw)
             if not txt:
                 continue
-            # on ignore les répétitions "Annotation" ou ":" si jamais
-            if re.fullmatch(r"Annotation\s*:?", txt, flags=re.IGNORECASE):
-                continue
-            return txt
-
-        return None
-
-    @staticmethod
-    def _find_user_rating(container) -> Optional[str]:
-        """
-        Repère une mention du style:
-            "<pseudo> a mis 6/10."
-        (visible sur ta page). :contentReference[oaicite:3]{index=3}
-        """
-        if not container:
-            return None
-        text = container.get_text(" ", strip=True)
-        m = re.search(r"\ba mis\s+(\d{1,2}/10)\b", text)
-        return m.group(1) if m else None
+            if want_annotation:
+                # on ignore les répétitions "Annotation" ou ":" si jamais
+                if _ANN_FULL_RE.fullmatch(txt):
+                    continue
+                annotation = txt
+                want_annotation = False
+            elif annotation is None and _ANN_LOOSE_RE.search(txt):
+                # marqueur et texte parfois dans le même noeud ("Annotation : ...")
+                rest = _ANN_FULL_RE.split(txt, 1)
+                tail = rest[1].strip() if len(rest) > 1 else ""
+                if tail:
+                    annotation = tail
+                else:
+                    want_annotation = True
+            if rating is None:
+                m = _RATING_RE.search(txt)
+                if m:
+                    rating = m.group(1)
+            if rating is not None and annotation is not None:
+                break
+        return rating, annotation
 
-    def parse_page(self, soup: BeautifulSoup, base_url: str) -> List[ListEntry]:
+    def parse_page(self, soup: BeautifulSoup, base_url: str,
+                   seen: Dict[str, ListEntry]) -> int:
         """
         Extraction d'une page:
         - chaque film a un lien /film/...
         - le titre est dans le texte du lien, souvent "Titre (YYYY)"
         - le commentaire éventuel est dans un bloc "Annotation : ..."
-        """
-        entries: List[ListEntry] = []
 
-        film_links = soup.select('a[href*="/film/"]')
-        seen_film_urls = set()
-
-        for a in film_links:
+        Alimente directement le dict partagé `seen` (dédup globale par URL,
+        testée AVANT tout get_text) et renvoie le nombre d'items films vus
+        sur la page (condition d'arrêt de la pagination).
+        """
+        found = 0
+
+        # Une seule passe : chaque ancre /film/ est rattachée à son item de
+        # liste englobant (li/article) via find_parent, sans re-scanner le
+        # texte de chaque ancêtre comme le faisait l'ancienne remontée à 8
+        # niveaux.
+        items = []
+        seen_items = set()
+        for a in soup.select('a[href*="/film/"]'):
+            # Préfiltre O(1) : la plupart des ancres /film/ d'une page de liste
+            # ne sont pas le lien-titre (affiche, chips) — on les écarte avant
+            # la remontée de conteneur et les extractions de texte.
             href = a.get("href")
-            if not href:
+            if not href or not _FILM_HREF_RE.search(href):
                 continue
+            if not (a.get_text(strip=True) or a.get("title") or a.get("aria-label")):
+                continue
+            it = a.find_parent(["li", "article"])
+            node = it if it is not None else a
+            if id(node) in seen_items:
+                continue
+            seen_items.add(id(node))
+            items.append((node, a))
+
+        for container, a in items:
+            # l'ancre retenue par le préfiltre est déjà le lien-titre
+            link = a
+            href = link.get("href")
 
             # Normalise URL
             film_url = urljoin(base_url, href)
 
-            # Déduplique (il peut y avoir d'autres liens vers le film dans le même bloc)
-            if film_url in seen_film_urls:
+            # Déduplique avant tout travail d'extraction de texte (il peut y
+            # avoir plusieurs liens vers le film : affiche, titre, note...)
+            if film_url in seen:
+                found += 1
                 continue
 
-            raw_title = a.get_text(strip=True) or a.get("title") or a.get("aria-label") or ""
+            raw_title = link.get_text(strip=True) or link.get("title") or link.get("aria-label") or ""
             raw_title = raw_title.strip()
             if not raw_title:
                 continue
 
             # On vise surtout les liens-titres de la liste (souvent "Titre (2014)")
-            # => petite validation: contient une année entre parenthèses OU ressemble à un titre non vide
             title, year = self._extract_year_from_title(raw_title)
 
-            # Remonte vers un container "raisonnable" (item de liste)
-            container = a
-            for _ in range(8):
-                if container is None or container.parent is None:
-                    break
-                container = container.parent
-                # heuristique: si le container contient "a mis X/10" ou "Annotation", on est probablement au bon niveau
-                txt = container.get_text(" ", strip=True)
-                if "a mis" in txt or "Annotation" in txt:
-                    break
-
-            user_rating = self._find_user_rating(container)
-            annotation = self._find_annotation_in_container(container)
-
-            entries.append(
-                ListEntry(
-                    title=title,
-                    year=year,
-                    film_url=film_url,
-                    user_rating=user_rating,
-                    annotation=annotation,
-                )
-            )
-            seen_film_urls.add(film_url)
+            # une seule traversée du texte de l'item pour note + annotation
+            user_rating, annotation = self._extract_meta(container.stripped_strings)
 
-        return entries
+            seen[film_url] = ListEntry(
+                title=title,
+                year=year,
+                film_url=film_url,
+                user_rating=user_rating,
+                annotation=annotation,
+            )
+            found += 1
+
+        return found
+
+    CONCURRENCY = 8
+
+    async def _fetch_soup_async(self, session: "aiohttp.ClientSession",
+                                sem: "asyncio.Semaphore", url: str) -> BeautifulSoup:
+        """GET borné par sémaphore, backoff exponentiel sur 429/5xx."""
+        for attempt in range(4):
+            async with sem:
+                async with session.get(
+                    url, timeout=aiohttp.ClientTimeout(total=self.timeout_s)
+                ) as r:
+                    if r.status == 429 or r.status >= 500:
+                        await asyncio.sleep(1.5 * 2 ** attempt)
+                        continue
+                    r.raise_for_status()
+                    body = await r.read()
+                    encoding = r.charset or "utf-8"
+            # Le parsing lxml est du CPU pur : on le sort de la boucle événement
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, lambda: BeautifulSoup(body, "lxml", from_encoding=encoding)
+            )
+        raise RuntimeError(f"Trop de tentatives (429/5xx) sur {url}")
 
-    def scrape_list(self, list_url: str, max_pages: int = 200) -> List[ListEntry]:
-        """
-        Parcourt ?page=1..n jusqu'à ce qu'une page ne contienne plus d'entrées.
-        (Sur ta liste on voit 1 2 3 4, donc ~4 pages). :contentReference[oaicite:4]{index=4}
-        """
+    async def _scrape_list_async(self, list_url: str, max_pages: int) -> List[ListEntry]:
         u = urlparse(list_url)
         base_url = f"{u.scheme}://{u.netloc}"
-
-        all_entries: List[ListEntry] = []
         seen: Dict[str, ListEntry] = {}
 
-        for page in range(1, max_pages + 1):
-            page_url = self._set_page(list_url, page)
-            soup = self._fetch_soup(page_url)
-
-            entries = self.parse_page(soup, base_url=base_url)
-
-            # Condition d'arrêt: plus rien trouvé
-            if not entries:
-                break
-
-            # Dédup globale
-            for e in entries:
-                if e.film_url not in seen:
-                    seen[e.film_url] = e
-
-            time.sleep(self.sleep_s)
-
-        all_entries = list(seen.values())
-        return all_entries
+        sem = asyncio.Semaphore(self.CONCURRENCY)
+        connector = aiohttp.TCPConnector(limit_per_host=self.CONCURRENCY)
+        headers = {
+            "User-Agent": self.USER_AGENT,
+            "Accept-Language": "fr-FR,fr;q=0.9,en;q=0.8",
+            "Accept-Encoding": "gzip, br",
+        }
+        async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+            page = 1
+            done = False
+            while not done and page <= max_pages:
+                batch = range(page, min(page + self.CONCURRENCY, max_pages + 1))
+                soups = await asyncio.gather(*(
+                    self._fetch_soup_async(session, sem, self._set_page(list_url, p))
+                    for p in batch
+                ))
+                for soup in soups:
+                    found = self.parse_page(soup, base_url=base_url, seen=seen)
+                    # Condition d'arrêt: plus rien trouvé sur une page
+                    if not found:
+                        done = True
+                        break
+                page = batch[-1] + 1
+
+        return list(seen.values())
 
+    def scrape_list(self, list_url: str, max_pages: int = 200) -> List[ListEntry]:
+        """
+        Parcourt ?page=1..n jusqu'à ce qu'une page ne contienne plus d'entrées,
+        par vagues de CONCURRENCY requêtes concurrentes (aiohttp) au lieu d'un
+        GET + sleep séquentiel par page.
+        """
+        return asyncio.run(self._scrape_list_async(list_url, max_pages))
 
-def export_jsonl(entries: List[ListEntry], path: str) -> None:
-    import json
-    with open(path, "w", encoding="utf-8") as f:
-        for e in entries:
-            f.write(json.dumps(asdict(e), ensure_ascii=False) + "\n")
 
+def export_both(entries: List[ListEntry], csv_path: str, jsonl_path: str) -> None:
+    """CSV + JSONL en une seule passe sur les entrées.
 
-def export_csv(entries: List[ListEntry], path: str) -> None:
+    Les lignes JSONL sont jointes par paquets de 500 pour limiter les appels
+    write(), et le même asdict sert aux deux sorties.
+    """
     import csv
+    import json
     fields = ["title", "year", "film_url", "user_rating", "annotation"]
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=fields)
+    with open(csv_path, "w", newline="", encoding="utf-8") as fc, \
+         open(jsonl_path, "w", encoding="utf-8") as fj:
+        w = csv.DictWriter(fc, fieldnames=fields)
         w.writeheader()
+        buf = []
         for e in entries:
-            w.writerow(asdict(e))
+            d = asdict(e)
+            w.writerow(d)
+            buf.append(json.dumps(d, ensure_ascii=False, separators=(",", ":")))
+            if len(buf) >= 500:
+                fj.write("\n".join(buf) + "\n")
+                buf.clear()
+        if buf:
+            fj.write("\n".join(buf) + "\n")
 
 
 # if __name__ == "__main__":
@@ -280,6 +346,5 @@ if __name__ == "__main__":
     for e in entries[:10]:
         print("-", e.title, e.year, e.user_rating, "|", (e.annotation or "")[:80])
 
-    export_csv(entries, args.out)
-    export_jsonl(entries, args.out.replace(".csv", ".jsonl"))
+    export_both(entries, args.out, args.out.replace(".csv", ".jsonl"))
     print(f"Export: {args.out} / {args.out.replace('.csv', '.jsonl')}")
\ No newline at end of file
@@ -1,9 +1,10 @@
 import os
-import time
+import asyncio
 import argparse
-import requests
+import httpx
 import psycopg2
-from psycopg2.extras import DictCursor
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import DictCursor, execute_values
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -19,39 +20,91 @@ DB = dict(
     password=os.getenv("POSTGRES_PASSWORD", "postgres"),
 )
 
-def tmdb_get(path, params=None, retry=3):
-    params = params or {}
-    params["api_key"] = TMDB_KEY
+# Prefetch TMDb concurrent (semaphore borne) ; l'ecriture DB reste
+# sequentielle cote psycopg2 (un seul writer).
+FETCH_CONCURRENCY = 16
+
+async def tmdb_get_async(session, sem, path, params=None, retry=3):
     for i in range(retry):
-        r = requests.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
-        if r.status_code == 429:
-            time.sleep(1.5 + i)
-            continue
-        r.raise_for_status()
-        return r.json()
+        async with sem:
+            r = await session.get(path, params=params)
+            if r.status_code == 429:
+                # on honore Retry-After avant de retenter
+                await asyncio.sleep(float(r.headers.get("Retry-After", 1.5 + i)))
+                continue
+            r.raise_for_status()
+            return r.json()
     raise RuntimeError(f"TMDb rate-limited too long on {path}")
 
-def upsert_person(cur, p):
-    cur.execute("""
+async def tmdb_fetch_all(requests_list):
+    """Precharge [(key, path, params)] -> {key: (json|None, exception|None)}."""
+    sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+    # HTTP/2 : requêtes multiplexées sur une connexion TLS unique vers TMDb
+    limits = httpx.Limits(max_connections=FETCH_CONCURRENCY)
+    # api_key porté par le client : plus de copie de dict params par appel
+    async with httpx.AsyncClient(http2=True, timeout=30, limits=limits,
+                                 base_url=TMDB_BASE,
+                                 params={"api_key": TMDB_KEY}) as session:
+        async def one(key, path, params):
+            try:
+                return key, (await tmdb_get_async(session, sem, path, params), None)
+            except Exception as e:
+                return key, (None, e)
+        results = await asyncio.gather(*(one(*t) for t in requests_list))
+    return dict(results)
+
+CHUNK_SIZE = 500
+
+def upsert_persons(cur, persons):
+    """Upsert en lot ; renvoie {tmdb_person_id: person_id}."""
+    if not persons:
+        return {}
+    res = execute_values(cur, """
         INSERT INTO person (tmdb_person_id, name)
-        VALUES (%s, %s)
+        VALUES %s
         ON CONFLICT (tmdb_person_id) DO UPDATE
         SET name = EXCLUDED.name
-        RETURNING person_id;
-    """, (p["id"], p["name"]))
-    return cur.fetchone()[0]
-
-def link_director(cur, film_id, person_id):
-    cur.execute("""
+        RETURNING tmdb_person_id, person_id;
+    """, list(persons.items()), fetch=True)
+    return {r["tmdb_person_id"]: r["person_id"] for r in res}
+
+def link_directors(cur, links):
+    if not links:
+        return
+    execute_values(cur, """
         INSERT INTO film_credit (film_id, person_id, department, job)
-        VALUES (%s, %s, 'Directing', 'Director')
+        VALUES %s
         ON CONFLICT DO NOTHING;
-    """, (film_id, person_id))
+    """, sorted(links), template="(%s, %s, 'Directing', 'Director')")
+
+def write_chunk(conn, cur, films, fetched):
+    """Écritures en lot pour un paquet de films déjà préchargé.
+
+    Tourne dans le thread writer unique : pendant qu'il committe le paquet N,
+    le thread principal précharge déjà les credits du paquet N+1.
+    """
+    # Accumulation personnes + liens puis deux execute_values, au lieu
+    # de deux INSERT par réalisateur.
+    persons = {}
+    pending_links = []   # (film_id, tmdb_person_id)
+    for film_id, tmdb_id in films:
+        credits, err = fetched[film_id]
+        if err is not None:
+            print(f"[ERROR] film_id={film_id} tmdb_id={tmdb_id} -> {err}")
+            continue
+        for c in credits.get("crew", []):
+            if c.get("job") == "Director":
+                persons[c["id"]] = c["name"]
+                pending_links.append((film_id, c["id"]))
+
+    person_map = upsert_persons(cur, persons)
+    link_directors(cur, {(fid, person_map[pid]) for fid, pid in pending_links})
+    conn.commit()
+    return len(pending_links)
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--limit", type=int, default=100)
-    ap.add_argument("--sleep", type=float, default=0.25)
     args = ap.parse_args()
 
     conn = psycopg2.connect(**DB)
@@ -59,8 +112,13 @@ def main():
 
     with conn, conn.cursor(cursor_factory=DictCursor) as cur:
 
-        # films NAS sans réalisateur encore importé
-        cur.execute("""
+        # films NAS sans réalisateur encore importé — curseur serveur
+        # (WITH HOLD pour survivre aux commits par paquet) : la mémoire reste
+        # O(CHUNK_SIZE) même avec un très gros --limit.
+        # Curseur tuple (pas de DictCursor) : pas un dict alloué par ligne.
+        read_cur = conn.cursor(name="apply_iter", withhold=True)
+        read_cur.itersize = 100
+        read_cur.execute("""
             SELECT DISTINCT f.film_id, f.tmdb_id
             FROM film f
             JOIN film_source fs ON fs.film_id = f.film_id
@@ -73,29 +131,32 @@ def main():
             ORDER BY f.film_id
             LIMIT %s;
         """, (args.limit,))
-        films = cur.fetchall()
-
-        for film in films:
-            film_id = film["film_id"]
-            tmdb_id = film["tmdb_id"]
-
-            try:
-                credits = tmdb_get(f"/movie/{tmdb_id}/credits", params={"language": "fr-FR"})
-                directors = [
-                    c for c in credits.get("crew", [])
-                    if c.get("job") == "Director"
-                ]
 
-                for d in directors:
-                    person_id = upsert_person(cur, d)
-                    link_director(cur, film_id, person_id)
-
-                conn.commit()
-                time.sleep(args.sleep)
-
-            except Exception as e:
-                conn.rollback()
-                print(f"[ERROR] film_id={film_id} tmdb_id={tmdb_id} -> {e}")
+        # Writer unique dans un thread dédié : la latence des commits est
+        # masquée sous le prefetch TMDb du paquet suivant, et un seul thread
+        # écrit (transactions simples, ordre des paquets conservé).
+        writer_pool = ThreadPoolExecutor(max_workers=1)
+        pending = []
+        total_links = total_films = 0
+        while True:
+            films = read_cur.fetchmany(CHUNK_SIZE)
+            if not films:
+                break
+
+            # Préchargement concurrent des credits avant la boucle d'écriture
+            fetched = asyncio.run(tmdb_fetch_all([
+                (film_id, f"/movie/{tmdb_id}/credits", {"language": "fr-FR"})
+                for film_id, tmdb_id in films
+            ]))
+            pending.append((len(films), writer_pool.submit(
+                write_chunk, conn, cur, films, fetched)))
+
+        for n_films, fut in pending:
+            total_links += fut.result()
+            total_films += n_films
+        writer_pool.shutdown()
+        read_cur.close()
+        print(f"Directors linked: {total_links} (films: {total_films})")
 
     conn.close()
     print("Done.")
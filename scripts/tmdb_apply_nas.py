@@ -1,10 +1,12 @@
 import os
-import time
+import asyncio
 import argparse
-import requests
+import httpx
 import psycopg2
-from psycopg2.extras import DictCursor
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import DictCursor, execute_values
 from dotenv import load_dotenv
+from tmdb_cache import TmdbDiskCache
 
 load_dotenv()
 
@@ -19,18 +21,51 @@ DB = dict(
     password=os.getenv("POSTGRES_PASSWORD", "postgres"),
 )
 
-def tmdb_get(path, params=None, retry=3):
-    params = params or {}
-    params["api_key"] = TMDB_KEY
+# Prefetch TMDb concurrent (semaphore borne) ; l'ecriture DB reste
+# sequentielle cote psycopg2 (un seul writer).
+FETCH_CONCURRENCY = 16
+
+async def tmdb_get_async(session, sem, path, params=None, retry=3):
     for i in range(retry):
-        r = requests.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
-        if r.status_code == 429:
-            time.sleep(1.5 + i)
-            continue
-        r.raise_for_status()
-        return r.json()
+        async with sem:
+            r = await session.get(path, params=params)
+            if r.status_code == 429:
+                # on honore Retry-After avant de retenter
+                await asyncio.sleep(float(r.headers.get("Retry-After", 1.5 + i)))
+                continue
+            r.raise_for_status()
+            return r.json()
     raise RuntimeError(f"TMDb rate-limited too long on {path}")
 
+async def tmdb_fetch_all(requests_list):
+    """Precharge [(key, path, params)] -> {key: (json|None, exception|None)}.
+
+    Les reponses passent par le cache disque partage (TTL 24h) : les re-runs
+    apres erreur SQL ne repaient ni le reseau ni le budget rate-limit TMDb.
+    """
+    cache = TmdbDiskCache()
+    sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+    # HTTP/2 : requêtes multiplexées sur une connexion TLS unique vers TMDb
+    limits = httpx.Limits(max_connections=FETCH_CONCURRENCY)
+    # api_key porté par le client : plus de copie de dict params par appel
+    async with httpx.AsyncClient(http2=True, timeout=30, limits=limits,
+                                 base_url=TMDB_BASE,
+                                 params={"api_key": TMDB_KEY}) as session:
+        async def one(key, path, params):
+            ck = TmdbDiskCache.make_key(path, params)
+            cached = cache.get(ck)
+            if cached is not None:
+                return key, (cached, None)
+            try:
+                data = await tmdb_get_async(session, sem, path, params)
+                cache.set(ck, data)
+                return key, (data, None)
+            except Exception as e:
+                return key, (None, e)
+        results = await asyncio.gather(*(one(*t) for t in requests_list))
+    cache.close()
+    return dict(results)
+
 def ensure_source(cur, code, label):
     cur.execute("""
       INSERT INTO source (code, label)
@@ -40,66 +75,169 @@ def ensure_source(cur, code, label):
     """, (code, label))
     return cur.fetchone()[0]
 
-def upsert_film(cur, d):
-    tmdb_id = d["id"]
-    imdb_id = d.get("imdb_id")
-    title = d.get("title")
-    original_title = d.get("original_title")
+SQL_UPSERT_FILMS = """
+  INSERT INTO film (tmdb_id, imdb_id, title, original_title, release_date, year, runtime_min,
+                    overview, original_language, poster_path, backdrop_path,
+                    tmdb_popularity, tmdb_vote_avg, tmdb_vote_count)
+  VALUES %s
+  ON CONFLICT (tmdb_id) DO UPDATE SET
+    imdb_id=EXCLUDED.imdb_id,
+    title=EXCLUDED.title,
+    original_title=EXCLUDED.original_title,
+    release_date=EXCLUDED.release_date,
+    year=EXCLUDED.year,
+    runtime_min=EXCLUDED.runtime_min,
+    overview=EXCLUDED.overview,
+    original_language=EXCLUDED.original_language,
+    poster_path=EXCLUDED.poster_path,
+    backdrop_path=EXCLUDED.backdrop_path,
+    tmdb_popularity=EXCLUDED.tmdb_popularity,
+    tmdb_vote_avg=EXCLUDED.tmdb_vote_avg,
+    tmdb_vote_count=EXCLUDED.tmdb_vote_count,
+    updated_at=now()
+  RETURNING tmdb_id, film_id;
+"""
+
+def film_row(d):
     release_date = d.get("release_date") or None
-    year = int(release_date[:4]) if release_date else None
-    runtime_min = d.get("runtime")
-    overview = d.get("overview")
-    original_language = d.get("original_language")
-    poster_path = d.get("poster_path")
-    backdrop_path = d.get("backdrop_path")
-    popularity = d.get("popularity")
-    vote_avg = d.get("vote_average")
-    vote_count = d.get("vote_count")
+    return (
+        d["id"], d.get("imdb_id"), d.get("title"), d.get("original_title"),
+        release_date, int(release_date[:4]) if release_date else None,
+        d.get("runtime"), d.get("overview"), d.get("original_language"),
+        d.get("poster_path"), d.get("backdrop_path"),
+        d.get("popularity"), d.get("vote_average"), d.get("vote_count"),
+    )
 
-    cur.execute("""
-      INSERT INTO film (tmdb_id, imdb_id, title, original_title, release_date, year, runtime_min,
-                        overview, original_language, poster_path, backdrop_path,
-                        tmdb_popularity, tmdb_vote_avg, tmdb_vote_count)
-      VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-      ON CONFLICT (tmdb_id) DO UPDATE SET
-        imdb_id=EXCLUDED.imdb_id,
-        title=EXCLUDED.title,
-        original_title=EXCLUDED.original_title,
-        release_date=EXCLUDED.release_date,
-        year=EXCLUDED.year,
-        runtime_min=EXCLUDED.runtime_min,
-        overview=EXCLUDED.overview,
-        original_language=EXCLUDED.original_language,
-        poster_path=EXCLUDED.poster_path,
-        backdrop_path=EXCLUDED.backdrop_path,
-        tmdb_popularity=EXCLUDED.tmdb_popularity,
-        tmdb_vote_avg=EXCLUDED.tmdb_vote_avg,
-        tmdb_vote_count=EXCLUDED.tmdb_vote_count,
-        updated_at=now()
-      RETURNING film_id;
-    """, (tmdb_id, imdb_id, title, original_title, release_date, year, runtime_min,
-          overview, original_language, poster_path, backdrop_path, popularity, vote_avg, vote_count))
-    return cur.fetchone()[0]
+def upsert_films(cur, details_list):
+    """Upsert en lot ; renvoie {tmdb_id: film_id}."""
+    if not details_list:
+        return {}
+    res = execute_values(cur, SQL_UPSERT_FILMS,
+                         [film_row(d) for d in details_list],
+                         page_size=200, fetch=True)
+    return {r["tmdb_id"]: r["film_id"] for r in res}
 
-def upsert_genres(cur, film_id, genres):
-    for g in genres:
-        cur.execute("""
-          INSERT INTO genre (tmdb_genre_id, name)
-          VALUES (%s, %s)
-          ON CONFLICT (tmdb_genre_id) DO UPDATE SET name=EXCLUDED.name
-          RETURNING genre_id;
-        """, (g["id"], g["name"]))
-        genre_id = cur.fetchone()[0]
+def upsert_genres(cur, details_list, film_map):
+    """Genres + liens film_genre en un seul aller-retour (CTE ... RETURNING)."""
+    names = {}
+    film_ids, gids = [], []
+    for d in details_list:
+        for g in d.get("genres", []):
+            names[g["id"]] = g["name"]
+            film_ids.append(film_map[d["id"]])
+            gids.append(g["id"])
+    if not names:
+        return
+    # les couples (film, genre) passent en arrays unnest, rendus via mogrify
+    # car execute_values ne prend pas de parametres additionnels
+    links = cur.mogrify("%s::int[], %s::int[]", (film_ids, gids)).decode()
+    execute_values(cur, f"""
+      WITH g AS (
+        INSERT INTO genre (tmdb_genre_id, name)
+        VALUES %s
+        ON CONFLICT (tmdb_genre_id) DO UPDATE SET name=EXCLUDED.name
+        RETURNING tmdb_genre_id, genre_id
+      )
+      INSERT INTO film_genre (film_id, genre_id)
+      SELECT DISTINCT l.film_id, g.genre_id
+      FROM unnest({links}) AS l(film_id, tmdb_genre_id)
+      JOIN g ON g.tmdb_genre_id = l.tmdb_genre_id
+      ON CONFLICT DO NOTHING;
+    """, list(names.items()))
+
+CHUNK_SIZE = 500
+
+def write_rows(cur, nas_source_id, ok):
+    """Écritures d'un lot [(tuple staging, details)] — sans commit.
+
+    Écritures en lot : un execute_values par table au lieu de ~6
+    allers-retours par ligne.
+    """
+    details_by_tmdb = {d["id"]: d for _, d in ok}
+    film_map = upsert_films(cur, list(details_by_tmdb.values()))
+    upsert_genres(cur, list(details_by_tmdb.values()), film_map)
+
+    if ok:
+        # lien source NAS
+        execute_values(cur, """
+          INSERT INTO film_source (film_id, source_id, is_available)
+          VALUES %s
+          ON CONFLICT (film_id, source_id) DO NOTHING;
+        """, sorted({(film_map[d["id"]], nas_source_id) for _, d in ok}),
+            template="(%s, %s, TRUE)")
+
+        # fichiers NAS (dédup par path, clé unique)
+        paths = {}
+        for (_iid, _tid, raw_file_path, _rf, _rt), d in ok:
+            paths[raw_file_path] = film_map[d["id"]]
+        execute_values(cur, """
+          INSERT INTO nas_asset (film_id, path, scanned_at)
+          VALUES %s
+          ON CONFLICT (path) DO UPDATE SET
+            film_id=EXCLUDED.film_id,
+            scanned_at=now();
+        """, [(fid, p) for p, fid in paths.items()],
+            template="(%s, %s, now())")
+
+        # marquer appliqué
         cur.execute("""
-          INSERT INTO film_genre (film_id, genre_id)
-          VALUES (%s, %s)
-          ON CONFLICT DO NOTHING;
-        """, (film_id, genre_id))
+          UPDATE import_nas
+          SET match_status='APPLIED', applied = TRUE
+          WHERE import_nas_id = ANY(%s);
+        """, ([it[0] for it, _ in ok],))
+
+def write_chunk(conn, cur, nas_source_id, items, fetched):
+    """Écritures en lot pour un paquet de lignes staging déjà préchargé.
+
+    Tourne dans le thread writer unique : pendant qu'il committe le paquet N,
+    le thread principal précharge déjà le paquet N+1 sur TMDb.
+    """
+    # Répartition fiches OK / erreurs de fetch (lignes = tuples du curseur
+    # de lecture, plus léger qu'un dict par ligne)
+    ok, failures = [], []
+    for it in items:
+        details, err = fetched[it[0]]
+        if err is not None:
+            failures.append((it[0], f"apply: {str(err)[:900]}"))
+        else:
+            ok.append((it, details))
+
+    try:
+        write_rows(cur, nas_source_id, ok)
+        conn.commit()
+
+    except Exception:
+        # rejoue ligne à ligne sous SAVEPOINT : seule la ligne fautive est
+        # marquée ERROR, pas les ~500 autres du paquet
+        conn.rollback()
+        replayed = []
+        for item in ok:
+            cur.execute("SAVEPOINT row_sp")
+            try:
+                write_rows(cur, nas_source_id, [item])
+                cur.execute("RELEASE SAVEPOINT row_sp")
+                replayed.append(item)
+            except Exception as e:
+                cur.execute("ROLLBACK TO SAVEPOINT row_sp")
+                failures.append((item[0][0], f"apply: {str(e)[:900]}"))
+        ok = replayed
+        conn.commit()
+
+    if failures:
+        execute_values(cur, """
+          UPDATE import_nas
+          SET match_status='ERROR', match_note = v.note
+          FROM (VALUES %s) AS v(id, note)
+          WHERE import_nas_id = v.id;
+        """, failures)
+        conn.commit()
+
+    return len(ok), len(failures)
+
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--limit", type=int, default=100)
-    ap.add_argument("--sleep", type=float, default=0.25)
     args = ap.parse_args()
 
     conn = psycopg2.connect(**DB)
@@ -109,61 +247,50 @@ def main():
         # s'assure que NAS existe dans source
         nas_source_id = ensure_source(cur, "NAS", "NAS")
 
-        cur.execute("""
+        # Curseur serveur (WITH HOLD pour survivre aux commits par paquet) :
+        # la mémoire reste O(CHUNK_SIZE) même avec un très gros --limit.
+        # Curseur tuple (pas de DictCursor) : pas un dict alloué par ligne.
+        read_cur = conn.cursor(name="apply_iter", withhold=True)
+        read_cur.itersize = 100
+        read_cur.execute("""
             SELECT import_nas_id, tmdb_id, raw_file_path, raw_file, raw_title
             FROM import_nas
             WHERE match_status='MATCHED'
                 AND tmdb_id IS NOT NULL
-                AND (match_note IS NULL OR match_note NOT LIKE %s)
+                AND applied = FALSE
             ORDER BY import_nas_id
             LIMIT %s;
-        """, ("%applied%", args.limit,))
-        items = cur.fetchall()
+        """, (args.limit,))
+        # Commit de mise en place : matérialise le curseur WITH HOLD et
+        # pérennise la ligne source — un rollback de paquet dans write_chunk
+        # ne peut plus détruire ni l'un ni l'autre (curseur mort au prochain
+        # fetchmany, source_id disparu -> cascade de violations FK).
+        conn.commit()
 
-        for it in items:
-            iid = it["import_nas_id"]
-            tmdb_id = it["tmdb_id"]
+        # Writer unique dans un thread dédié : la latence des commits est
+        # masquée sous le prefetch TMDb du paquet suivant, et un seul thread
+        # écrit (transactions simples, ordre des paquets conservé).
+        writer_pool = ThreadPoolExecutor(max_workers=1)
+        pending = []
+        while True:
+            items = read_cur.fetchmany(CHUNK_SIZE)
+            if not items:
+                break
+            fetched = asyncio.run(tmdb_fetch_all([
+                (iid, f"/movie/{tid}", {"language": "fr-FR"})
+                for iid, tid, *_ in items
+            ]))
+            pending.append(writer_pool.submit(
+                write_chunk, conn, cur, nas_source_id, items, fetched))
 
-            try:
-                details = tmdb_get(f"/movie/{tmdb_id}", params={"language": "fr-FR"})
-                film_id = upsert_film(cur, details)
-                upsert_genres(cur, film_id, details.get("genres", []))
-
-                # lien source NAS
-                cur.execute("""
-                  INSERT INTO film_source (film_id, source_id, is_available)
-                  VALUES (%s, %s, TRUE)
-                  ON CONFLICT (film_id, source_id) DO NOTHING;
-                """, (film_id, nas_source_id))
-
-                # fichier NAS (évite doublons par path unique)
-                cur.execute("""
-                  INSERT INTO nas_asset (film_id, path, scanned_at)
-                  VALUES (%s, %s, now())
-                  ON CONFLICT (path) DO UPDATE SET
-                    film_id=EXCLUDED.film_id,
-                    scanned_at=now();
-                """, (film_id, it["raw_file_path"]))
-
-                # marquer appliqué
-                cur.execute("""
-                    UPDATE import_nas
-                    SET match_status='APPLIED',
-                        match_note = COALESCE(match_note,'') || ' | applied'
-                    WHERE import_nas_id=%s
-                """, (iid,))
-
-                conn.commit()
-                time.sleep(args.sleep)
-
-            except Exception as e:
-                conn.rollback()
-                cur.execute("""
-                  UPDATE import_nas
-                  SET match_status='ERROR', match_note=%s
-                  WHERE import_nas_id=%s
-                """, (f"apply: {str(e)[:900]}", iid))
-                conn.commit()
+        total_ok = total_err = 0
+        for fut in pending:
+            n_ok, n_err = fut.result()
+            total_ok += n_ok
+            total_err += n_err
+        writer_pool.shutdown()
+        read_cur.close()
+        print(f"Applied: {total_ok} | Errors: {total_err}")
 
     conn.close()
     print("Done.")
@@ -1,10 +1,14 @@
+import io
 import os
 import time
 import argparse
-import requests
+import threading
+import traceback
+import requests_cache
 import psycopg2
-from psycopg2.extras import DictCursor
-from datetime import datetime
+from requests.adapters import HTTPAdapter, Retry
+from psycopg2.extras import DictCursor, execute_values
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,6 +16,22 @@ load_dotenv()
 TMDB_KEY = os.environ["TMDB_API_KEY"]
 TMDB_BASE = "https://api.themoviedb.org/3"
 
+# Les /movie/{id} reviennent d'un run à l'autre (et depuis les autres
+# pipelines) : cache sqlite transparent, TTL 7 jours.
+SESSION = requests_cache.CachedSession(
+    cache_name="tmdb_cache", backend="sqlite",
+    expire_after=timedelta(days=7),
+)
+# Session unique -> keep-alive (pas de handshake TLS par appel) ; retry et
+# backoff gérés par urllib3 plutôt qu'en Python.
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1, pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=1.5,
+                      status_forcelist=[429, 502, 503, 504]),
+))
+# api_key porté par la session : plus de mutation du dict params par appel
+SESSION.params = {"api_key": TMDB_KEY}
+
 DB = dict(
     host=os.getenv("POSTGRES_HOST", "localhost"),
     port=int(os.getenv("POSTGRES_PORT", "5432")),
@@ -22,10 +42,35 @@ DB = dict(
 
 USER_ID = 1  # ton user Hide
 
+class TokenBucket:
+    """Limiteur token bucket : on consomme tout le débit TMDb autorisé sans
+    jamais le dépasser, au lieu de dormir un délai fixe après chaque appel
+    (qui sous-utilise le quota quand les réponses sont rapides)."""
+
+    def __init__(self, rate=40, capacity=40):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 0
+            else:
+                self.tokens -= 1
+
+_BUCKET = TokenBucket(rate=40, capacity=40)
+
 def tmdb_get(path, params=None):
-    params = params or {}
-    params["api_key"] = TMDB_KEY
-    r = requests.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
+    _BUCKET.take()
+    r = SESSION.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
     r.raise_for_status()
     return r.json()
 
@@ -34,106 +79,216 @@ def normalize_date(d):
         return None
     return d
 
+# Écritures par lot : 4 allers-retours + 1 commit par paquet au lieu de
+# 5 allers-retours + 1 commit par ligne.
+BATCH_SIZE = 200
+
+FILM_COLS = "tmdb_id, title, original_title, release_date, year, runtime_min, overview"
+
+def _copy_val(v):
+    """Encode une valeur au format texte de COPY (\\N = NULL)."""
+    if v is None:
+        return r"\N"
+    return (str(v).replace("\\", "\\\\")
+            .replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r"))
+
+def upsert_films(cur, rows):
+    """Upsert film par COPY vers une table temporaire puis merge serveur.
+
+    COPY charge le lot d'un seul flux (bien plus vite que des INSERT
+    ligne à ligne), et un unique INSERT ... SELECT ... ON CONFLICT fait
+    le merge côté serveur. Renvoie {tmdb_id: film_id}.
+    """
+    cur.execute("""
+        DROP TABLE IF EXISTS tmp_film;
+        CREATE TEMP TABLE tmp_film (
+          tmdb_id bigint, title text, original_title text,
+          release_date date, year int, runtime_min int, overview text
+        ) ON COMMIT DROP;
+    """)
+    buf = io.StringIO("".join(
+        "\t".join(_copy_val(v) for v in row) + "\n" for row in rows))
+    cur.copy_expert(f"COPY tmp_film ({FILM_COLS}) FROM STDIN", buf)
+    cur.execute(f"""
+        INSERT INTO film ({FILM_COLS})
+        SELECT {FILM_COLS} FROM tmp_film
+        ON CONFLICT (tmdb_id) DO UPDATE SET
+          title=EXCLUDED.title,
+          original_title=EXCLUDED.original_title,
+          release_date=EXCLUDED.release_date,
+          year=EXCLUDED.year,
+          runtime_min=EXCLUDED.runtime_min,
+          overview=EXCLUDED.overview
+        RETURNING tmdb_id, film_id;
+    """)
+    return {r["tmdb_id"]: r["film_id"] for r in cur.fetchall()}
+
+def film_row(details):
+    release_date = details.get("release_date") or None
+    return (
+        details["id"], details.get("title"), details.get("original_title"),
+        release_date, int(release_date[:4]) if release_date else None,
+        details.get("runtime"), details.get("overview"),
+    )
+
+def exc_note(e):
+    """Type + message de l'exception, sans la traceback complète : plus
+    informatif que str(e) (qui peut être vide) et borne la note."""
+    return "".join(traceback.format_exception_only(type(e), e)).strip()[:900]
+
+def write_batch(cur, batch):
+    """Écritures d'un lot [(row, details)] — sans commit (géré par l'appelant)."""
+    # upsert films (dédup par tmdb_id) -> {tmdb_id: film_id}
+    films = {d["id"]: film_row(d) for _, d in batch}
+    film_map = upsert_films(cur, list(films.values()))
+
+    # upsert user_film (dernière ligne gagne par film)
+    uf_rows = {}
+    watch_rows = []
+    for r, d in batch:
+        film_id = film_map[d["id"]]
+        watched = normalize_date(r["watched_date"])
+        uf_rows[film_id] = (USER_ID, film_id, r["rating_10"], watched, watched)
+        if watched:
+            watch_rows.append((
+                USER_ID, film_id,
+                datetime.combine(watched, datetime.min.time()),
+                r["rating_10"],
+            ))
+    execute_values(cur, """
+        INSERT INTO user_film
+          (user_id, film_id, status, rating_10, first_seen_at, last_seen_at, rewatch_count)
+        VALUES %s
+        ON CONFLICT (user_id, film_id) DO UPDATE SET
+          status='SEEN',
+          rating_10=EXCLUDED.rating_10,
+          last_seen_at=EXCLUDED.last_seen_at,
+          updated_at=now();
+    """, list(uf_rows.values()), template="(%s, %s, 'SEEN', %s, %s, %s, 0)")
+
+    if watch_rows:
+        execute_values(cur, """
+            INSERT INTO watch_event
+              (user_id, film_id, watched_at, rating_10, context)
+            VALUES %s;
+        """, watch_rows, template="(%s, %s, %s, %s, 'senscritique_import')")
+
+    cur.execute("""
+        UPDATE import_seen_sc
+        SET applied = TRUE
+        WHERE import_seen_id = ANY(%s);
+    """, ([r["import_seen_id"] for r, _ in batch],))
+
+def flush_batch(conn, cur, batch):
+    """batch = [(row, details)] ; renvoie (nb appliqués, nb erreurs)."""
+    if not batch:
+        return 0, 0
+    try:
+        write_batch(cur, batch)
+        conn.commit()
+        return len(batch), 0
+
+    except Exception:
+        # rejoue ligne à ligne sous SAVEPOINT : seule la ligne fautive est
+        # marquée ERROR, les 199 autres du paquet passent quand même
+        conn.rollback()
+        n_ok = 0
+        failures = []
+        for item in batch:
+            cur.execute("SAVEPOINT row_sp")
+            try:
+                write_batch(cur, [item])
+                cur.execute("RELEASE SAVEPOINT row_sp")
+                n_ok += 1
+            except Exception as e:
+                cur.execute("ROLLBACK TO SAVEPOINT row_sp")
+                failures.append((item[0]["import_seen_id"], f"apply: {exc_note(e)}"))
+        if failures:
+            execute_values(cur, """
+                UPDATE import_seen_sc
+                SET match_status='ERROR', match_note = v.note
+                FROM (VALUES %s) AS v(id, note)
+                WHERE import_seen_id = v.id;
+            """, failures)
+        conn.commit()
+        return n_ok, len(failures)
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--limit", type=int, default=200)
-    ap.add_argument("--sleep", type=float, default=0.2)
     args = ap.parse_args()
 
     conn = psycopg2.connect(**DB)
     conn.autocommit = False
 
     with conn, conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute("""
-            SELECT *
-            FROM import_seen_sc
-            WHERE match_status='MATCHED'
-              AND tmdb_id IS NOT NULL
-              AND (match_note IS NULL OR match_note NOT LIKE '%%applied%%')
-            ORDER BY import_seen_id
-            LIMIT %s;
-        """, (args.limit,))
-        rows = cur.fetchall()
-
-        print(f"[apply_seen] items: {len(rows)}")
-
-        for r in rows:
-            try:
-                details = tmdb_get(f"/movie/{r['tmdb_id']}", {"language": "fr-FR"})
-
-                # upsert film
-                cur.execute("""
-                    INSERT INTO film (tmdb_id, title, original_title, release_date, year, runtime_min, overview)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s)
-                    ON CONFLICT (tmdb_id) DO UPDATE SET
-                      title=EXCLUDED.title,
-                      original_title=EXCLUDED.original_title,
-                      release_date=EXCLUDED.release_date,
-                      year=EXCLUDED.year,
-                      runtime_min=EXCLUDED.runtime_min,
-                      overview=EXCLUDED.overview
-                    RETURNING film_id;
-                """, (
-                    details["id"],
-                    details.get("title"),
-                    details.get("original_title"),
-                    details.get("release_date"),
-                    int(details["release_date"][:4]) if details.get("release_date") else None,
-                    details.get("runtime"),
-                    details.get("overview"),
-                ))
-                film_id = cur.fetchone()[0]
-
-                watched = normalize_date(r["watched_date"])
-
-                # upsert user_film
-                cur.execute("""
-                    INSERT INTO user_film
-                      (user_id, film_id, status, rating_10, first_seen_at, last_seen_at, rewatch_count)
-                    VALUES (%s,%s,'SEEN',%s,%s,%s,0)
-                    ON CONFLICT (user_id, film_id) DO UPDATE SET
-                      status='SEEN',
-                      rating_10=EXCLUDED.rating_10,
-                      last_seen_at=EXCLUDED.last_seen_at,
-                      updated_at=now();
-                """, (
-                    USER_ID,
-                    film_id,
-                    r["rating_10"],
-                    watched,
-                    watched,
-                ))
-
-                # insert watch_event
-                if watched:
-                    cur.execute("""
-                        INSERT INTO watch_event
-                          (user_id, film_id, watched_at, rating_10, context)
-                        VALUES (%s,%s,%s,%s,'senscritique_import');
-                    """, (
-                        USER_ID,
-                        film_id,
-                        datetime.combine(watched, datetime.min.time()),
-                        r["rating_10"],
-                    ))
-
-                cur.execute("""
-                    UPDATE import_seen_sc
-                    SET match_note = COALESCE(match_note,'') || ' | applied'
-                    WHERE import_seen_id=%s;
-                """, (r["import_seen_id"],))
+        total_rows = 0
+        total_ok = total_err = 0
+        json_hits = 0       # fiches servies depuis raw_tmdb_json (sans HTTP)
 
-                conn.commit()
-                time.sleep(args.sleep)
+        remaining = args.limit
+        while remaining > 0:
+            # SKIP LOCKED : plusieurs workers peuvent tourner en parallèle.
+            # On réclame un paquet à la fois : le commit du paquet relâche
+            # les verrous, mais il marque en même temps applied/ERROR — un
+            # worker concurrent ne peut donc jamais rejouer ces lignes
+            # (réclamer tout --limit d'un coup laissait les paquets non
+            # flushés déverrouillés et encore applied=FALSE dès le 1er commit).
+            cur.execute("""
+                SELECT *
+                FROM import_seen_sc
+                WHERE match_status='MATCHED'
+                  AND tmdb_id IS NOT NULL
+                  AND applied = FALSE
+                ORDER BY import_seen_id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED;
+            """, (min(BATCH_SIZE, remaining),))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            remaining -= len(rows)
+            total_rows += len(rows)
 
-            except Exception as e:
-                conn.rollback()
-                cur.execute("""
+            batch = []          # (row, details) prêts à écrire
+            fetch_errors = []   # (id, note) — erreurs TMDb du paquet
+
+            for r in rows:
+                # fiche persistée au match : pas d'appel TMDb sauf fiche
+                # incomplète (les résultats de /search n'ont pas le runtime)
+                details = r["raw_tmdb_json"]
+                if details is not None and "runtime" in details:
+                    json_hits += 1
+                else:
+                    try:
+                        details = tmdb_get(f"/movie/{r['tmdb_id']}", {"language": "fr-FR"})
+                    except Exception as e:
+                        fetch_errors.append((r["import_seen_id"], f"apply: {exc_note(e)}"))
+                        continue
+                batch.append((r, details))
+
+            if fetch_errors:
+                # même transaction que le paquet : les lignes en échec sont
+                # marquées ERROR avant que leurs verrous ne tombent
+                execute_values(cur, """
                     UPDATE import_seen_sc
-                    SET match_status='ERROR', match_note=%s
-                    WHERE import_seen_id=%s;
-                """, (str(e)[:900], r["import_seen_id"]))
+                    SET match_status='ERROR', match_note = v.note
+                    FROM (VALUES %s) AS v(id, note)
+                    WHERE import_seen_id = v.id;
+                """, fetch_errors)
+                total_err += len(fetch_errors)
+
+            n_ok, n_err = flush_batch(conn, cur, batch)
+            if not batch:
+                # paquet entièrement en échec fetch : flush_batch n'a pas
+                # committé, on pousse les notes ERROR nous-mêmes
                 conn.commit()
+            total_ok += n_ok
+            total_err += n_err
+
+        print(f"[apply_seen] items: {total_rows}")
+        print(f"[apply_seen] applied: {total_ok} | errors: {total_err} "
+              f"| json hits: {json_hits}/{total_rows}")
 
     conn.close()
     print("Done.")
@@ -0,0 +1,47 @@
+# Cache disque des réponses TMDb partagé par les scripts asynchrones
+# (les scripts encore sur requests utilisent requests_cache ; ici le client
+# est httpx async, donc un petit cache sqlite maison fait le même travail).
+import json
+import sqlite3
+import time
+
+CACHE_PATH = ".tmdb_cache_async.sqlite"
+DEFAULT_TTL = 86400  # 24h, aligné sur les CachedSession des autres scripts
+
+
+class TmdbDiskCache:
+    """Cache clé -> JSON avec TTL, persistant entre deux exécutions."""
+
+    def __init__(self, path: str = CACHE_PATH, ttl: int = DEFAULT_TTL):
+        self.ttl = ttl
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tmdb_cache ("
+            " key TEXT PRIMARY KEY, payload TEXT NOT NULL, fetched_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def make_key(path: str, params: dict | None) -> str:
+        # api_key exclue de la clé : même réponse quelle que soit la clé API
+        items = sorted((k, v) for k, v in (params or {}).items() if k != "api_key")
+        return path + "?" + "&".join(f"{k}={v}" for k, v in items)
+
+    def get(self, key: str):
+        row = self._db.execute(
+            "SELECT payload, fetched_at FROM tmdb_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def set(self, key: str, value) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO tmdb_cache (key, payload, fetched_at)"
+            " VALUES (?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), time.time()),
+        )
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
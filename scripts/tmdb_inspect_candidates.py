@@ -1,12 +1,20 @@
-import os, re, argparse, requests
+import os, re, argparse, asyncio
+import httpx
 import psycopg2
 from psycopg2.extras import DictCursor
 from dotenv import load_dotenv
+from tmdb_cache import TmdbDiskCache
 
 load_dotenv()
 TMDB_KEY = os.environ["TMDB_API_KEY"]
 TMDB_BASE = "https://api.themoviedb.org/3"
 
+FETCH_CONCURRENCY = 10
+
+# Cache disque partagé avec les pipelines match : les fiches des candidats
+# ambigus y sont souvent déjà (la clé inclut append_to_response=credits).
+_disk_cache = TmdbDiskCache(ttl=7 * 86400)
+
 DB = dict(
     host=os.getenv("POSTGRES_HOST", "localhost"),
     port=int(os.getenv("POSTGRES_PORT", "5432")),
@@ -15,18 +23,28 @@ DB = dict(
     password=os.getenv("POSTGRES_PASSWORD", "postgres"),
 )
 
-def tmdb_get(path, params=None):
-    params = params or {}
-    params["api_key"] = TMDB_KEY
-    r = requests.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
-    r.raise_for_status()
-    return r.json()
+async def tmdb_get(session, sem, path, params=None):
+    async with sem:
+        r = await session.get(path, params=params)
+        r.raise_for_status()
+        return r.json()
 
-def directors(tmdb_id: int):
-    credits = tmdb_get(f"/movie/{tmdb_id}/credits", params={"language":"fr-FR"})
-    return [c["name"] for c in credits.get("crew", []) if c.get("job") == "Director"]
+async def movie_with_credits(session, sem, tmdb_id: int):
+    # fiche + credits en un seul appel (append_to_response) au lieu de
+    # /movie/{id} puis /movie/{id}/credits
+    params = {"language": "fr-FR", "append_to_response": "credits"}
+    ck = TmdbDiskCache.make_key(f"/movie/{tmdb_id}", params)
+    d = _disk_cache.get(ck)
+    if d is None:
+        d = await tmdb_get(session, sem, f"/movie/{tmdb_id}", params)
+        _disk_cache.set(ck, d)
+    return d
 
-def main():
+def directors(details):
+    crew = (details.get("credits") or {}).get("crew", [])
+    return [c["name"] for c in crew if c.get("job") == "Director"]
+
+async def main_async():
     ap = argparse.ArgumentParser()
     ap.add_argument("--id", type=int, help="import_nas_id (optional). If omitted, lists all ambiguous.")
     args = ap.parse_args()
@@ -39,28 +57,43 @@ def main():
             cur.execute("""SELECT * FROM import_nas WHERE match_status='AMBIGUOUS' ORDER BY import_nas_id""")
         rows = cur.fetchall()
 
-    for row in rows:
-        iid = row["import_nas_id"]
-        title = row["raw_title"]
-        year = row["raw_year"]
-        raw_dir = row["raw_director"]
-        note = row["match_note"] or ""
-        print("\n" + "="*80)
-        print(f"import_nas_id={iid} | {title} ({year}) | director_raw={raw_dir}")
-        print(f"match_note={note}")
+    sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+    limits = httpx.Limits(max_connections=FETCH_CONCURRENCY)
+    # api_key porté par le client : plus de copie de dict params par appel
+    async with httpx.AsyncClient(http2=True, timeout=30, limits=limits,
+                                 base_url=TMDB_BASE,
+                                 params={"api_key": TMDB_KEY}) as session:
+        for row in rows:
+            iid = row["import_nas_id"]
+            title = row["raw_title"]
+            year = row["raw_year"]
+            raw_dir = row["raw_director"]
+            note = row["match_note"] or ""
+            print("\n" + "="*80)
+            print(f"import_nas_id={iid} | {title} ({year}) | director_raw={raw_dir}")
+            print(f"match_note={note}")
+
+            m = re.search(r"candidates=([0-9,]+)", note)
+            if not m:
+                print("No candidates list found in match_note.")
+                continue
 
-        m = re.search(r"candidates=([0-9,]+)", note)
-        if not m:
-            print("No candidates list found in match_note.")
-            continue
+            ids = [int(x) for x in m.group(1).split(",") if x.strip().isdigit()]
+            # tous les candidats de la ligne en parallèle (requêtes indépendantes)
+            fiches = await asyncio.gather(
+                *(movie_with_credits(session, sem, cid) for cid in ids),
+                return_exceptions=True)
+            for tmdb_id, d in zip(ids, fiches):
+                if isinstance(d, Exception):
+                    print(f"\nTMDb {tmdb_id}: fetch error: {d}")
+                    continue
+                rel = d.get("release_date") or ""
+                print(f"\nTMDb {tmdb_id}: {d.get('title')} | release={rel} | original={d.get('original_title')}")
+                print("Directors:", ", ".join(directors(d)) or "(none)")
+                print("Overview:", (d.get("overview") or "")[:200].replace("\n"," ") + ("..." if d.get("overview") and len(d.get("overview"))>200 else ""))
 
-        ids = [int(x) for x in m.group(1).split(",") if x.strip().isdigit()]
-        for tmdb_id in ids:
-            d = tmdb_get(f"/movie/{tmdb_id}", params={"language":"fr-FR"})
-            rel = d.get("release_date") or ""
-            print(f"\nTMDb {tmdb_id}: {d.get('title')} | release={rel} | original={d.get('original_title')}")
-            print("Directors:", ", ".join(directors(tmdb_id)) or "(none)")
-            print("Overview:", (d.get("overview") or "")[:200].replace("\n"," ") + ("..." if d.get("overview") and len(d.get("overview"))>200 else ""))
+def main():
+    asyncio.run(main_async())
 
 if __name__ == "__main__":
     main()
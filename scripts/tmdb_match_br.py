@@ -1,11 +1,14 @@
 import os
 import re
-import time
+import asyncio
 import argparse
-import requests
+import httpx
 import psycopg2
-from psycopg2.extras import DictCursor
+from asyncio_throttle import Throttler
+from psycopg2.extras import DictCursor, execute_batch, execute_values
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
+from tmdb_cache import TmdbDiskCache
 
 load_dotenv()
 
@@ -20,23 +23,47 @@ DB = dict(
     password=os.getenv("POSTGRES_PASSWORD", "postgres"),
 )
 
-def tmdb_get(path, params=None, retry=3):
-    params = params or {}
-    params["api_key"] = TMDB_KEY
-    for i in range(retry):
-        r = requests.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
-        if r.status_code == 429:
-            time.sleep(1.5 + i)
-            continue
-        r.raise_for_status()
-        return r.json()
-    raise RuntimeError(f"TMDb rate-limited too long on {path}")
+# Requêtes TMDb concurrentes bornées par sémaphore : la boucle est
+# network-bound, le pacing time.sleep disparaît.
+FETCH_CONCURRENCY = 20
+# Token bucket global : on sature le RPS autorisé sans pause fixe entre
+# réponses rapides, et sans rafale qui déclencherait une salve de 429.
+RATE_LIMIT_RPS = 40
+_throttler = Throttler(rate_limit=RATE_LIMIT_RPS, period=1.0)
+
+class TmdbRateLimitError(RuntimeError):
+    pass
+
+# Cache disque partagé entre scripts : les credits d'un même tmdb_id sont
+# demandés par match_nas, match_br, match_seen et inspect — 2e visite sans HTTP.
+_disk_cache = TmdbDiskCache(ttl=7 * 86400)
+
+@retry(wait=wait_exponential(multiplier=1, max=30), stop=stop_after_attempt(5),
+       retry=retry_if_exception_type(TmdbRateLimitError))
+async def tmdb_get(session, sem, path, params=None):
+    async with _throttler:
+        async with sem:
+            r = await session.get(path, params=params)
+            if r.status_code == 429:
+                # backoff exponentiel géré par tenacity
+                raise TmdbRateLimitError(f"TMDb 429 on {path}")
+            r.raise_for_status()
+            return r.json()
+
+# Motif compilé une fois : norm tourne pour chaque ligne et jusqu'à
+# 10 candidats x 2 titres par ligne.
+_WS_RE = re.compile(r"\s+")
 
 def norm(s: str) -> str:
     s = (s or "").strip().lower()
-    s = re.sub(r"\s+", " ", s)
+    s = _WS_RE.sub(" ", s)
     return s
 
+# Au-delà de ce score, le 2e candidat à égalité n'est quasiment jamais le
+# bon — on accepte sans payer les appels credits. (Ici l'année ne compte pas
+# dans le score, le seuil ne joue que si la grille de scoring évolue.)
+HIGH_CONFIDENCE_THRESHOLD = 8
+
 def director_hint(row):
     # Prefer raw_creators, else first+last
     if row.get("raw_creators"):
@@ -65,14 +92,171 @@ def score_candidate(q_title, q_year, q_dir, cand):
     # here we just return base score
     return s
 
-def get_directors_for_tmdb_id(tmdb_id: int) -> list[str]:
-    credits = tmdb_get(f"/movie/{tmdb_id}/credits", params={"language": "en-US"})
-    return [norm(c.get("name")) for c in credits.get("crew", []) if c.get("job") == "Director"]
+async def get_directors_for_tmdb_id(session, sem, tmdb_id: int) -> list[str]:
+    # fiche + credits en un seul appel : la même réponse cachée sert aussi
+    # aux scripts apply/inspect qui veulent les détails du film
+    params = {"language": "en-US", "append_to_response": "credits"}
+    ck = TmdbDiskCache.make_key(f"/movie/{tmdb_id}", params)
+    details = _disk_cache.get(ck)
+    if details is None:
+        details = await tmdb_get(session, sem, f"/movie/{tmdb_id}", params=params)
+        _disk_cache.set(ck, details)
+    crew = (details.get("credits") or {}).get("crew", [])
+    # noms bruts TMDb : la normalisation se fait à l'usage
+    return [c.get("name") for c in crew if c.get("job") == "Director" and c.get("name")]
 
-def main():
+async def safe_directors(session, sem, tmdb_id):
+    """Les erreurs credits ne doivent pas couler tout le gather : liste vide."""
+    try:
+        return await get_directors_for_tmdb_id(session, sem, tmdb_id)
+    except Exception:
+        return []
+
+def cached_directors(cur, tmdb_ids):
+    """Réalisateurs déjà matérialisés en base ; {tmdb_id: [noms bruts TMDb]}."""
+    if not tmdb_ids:
+        return {}
+    cur.execute("""
+        SELECT tmdb_id, name FROM film_directors WHERE tmdb_id = ANY(%s);
+    """, (list(tmdb_ids),))
+    out = {}
+    for tid, name in cur.fetchall():
+        out.setdefault(tid, []).append(name)
+    return out
+
+def store_directors(cur, dirs_by_id):
+    """Matérialise les réalisateurs fraîchement récupérés (commit via flush)."""
+    rows = [(tid, d) for tid, dirs in dirs_by_id.items() for d in dirs]
+    if rows:
+        execute_values(cur, """
+            INSERT INTO film_directors (tmdb_id, name)
+            VALUES %s
+            ON CONFLICT DO NOTHING;
+        """, rows)
+
+async def resolve_rows(cur, session, sem, items, out):
+    """Pipeline par phases : recherches groupées, scoring local, credits
+    groupés pour les seuls cas encore ambigus, décisions en mémoire."""
+
+    # Phase 1 — toutes les recherches en parallèle
+    searches = await asyncio.gather(*(
+        tmdb_get(session, sem, "/search/movie", params={
+            "query": (it["raw_title_clean"] or "").strip(),
+            "language": "fr-FR",
+            "include_adult": "false",
+        }) for it in items
+    ), return_exceptions=True)
+
+    # Phase 2 — scoring local, cas tranchés tout de suite
+    year = None  # publish_date = date d'édition BR, pas l'année du film
+    pending = []  # (it, top, best_score) encore ambigus après scoring
+    for it, search in zip(items, searches):
+        iid = it["import_br_id"]
+        title_clean = (it["raw_title_clean"] or "").strip()
+        if isinstance(search, Exception):
+            out["errored"].append((f"match: {str(search)[:900]}", iid))
+            continue
+        results = search.get("results", []) or []
+        if not results:
+            out["not_found"].append((f"no result for '{title_clean}'", iid))
+            continue
+
+        dir_hint = director_hint(it)
+        q_title = norm(title_clean)
+        scored = [(score_candidate(q_title, year, dir_hint, r), r) for r in results[:10]]
+        scored.sort(key=lambda x: x[0], reverse=True)
+        best_score, best = scored[0]
+
+        # If clearly best, accept
+        # If multiple close, use director to disambiguate
+        top = scored[:3]
+        tied = (len(top) >= 2 and top[0][0] == top[1][0]
+                and best_score < HIGH_CONFIDENCE_THRESHOLD)
+        if tied and dir_hint:
+            pending.append((it, top, best_score))
+        elif tied:
+            out["ambiguous"].append((best["id"], f"ambiguous | best_score={best_score}", iid))
+        else:
+            out["matched"].append((best["id"], f"single result | best_score={best_score}", iid))
+
+    # Phase 3 — réalisateurs : d'abord film_directors en local, puis credits
+    # TMDb pour les seuls tmdb_id encore inconnus (matérialisés au passage)
+    cand_ids = sorted({cand["id"] for _, top, _ in pending for _, cand in top})
+    dirs_by_id = cached_directors(cur, cand_ids)
+    missing = [cid for cid in cand_ids if cid not in dirs_by_id]
+    fetched = dict(zip(missing, await asyncio.gather(*(
+        safe_directors(session, sem, cid) for cid in missing
+    ))))
+    store_directors(cur, fetched)
+    dirs_by_id.update(fetched)
+
+    # Phase 4 — décisions finales en mémoire
+    for it, top, best_score in pending:
+        iid = it["import_br_id"]
+        dir_hint = director_hint(it)
+        chosen = top[0][1]
+        note = f"best_score={best_score}"
+        ambiguous = True
+        for _, cand in top:
+            dirs = [norm(d) for d in dirs_by_id.get(cand["id"], [])]
+            if any(dir_hint in d or d in dir_hint for d in dirs):
+                chosen = cand
+                note += f" | dir_match={dir_hint}"
+                ambiguous = False
+                break
+        if ambiguous:
+            # store first candidate but flag as ambiguous
+            out["ambiguous"].append((chosen["id"], f"ambiguous | {note}", iid))
+        else:
+            out["matched"].append((chosen["id"], f"single result | {note}", iid))
+
+def flush_updates(conn, cur, out):
+    """Toutes les décisions d'un run en 4 execute_batch + 1 commit.
+
+    Les formes d'UPDATE sont préparées une fois (PREPARE) : dans les batchs,
+    le serveur exécute le plan déjà construit au lieu de re-parser/replanifier
+    la même requête pour chaque ligne."""
+    if out["matched"]:
+        cur.execute("""
+            PREPARE upd_matched(bigint, text, bigint) AS
+            UPDATE import_br
+            SET match_status='MATCHED', tmdb_id=$1, match_note=$2
+            WHERE import_br_id=$3;
+        """)
+        execute_batch(cur, "EXECUTE upd_matched(%s, %s, %s);",
+                      out["matched"], page_size=200)
+    if out["ambiguous"]:
+        cur.execute("""
+            PREPARE upd_ambiguous(bigint, text, bigint) AS
+            UPDATE import_br
+            SET match_status='AMBIGUOUS', tmdb_id=$1, match_note=$2
+            WHERE import_br_id=$3;
+        """)
+        execute_batch(cur, "EXECUTE upd_ambiguous(%s, %s, %s);",
+                      out["ambiguous"], page_size=200)
+    if out["not_found"]:
+        cur.execute("""
+            PREPARE upd_not_found(text, bigint) AS
+            UPDATE import_br
+            SET match_status='NOT_FOUND', match_note=$1
+            WHERE import_br_id=$2;
+        """)
+        execute_batch(cur, "EXECUTE upd_not_found(%s, %s);",
+                      out["not_found"], page_size=200)
+    if out["errored"]:
+        cur.execute("""
+            PREPARE upd_errored(text, bigint) AS
+            UPDATE import_br
+            SET match_status='ERROR', match_note=$1
+            WHERE import_br_id=$2;
+        """)
+        execute_batch(cur, "EXECUTE upd_errored(%s, %s);",
+                      out["errored"], page_size=200)
+    conn.commit()
+
+async def main_async():
     ap = argparse.ArgumentParser()
     ap.add_argument("--limit", type=int, default=100)
-    ap.add_argument("--sleep", type=float, default=0.25)
     args = ap.parse_args()
 
     conn = psycopg2.connect(**DB)
@@ -86,92 +270,31 @@ def main():
               AND (tmdb_id IS NULL OR tmdb_id = 0)
               AND raw_title_clean IS NOT NULL AND raw_title_clean <> ''
             ORDER BY import_br_id
-            LIMIT %s;
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED;
         """, (args.limit,))
         items = cur.fetchall()
 
         print(f"Items to match: {len(items)}")
 
-        for it in items:
-            iid = it["import_br_id"]
-            title_clean = (it["raw_title_clean"] or "").strip()
-            #year = it["publish_date"].year if it["publish_date"] else None
-            year = None  # publish_date = date d'édition BR, pas l'année du film
-            dir_hint = director_hint(it)
-
-            try:
-                # Search TMDb
-                search = tmdb_get("/search/movie", params={
-                    "query": title_clean,
-                    "language": "fr-FR",
-                    "include_adult": "false",
-                    #**({"year": year} if year else {})
-                })
-                results = search.get("results", []) or []
-
-                if not results:
-                    cur.execute("""
-                        UPDATE import_br
-                        SET match_status='NOT_FOUND', match_note=%s
-                        WHERE import_br_id=%s;
-                    """, (f"no result for '{title_clean}'", iid))
-                    conn.commit()
-                    time.sleep(args.sleep)
-                    continue
-
-                # Score candidates
-                q_title = norm(title_clean)
-                scored = [(score_candidate(q_title, year, dir_hint, r), r) for r in results[:10]]
-                scored.sort(key=lambda x: x[0], reverse=True)
-                best_score, best = scored[0]
-
-                # If clearly best, accept
-                # If multiple close, use director to disambiguate
-                top = scored[:3]
-                ambiguous = len(top) >= 2 and top[0][0] == top[1][0]
-
-                chosen = best
-                note = f"best_score={best_score}"
-
-                if ambiguous and dir_hint:
-                    # fetch directors for top candidates only
-                    for _, cand in top:
-                        tmdb_id = cand["id"]
-                        dirs = get_directors_for_tmdb_id(tmdb_id)
-                        if any(dir_hint in d or d in dir_hint for d in dirs):
-                            chosen = cand
-                            note += f" | dir_match={dir_hint}"
-                            ambiguous = False
-                            break
-
-                if ambiguous:
-                    # store first candidate but flag as ambiguous
-                    cur.execute("""
-                        UPDATE import_br
-                        SET match_status='AMBIGUOUS', tmdb_id=%s, match_note=%s
-                        WHERE import_br_id=%s;
-                    """, (chosen["id"], f"ambiguous | {note}", iid))
-                else:
-                    cur.execute("""
-                        UPDATE import_br
-                        SET match_status='MATCHED', tmdb_id=%s, match_note=%s
-                        WHERE import_br_id=%s;
-                    """, (chosen["id"], f"single result | {note}", iid))
-
-                conn.commit()
-                time.sleep(args.sleep)
-
-            except Exception as e:
-                conn.rollback()
-                cur.execute("""
-                    UPDATE import_br
-                    SET match_status='ERROR', match_note=%s
-                    WHERE import_br_id=%s;
-                """, (f"match: {str(e)[:900]}", iid))
-                conn.commit()
+        out = {"matched": [], "not_found": [], "ambiguous": [], "errored": []}
+        sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+        # HTTP/2 : les requêtes en vol sont multiplexées sur une seule
+        # connexion TLS vers api.themoviedb.org (pas un handshake par flux).
+        limits = httpx.Limits(max_connections=FETCH_CONCURRENCY)
+        # api_key porté par le client : plus de copie de dict params par appel
+        async with httpx.AsyncClient(http2=True, timeout=30, limits=limits,
+                                     base_url=TMDB_BASE,
+                                     params={"api_key": TMDB_KEY}) as session:
+            await resolve_rows(cur, session, sem, items, out)
+
+        flush_updates(conn, cur, out)
 
     conn.close()
     print("Done.")
 
+def main():
+    asyncio.run(main_async())
+
 if __name__ == "__main__":
     main()
@@ -1,11 +1,14 @@
 import os
 import re
-import time
+import asyncio
 import argparse
-import requests
+import httpx
 import psycopg2
-from psycopg2.extras import DictCursor
+from asyncio_throttle import Throttler
+from psycopg2.extras import DictCursor, execute_batch, execute_values
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
+from tmdb_cache import TmdbDiskCache
 
 load_dotenv()
 
@@ -20,136 +23,259 @@ DB = dict(
     password=os.getenv("POSTGRES_PASSWORD", "postgres"),
 )
 
+# Requêtes TMDb concurrentes bornées par sémaphore : la boucle est
+# network-bound, le pacing time.sleep disparaît.
+FETCH_CONCURRENCY = 20
+# Token bucket global : on sature le RPS autorisé sans pause fixe entre
+# réponses rapides, et sans rafale qui déclencherait une salve de 429.
+RATE_LIMIT_RPS = 40
+_throttler = Throttler(rate_limit=RATE_LIMIT_RPS, period=1.0)
+
+class TmdbRateLimitError(RuntimeError):
+    pass
+
+# Cache disque partagé entre scripts : les credits d'un même tmdb_id sont
+# demandés par match_nas, match_br, match_seen et inspect — 2e visite sans HTTP.
+_disk_cache = TmdbDiskCache(ttl=7 * 86400)
+
+# Motifs compilés une fois : norm_name tourne pour chaque ligne et chaque
+# réalisateur de chaque candidat.
+_NONALNUM_RE = re.compile(r"[^a-z0-9àâäçéèêëîïôöùûüÿñ\s'-]")
+_WS_RE = re.compile(r"\s+")
+
 def norm_name(s: str) -> str:
     if not s:
         return ""
     s = s.lower().strip()
-    s = re.sub(r"[^a-z0-9àâäçéèêëîïôöùûüÿñ\s'-]", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _NONALNUM_RE.sub(" ", s)
+    s = _WS_RE.sub(" ", s).strip()
     return s
 
-def tmdb_get(path, params=None, retry=3):
-    params = params or {}
-    params["api_key"] = TMDB_KEY
-    for i in range(retry):
-        r = requests.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
-        if r.status_code == 429:
-            time.sleep(1.5 + i)
-            continue
-        r.raise_for_status()
-        return r.json()
-    raise RuntimeError(f"TMDb rate-limited too long on {path}")
+@retry(wait=wait_exponential(multiplier=1, max=30), stop=stop_after_attempt(5),
+       retry=retry_if_exception_type(TmdbRateLimitError))
+async def tmdb_get(session, sem, path, params=None):
+    async with _throttler:
+        async with sem:
+            r = await session.get(path, params=params)
+            if r.status_code == 429:
+                # backoff exponentiel géré par tenacity
+                raise TmdbRateLimitError(f"TMDb 429 on {path}")
+            r.raise_for_status()
+            return r.json()
 
-def tmdb_search_movie(title, year=None):
+async def tmdb_search_movie(session, sem, title, year=None):
     params = {"query": title, "include_adult": "false", "language": "fr-FR"}
     if year:
         params["year"] = year
-    data = tmdb_get("/search/movie", params=params)
+    data = await tmdb_get(session, sem, "/search/movie", params=params)
     return data.get("results", [])
 
-def tmdb_directors_for_movie(tmdb_id: int):
-    credits = tmdb_get(f"/movie/{tmdb_id}/credits", params={"language": "fr-FR"})
+async def tmdb_directors_for_movie(session, sem, tmdb_id: int):
+    # fiche + credits en un seul appel : la même réponse cachée sert aussi
+    # aux scripts apply/inspect qui veulent les détails du film
+    params = {"language": "fr-FR", "append_to_response": "credits"}
+    ck = TmdbDiskCache.make_key(f"/movie/{tmdb_id}", params)
+    details = _disk_cache.get(ck)
+    if details is None:
+        details = await tmdb_get(session, sem, f"/movie/{tmdb_id}", params=params)
+        _disk_cache.set(ck, details)
     directors = []
-    for crew in credits.get("crew", []):
+    for crew in (details.get("credits") or {}).get("crew", []):
         if crew.get("job") == "Director":
             directors.append(crew.get("name", ""))
-    return [norm_name(d) for d in directors if d]
+    # noms bruts TMDb : la normalisation se fait à l'usage
+    return [d for d in directors if d]
 
-def main():
+async def safe_directors(session, sem, tmdb_id):
+    """Les erreurs credits ne doivent pas couler tout le gather : liste vide."""
+    try:
+        return await tmdb_directors_for_movie(session, sem, tmdb_id)
+    except Exception:
+        return []
+
+def cached_directors(cur, tmdb_ids):
+    """Réalisateurs déjà matérialisés en base ; {tmdb_id: [noms bruts TMDb]}."""
+    if not tmdb_ids:
+        return {}
+    cur.execute("""
+        SELECT tmdb_id, name FROM film_directors WHERE tmdb_id = ANY(%s);
+    """, (list(tmdb_ids),))
+    out = {}
+    for tid, name in cur.fetchall():
+        out.setdefault(tid, []).append(name)
+    return out
+
+def store_directors(cur, dirs_by_id):
+    """Matérialise les réalisateurs fraîchement récupérés (commit via flush)."""
+    rows = [(tid, d) for tid, dirs in dirs_by_id.items() for d in dirs]
+    if rows:
+        execute_values(cur, """
+            INSERT INTO film_directors (tmdb_id, name)
+            VALUES %s
+            ON CONFLICT DO NOTHING;
+        """, rows)
+
+async def resolve_rows(cur, session, sem, items, out):
+    """Pipeline par phases : recherches groupées, tri local, credits groupés
+    pour les seules lignes multi-candidats, décisions en mémoire."""
+
+    # Titres vides : NOT_FOUND local, pas de RTT TMDb pour une page vide
+    kept = []
+    for it in items:
+        if not (it["raw_title"] and it["raw_title"].strip()):
+            out["not_found"].append(("empty title", it["import_nas_id"]))
+        else:
+            kept.append(it)
+    items = kept
+
+    # Phase 1 — toutes les recherches en parallèle
+    searches = await asyncio.gather(*(
+        tmdb_search_movie(session, sem, it["raw_title"], it["raw_year"])
+        for it in items
+    ), return_exceptions=True)
+
+    # Phase 2 — cas tranchés tout de suite (0 ou 1 candidat)
+    pending = []  # (it, candidates) à départager via réalisateur
+    for it, results in zip(items, searches):
+        iid = it["import_nas_id"]
+        if isinstance(results, Exception):
+            out["errored"].append((str(results)[:1000], iid))
+            continue
+        if not results:
+            out["not_found"].append(("no result", iid))
+            continue
+
+        # On garde les 5 premiers candidats
+        candidates = results[:5]
+
+        # 1) Si un seul candidat => MATCHED
+        if len(candidates) == 1:
+            out["matched"].append((candidates[0]["id"], "single result", iid))
+            continue
+
+        # 2) Réalisateur brut disponible -> départage en phase credits
+        if norm_name(it["raw_director"] or ""):
+            pending.append((it, candidates))
+            continue
+
+        # 3) Sinon -> AMBIGUOUS (on stocke un peu d'info)
+        cand_ids = [str(c["id"]) for c in candidates]
+        out["ambiguous"].append((f"candidates={','.join(cand_ids)}", iid))
+
+    # Phase 3 — réalisateurs : d'abord film_directors en local, puis credits
+    # TMDb pour les seuls tmdb_id encore inconnus (matérialisés au passage)
+    cand_ids = sorted({c["id"] for _, candidates in pending for c in candidates})
+    dirs_by_id = cached_directors(cur, cand_ids)
+    missing = [cid for cid in cand_ids if cid not in dirs_by_id]
+    fetched = dict(zip(missing, await asyncio.gather(*(
+        safe_directors(session, sem, cid) for cid in missing
+    ))))
+    store_directors(cur, fetched)
+    dirs_by_id.update(fetched)
+
+    # Phase 4 — décisions finales en mémoire
+    for it, candidates in pending:
+        iid = it["import_nas_id"]
+        raw_dir = norm_name(it["raw_director"] or "")
+        scored = []
+        for c in candidates:
+            dirs = [norm_name(d) for d in dirs_by_id.get(c["id"], [])]
+            # score simple : match exact du nom normalisé
+            score = 1 if raw_dir in dirs else 0
+            scored.append((score, c["id"], dirs))
+
+        scored.sort(reverse=True, key=lambda x: x[0])
+        best_score, best_id, best_dirs = scored[0]
+
+        if best_score == 1:
+            out["matched"].append((best_id, f"director match: {best_dirs}", iid))
+        else:
+            cand_ids_txt = [str(c["id"]) for c in candidates]
+            out["ambiguous"].append((f"candidates={','.join(cand_ids_txt)}", iid))
+
+def flush_updates(conn, cur, out):
+    """Toutes les décisions d'un run en 4 execute_batch + 1 commit.
+
+    Les formes d'UPDATE sont préparées une fois (PREPARE) : dans les batchs,
+    le serveur exécute le plan déjà construit au lieu de re-parser/replanifier
+    la même requête pour chaque ligne."""
+    if out["matched"]:
+        cur.execute("""
+            PREPARE upd_matched(bigint, text, bigint) AS
+            UPDATE import_nas
+            SET tmdb_id=$1, match_status='MATCHED', match_note=$2
+            WHERE import_nas_id=$3;
+        """)
+        execute_batch(cur, "EXECUTE upd_matched(%s, %s, %s);",
+                      out["matched"], page_size=200)
+    if out["not_found"]:
+        cur.execute("""
+            PREPARE upd_not_found(text, bigint) AS
+            UPDATE import_nas
+            SET match_status='NOT_FOUND', match_note=$1
+            WHERE import_nas_id=$2;
+        """)
+        execute_batch(cur, "EXECUTE upd_not_found(%s, %s);",
+                      out["not_found"], page_size=200)
+    if out["ambiguous"]:
+        cur.execute("""
+            PREPARE upd_ambiguous(text, bigint) AS
+            UPDATE import_nas
+            SET match_status='AMBIGUOUS', match_note=$1
+            WHERE import_nas_id=$2;
+        """)
+        execute_batch(cur, "EXECUTE upd_ambiguous(%s, %s);",
+                      out["ambiguous"], page_size=200)
+    if out["errored"]:
+        cur.execute("""
+            PREPARE upd_errored(text, bigint) AS
+            UPDATE import_nas
+            SET match_status='ERROR', match_note=$1
+            WHERE import_nas_id=$2;
+        """)
+        execute_batch(cur, "EXECUTE upd_errored(%s, %s);",
+                      out["errored"], page_size=200)
+    conn.commit()
+
+async def main_async():
     ap = argparse.ArgumentParser()
     ap.add_argument("--limit", type=int, default=100, help="Nb de lignes à traiter par run")
-    ap.add_argument("--sleep", type=float, default=0.25, help="Pause entre appels TMDb")
     args = ap.parse_args()
 
     conn = psycopg2.connect(**DB)
     conn.autocommit = False
 
     with conn, conn.cursor(cursor_factory=DictCursor) as cur:
+        # SKIP LOCKED : plusieurs workers peuvent tourner en parallèle, chacun
+        # réclame un lot disjoint (verrous tenus jusqu'au flush final).
         cur.execute("""
             SELECT import_nas_id, raw_title, raw_year, raw_director
             FROM import_nas
             WHERE match_status='PENDING'
             ORDER BY import_nas_id
-            LIMIT %s;
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED;
         """, (args.limit,))
         items = cur.fetchall()
 
-        for it in items:
-            iid = it["import_nas_id"]
-            title = it["raw_title"]
-            year = it["raw_year"]
-            raw_dir = norm_name(it["raw_director"] or "")
-
-            try:
-                results = tmdb_search_movie(title, year)
-
-                if not results:
-                    cur.execute("""
-                        UPDATE import_nas
-                        SET match_status='NOT_FOUND', match_note=%s
-                        WHERE import_nas_id=%s
-                    """, ("no result", iid))
-                    conn.commit()
-                    continue
-
-                # On garde les 5 premiers candidats
-                candidates = results[:5]
-
-                # 1) Si un seul candidat => MATCHED
-                if len(candidates) == 1:
-                    tmdb_id = candidates[0]["id"]
-                    cur.execute("""
-                        UPDATE import_nas
-                        SET tmdb_id=%s, match_status='MATCHED', match_note=%s
-                        WHERE import_nas_id=%s
-                    """, (tmdb_id, "single result", iid))
-                    conn.commit()
-                    time.sleep(args.sleep)
-                    continue
-
-                # 2) Si on a un réalisateur brut, on s'en sert pour départager
-                if raw_dir:
-                    scored = []
-                    for c in candidates:
-                        cid = c["id"]
-                        dirs = tmdb_directors_for_movie(cid)
-                        # score simple : match exact du nom normalisé
-                        score = 1 if raw_dir in dirs else 0
-                        scored.append((score, cid, dirs))
-                        time.sleep(args.sleep)
-
-                    scored.sort(reverse=True, key=lambda x: x[0])
-                    best_score, best_id, best_dirs = scored[0]
-
-                    if best_score == 1:
-                        cur.execute("""
-                            UPDATE import_nas
-                            SET tmdb_id=%s, match_status='MATCHED', match_note=%s
-                            WHERE import_nas_id=%s
-                        """, (best_id, f"director match: {best_dirs}", iid))
-                        conn.commit()
-                        continue
-
-                # 3) Sinon -> AMBIGUOUS (on stocke un peu d'info)
-                cand_ids = [str(c["id"]) for c in candidates]
-                cur.execute("""
-                    UPDATE import_nas
-                    SET match_status='AMBIGUOUS', match_note=%s
-                    WHERE import_nas_id=%s
-                """, (f"candidates={','.join(cand_ids)}", iid))
-                conn.commit()
-
-            except Exception as e:
-                conn.rollback()
-                cur.execute("""
-                    UPDATE import_nas
-                    SET match_status='ERROR', match_note=%s
-                    WHERE import_nas_id=%s
-                """, (str(e)[:1000], iid))
-                conn.commit()
+        out = {"matched": [], "not_found": [], "ambiguous": [], "errored": []}
+        sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+        # HTTP/2 : les requêtes en vol sont multiplexées sur une seule
+        # connexion TLS vers api.themoviedb.org (pas un handshake par flux).
+        limits = httpx.Limits(max_connections=FETCH_CONCURRENCY)
+        # api_key porté par le client : plus de copie de dict params par appel
+        async with httpx.AsyncClient(http2=True, timeout=30, limits=limits,
+                                     base_url=TMDB_BASE,
+                                     params={"api_key": TMDB_KEY}) as session:
+            await resolve_rows(cur, session, sem, items, out)
+
+        flush_updates(conn, cur, out)
 
     conn.close()
     print("Done.")
 
+def main():
+    asyncio.run(main_async())
+
 if __name__ == "__main__":
     main()
@@ -1,11 +1,14 @@
 import os
 import re
-import time
+import asyncio
 import argparse
-import requests
+import httpx
 import psycopg2
-from psycopg2.extras import DictCursor
+from asyncio_throttle import Throttler
+from psycopg2.extras import DictCursor, Json, execute_batch, execute_values
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
+from tmdb_cache import TmdbDiskCache
 
 load_dotenv()
 
@@ -20,134 +23,295 @@ DB = dict(
     password=os.getenv("POSTGRES_PASSWORD", "postgres"),
 )
 
-def tmdb_get(path, params=None, retry=3):
-    params = params or {}
-    params["api_key"] = TMDB_KEY
-    for i in range(retry):
-        r = requests.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
-        if r.status_code == 429:
-            time.sleep(1.5 + i)
-            continue
-        r.raise_for_status()
-        return r.json()
-    raise RuntimeError("TMDb rate limit")
+# Requêtes TMDb concurrentes bornées par sémaphore : la boucle est
+# network-bound, le pacing time.sleep disparaît.
+FETCH_CONCURRENCY = 20
+# Token bucket global : on sature le RPS autorisé sans pause fixe entre
+# réponses rapides, et sans rafale qui déclencherait une salve de 429.
+RATE_LIMIT_RPS = 40
+_throttler = Throttler(rate_limit=RATE_LIMIT_RPS, period=1.0)
+
+class TmdbRateLimitError(RuntimeError):
+    pass
+
+# Cache disque partagé entre scripts : les credits d'un même tmdb_id sont
+# demandés par match_nas, match_br, match_seen et inspect — 2e visite sans HTTP.
+_disk_cache = TmdbDiskCache(ttl=7 * 86400)
+
+@retry(wait=wait_exponential(multiplier=1, max=30), stop=stop_after_attempt(5),
+       retry=retry_if_exception_type(TmdbRateLimitError))
+async def tmdb_get(session, sem, path, params=None):
+    async with _throttler:
+        async with sem:
+            r = await session.get(path, params=params)
+            if r.status_code == 429:
+                # backoff exponentiel géré par tenacity
+                raise TmdbRateLimitError(f"TMDb 429 on {path}")
+            r.raise_for_status()
+            return r.json()
+
+# Motifs compilés une fois : norm tourne pour chaque ligne et jusqu'à
+# 10 candidats x 2 titres par ligne.
+_BRACKETS_RE = re.compile(r"\[[^\]]*\]")
+_NONALNUM_RE = re.compile(r"[^a-z0-9 ]+")
+_WS_RE = re.compile(r"\s+")
 
 def norm(s: str) -> str:
     s = (s or "").lower()
-    s = re.sub(r"\[[^\]]*\]", "", s)
-    s = re.sub(r"[^a-z0-9 ]+", " ", s)
-    return re.sub(r"\s+", " ", s).strip()
-
-def score_candidate(title_q, year_q, director_q, cand):
-    s = 0
-    title = norm(cand.get("title"))
-    orig = norm(cand.get("original_title"))
-
-    if title == title_q or orig == title_q:
-        s += 5
-    elif title_q in title or title_q in orig:
-        s += 2
-
-    if year_q:
-        rd = cand.get("release_date") or ""
-        if rd.startswith(str(year_q)):
+    s = _BRACKETS_RE.sub("", s)
+    s = _NONALNUM_RE.sub(" ", s)
+    return _WS_RE.sub(" ", s).strip()
+
+# Titre exact (5) + année (3) : au-delà, le 2e candidat à égalité n'est
+# quasiment jamais le bon — on accepte sans payer les appels credits.
+HIGH_CONFIDENCE_THRESHOLD = 8
+
+def score_candidates(cands, title_q, year_q):
+    """Score tous les candidats en une passe, invariants hoistés hors de la
+    boucle : le cast str(année) est fait une fois (pas une fois par candidat)
+    et les titres normalisés sont calculés en bloc."""
+    year_str = str(year_q) if year_q else None
+    # score maximal atteignable avec les infos disponibles : dès qu'un
+    # candidat l'atteint, inutile de scorer la suite — et la vérification
+    # d'égalité en aval ne voit qu'un candidat, donc pas d'appels credits
+    max_possible = 5 + (3 if year_str else 0)
+    cand_norm = [(norm(c.get("title")), norm(c.get("original_title")),
+                  (c.get("release_date") or "")[:4]) for c in cands]
+    scored = []
+    for (title, orig, rd_year), cand in zip(cand_norm, cands):
+        s = 0
+        if title == title_q or orig == title_q:
+            s += 5
+        elif title_q in title or title_q in orig:
+            s += 2
+        if year_str and rd_year == year_str:
             s += 3
+        scored.append((s, cand))
+        if s == max_possible:
+            break
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return scored
 
-    return s
+def cached_details(tmdb_id):
+    """Fiche complète si déjà en cache disque (via get_directors), sinon None."""
+    params = {"language": "fr-FR", "append_to_response": "credits"}
+    return _disk_cache.get(TmdbDiskCache.make_key(f"/movie/{tmdb_id}", params))
 
-def get_directors(tmdb_id):
-    credits = tmdb_get(f"/movie/{tmdb_id}/credits")
-    return [norm(c["name"]) for c in credits.get("crew", []) if c.get("job") == "Director"]
+async def get_directors(session, sem, tmdb_id):
+    # fiche + credits en un seul appel : la même réponse cachée sert aussi
+    # aux scripts apply/inspect qui veulent les détails du film
+    params = {"language": "fr-FR", "append_to_response": "credits"}
+    ck = TmdbDiskCache.make_key(f"/movie/{tmdb_id}", params)
+    details = _disk_cache.get(ck)
+    if details is None:
+        details = await tmdb_get(session, sem, f"/movie/{tmdb_id}", params)
+        _disk_cache.set(ck, details)
+    crew = (details.get("credits") or {}).get("crew", [])
+    # noms bruts TMDb : la normalisation se fait à l'usage
+    return [c["name"] for c in crew if c.get("job") == "Director"]
 
-def main():
+async def safe_directors(session, sem, tmdb_id):
+    """Les erreurs credits ne doivent pas couler tout le gather : liste vide."""
+    try:
+        return await get_directors(session, sem, tmdb_id)
+    except Exception:
+        return []
+
+def cached_directors(cur, tmdb_ids):
+    """Réalisateurs déjà matérialisés en base ; {tmdb_id: [noms bruts TMDb]}."""
+    if not tmdb_ids:
+        return {}
+    cur.execute("""
+        SELECT tmdb_id, name FROM film_directors WHERE tmdb_id = ANY(%s);
+    """, (list(tmdb_ids),))
+    out = {}
+    for tid, name in cur.fetchall():
+        out.setdefault(tid, []).append(name)
+    return out
+
+def store_directors(cur, dirs_by_id):
+    """Matérialise les réalisateurs fraîchement récupérés (commit via flush)."""
+    rows = [(tid, d) for tid, dirs in dirs_by_id.items() for d in dirs]
+    if rows:
+        execute_values(cur, """
+            INSERT INTO film_directors (tmdb_id, name)
+            VALUES %s
+            ON CONFLICT DO NOTHING;
+        """, rows)
+
+async def resolve_rows(cur, session, sem, rows, out):
+    """Pipeline par phases : recherches groupées, scoring local, credits
+    groupés pour les seuls cas encore ambigus, décisions en mémoire."""
+
+    # Phase 1 — une recherche par titre normalisé unique : les re-imports
+    # répètent les mêmes titres, le résultat est diffusé à toutes les lignes
+    # du groupe (l'année ne fait pas partie de la requête /search, elle
+    # n'entre que dans le scoring par ligne)
+    queries = {}  # norm(titre) -> raw_title du premier représentant
+    kept = []
+    for r in rows:
+        # titre vide : NOT_FOUND local, pas de RTT TMDb pour une page vide
+        if not (r["raw_title"] and r["raw_title"].strip()):
+            out["not_found"].append(("empty title", r["import_seen_id"]))
+            continue
+        kept.append(r)
+        queries.setdefault(norm(r["raw_title"]), r["raw_title"])
+    rows = kept
+    keys = list(queries)
+    searches = await asyncio.gather(*(
+        tmdb_get(session, sem, "/search/movie", {
+            "query": queries[k],
+            "language": "fr-FR",
+            "include_adult": "false",
+        }) for k in keys
+    ), return_exceptions=True)
+    search_by_key = dict(zip(keys, searches))
+
+    # Phase 2 — scoring local, cas tranchés tout de suite
+    pending = []  # (r, scored, best_score) encore ambigus après scoring
+    for r in rows:
+        search = search_by_key[norm(r["raw_title"])]
+        iid = r["import_seen_id"]
+        if isinstance(search, Exception):
+            out["errored"].append((str(search)[:900], iid))
+            continue
+        results = search.get("results", [])
+        if not results:
+            out["not_found"].append((f"no result for '{r['raw_title']}'", iid))
+            continue
+
+        title_q = norm(r["raw_title"])
+        year_q = r["raw_year"]
+        scored = score_candidates(results[:10], title_q, year_q)
+        best_score, best = scored[0]
+
+        if (len(scored) > 1 and scored[1][0] == best_score
+                and best_score < HIGH_CONFIDENCE_THRESHOLD):
+            pending.append((r, scored, best_score))
+        else:
+            # la fiche candidate est persistée : apply la relira sans HTTP
+            out["matched"].append((best["id"], Json(best), f"score={best_score}", iid))
+
+    # Phase 3 — réalisateurs : d'abord film_directors en local, puis credits
+    # TMDb pour les seuls tmdb_id encore inconnus (matérialisés au passage)
+    cand_ids = sorted({cand["id"] for _, scored, _ in pending for _, cand in scored[:3]})
+    dirs_by_id = cached_directors(cur, cand_ids)
+    missing = [cid for cid in cand_ids if cid not in dirs_by_id]
+    fetched = dict(zip(missing, await asyncio.gather(*(
+        safe_directors(session, sem, cid) for cid in missing
+    ))))
+    store_directors(cur, fetched)
+    dirs_by_id.update(fetched)
+
+    # Phase 4 — décisions finales en mémoire
+    for r, scored, best_score in pending:
+        iid = r["import_seen_id"]
+        director_q = norm(r["raw_directors"])
+        chosen = scored[0][1]
+        note = f"score={best_score}"
+        ambiguous = True
+        for _, cand in scored[:3]:
+            dirs = [norm(d) for d in dirs_by_id.get(cand["id"], [])]
+            if any(director_q in d or d in director_q for d in dirs):
+                chosen = cand
+                ambiguous = False
+                note += " | director_match"
+                break
+        if ambiguous:
+            out["ambiguous"].append((chosen["id"], note, iid))
+        else:
+            # la fiche complète (détails + runtime) est déjà en cache disque
+            # grâce à get_directors : on la persiste sans les credits
+            full = cached_details(chosen["id"])
+            payload = ({k: v for k, v in full.items() if k != "credits"}
+                       if full else chosen)
+            out["matched"].append((chosen["id"], Json(payload), note, iid))
+
+def flush_updates(conn, cur, out):
+    """Toutes les décisions d'un run en 4 execute_batch + 1 commit.
+
+    Les formes d'UPDATE sont préparées une fois (PREPARE) : dans les batchs,
+    le serveur exécute le plan déjà construit au lieu de re-parser/replanifier
+    la même requête pour chaque ligne."""
+    if out["matched"]:
+        cur.execute("""
+            PREPARE upd_matched(bigint, jsonb, text, bigint) AS
+            UPDATE import_seen_sc
+            SET match_status='MATCHED', tmdb_id=$1, raw_tmdb_json=$2, match_note=$3
+            WHERE import_seen_id=$4;
+        """)
+        execute_batch(cur, "EXECUTE upd_matched(%s, %s, %s, %s);",
+                      out["matched"], page_size=200)
+    if out["ambiguous"]:
+        cur.execute("""
+            PREPARE upd_ambiguous(bigint, text, bigint) AS
+            UPDATE import_seen_sc
+            SET match_status='AMBIGUOUS', tmdb_id=$1, match_note=$2
+            WHERE import_seen_id=$3;
+        """)
+        execute_batch(cur, "EXECUTE upd_ambiguous(%s, %s, %s);",
+                      out["ambiguous"], page_size=200)
+    if out["not_found"]:
+        cur.execute("""
+            PREPARE upd_not_found(text, bigint) AS
+            UPDATE import_seen_sc
+            SET match_status='NOT_FOUND', match_note=$1
+            WHERE import_seen_id=$2;
+        """)
+        execute_batch(cur, "EXECUTE upd_not_found(%s, %s);",
+                      out["not_found"], page_size=200)
+    if out["errored"]:
+        cur.execute("""
+            PREPARE upd_errored(text, bigint) AS
+            UPDATE import_seen_sc
+            SET match_status='ERROR', match_note=$1
+            WHERE import_seen_id=$2;
+        """)
+        execute_batch(cur, "EXECUTE upd_errored(%s, %s);",
+                      out["errored"], page_size=200)
+    conn.commit()
+
+async def main_async():
     ap = argparse.ArgumentParser()
     ap.add_argument("--limit", type=int, default=200)
-    ap.add_argument("--sleep", type=float, default=0.25)
     args = ap.parse_args()
 
     conn = psycopg2.connect(**DB)
     conn.autocommit = False
 
     with conn, conn.cursor(cursor_factory=DictCursor) as cur:
+        # SKIP LOCKED : plusieurs workers peuvent tourner en parallèle, chacun
+        # réclame un lot disjoint (verrous tenus jusqu'au flush final).
         cur.execute("""
             SELECT import_seen_id, raw_title, raw_year, raw_directors
             FROM import_seen_sc
             WHERE match_status='PENDING'
             ORDER BY import_seen_id
-            LIMIT %s;
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED;
         """, (args.limit,))
         rows = cur.fetchall()
 
         print(f"[match_seen] items: {len(rows)}")
 
-        for r in rows:
-            iid = r["import_seen_id"]
-            title_q = norm(r["raw_title"])
-            year_q = r["raw_year"]
-            director_q = norm(r["raw_directors"])
-
-            try:
-                search = tmdb_get("/search/movie", {
-                    "query": r["raw_title"],
-                    "language": "fr-FR",
-                    "include_adult": "false",
-                })
-                results = search.get("results", [])
-
-                if not results:
-                    cur.execute("""
-                        UPDATE import_seen_sc
-                        SET match_status='NOT_FOUND', match_note=%s
-                        WHERE import_seen_id=%s;
-                    """, (f"no result for '{r['raw_title']}'", iid))
-                    conn.commit()
-                    continue
-
-                scored = [(score_candidate(title_q, year_q, director_q, c), c) for c in results[:10]]
-                scored.sort(key=lambda x: x[0], reverse=True)
-                best_score, best = scored[0]
-
-                ambiguous = len(scored) > 1 and scored[1][0] == best_score
-
-                chosen = best
-                note = f"score={best_score}"
-
-                if ambiguous:
-                    for _, cand in scored[:3]:
-                        dirs = get_directors(cand["id"])
-                        if any(director_q in d or d in director_q for d in dirs):
-                            chosen = cand
-                            ambiguous = False
-                            note += " | director_match"
-                            break
-
-                if ambiguous:
-                    cur.execute("""
-                        UPDATE import_seen_sc
-                        SET match_status='AMBIGUOUS', tmdb_id=%s, match_note=%s
-                        WHERE import_seen_id=%s;
-                    """, (chosen["id"], note, iid))
-                else:
-                    cur.execute("""
-                        UPDATE import_seen_sc
-                        SET match_status='MATCHED', tmdb_id=%s, match_note=%s
-                        WHERE import_seen_id=%s;
-                    """, (chosen["id"], note, iid))
-
-                conn.commit()
-                time.sleep(args.sleep)
-
-            except Exception as e:
-                conn.rollback()
-                cur.execute("""
-                    UPDATE import_seen_sc
-                    SET match_status='ERROR', match_note=%s
-                    WHERE import_seen_id=%s;
-                """, (str(e)[:900], iid))
-                conn.commit()
+        out = {"matched": [], "not_found": [], "ambiguous": [], "errored": []}
+        sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+        # HTTP/2 : les requêtes en vol sont multiplexées sur une seule
+        # connexion TLS vers api.themoviedb.org (pas un handshake par flux).
+        limits = httpx.Limits(max_connections=FETCH_CONCURRENCY)
+        # api_key porté par le client : plus de copie de dict params par appel
+        async with httpx.AsyncClient(http2=True, timeout=30, limits=limits,
+                                     base_url=TMDB_BASE,
+                                     params={"api_key": TMDB_KEY}) as session:
+            await resolve_rows(cur, session, sem, rows, out)
+
+        flush_updates(conn, cur, out)
 
     conn.close()
     print("Done.")
 
+def main():
+    asyncio.run(main_async())
+
 if __name__ == "__main__":
     main()
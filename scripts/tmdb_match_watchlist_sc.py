@@ -1,11 +1,15 @@
 import os
 import re
-import time
+import asyncio
 import argparse
-import requests
+from functools import lru_cache
+import httpx
 import psycopg2
-from psycopg2.extras import DictCursor
+from asyncio_throttle import Throttler
+from psycopg2.extras import DictCursor, Json, execute_values
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
+from tmdb_cache import TmdbDiskCache
 
 load_dotenv()
 
@@ -20,152 +24,377 @@ DB = dict(
     password=os.getenv("POSTGRES_PASSWORD", "postgres"),
 )
 
-def tmdb_get(path, params=None, retry=3):
-    params = params or {}
-    params["api_key"] = TMDB_KEY
-    for i in range(retry):
-        r = requests.get(f"{TMDB_BASE}{path}", params=params, timeout=30)
-        if r.status_code == 429:
-            time.sleep(1.5 + i)
-            continue
-        r.raise_for_status()
-        return r.json()
-    raise RuntimeError("TMDb rate limit")
+# Requêtes TMDb concurrentes bornées par sémaphore : la boucle est
+# network-bound, le pacing time.sleep disparaît.
+FETCH_CONCURRENCY = 20
+# Token bucket global : on sature le RPS autorisé sans pause fixe entre
+# réponses rapides, et sans rafale qui déclencherait une salve de 429.
+RATE_LIMIT_RPS = 40
+_throttler = Throttler(rate_limit=RATE_LIMIT_RPS, period=1.0)
+
+class TmdbRateLimitError(RuntimeError):
+    pass
+
+# Taille des paquets lus sur le curseur serveur (et traités par vague async).
+CHUNK_SIZE = 500
+
+# Cache disque partagé entre scripts : les credits d'un même tmdb_id sont
+# demandés par match_nas, match_br, match_seen et inspect — 2e visite sans HTTP.
+_disk_cache = TmdbDiskCache(ttl=7 * 86400)
+
+@retry(wait=wait_exponential(multiplier=1, max=30), stop=stop_after_attempt(5),
+       retry=retry_if_exception_type(TmdbRateLimitError))
+async def tmdb_get(session, sem, path, params=None):
+    async with _throttler:
+        async with sem:
+            r = await session.get(path, params=params)
+            if r.status_code == 429:
+                # backoff exponentiel géré par tenacity
+                raise TmdbRateLimitError(f"TMDb 429 on {path}")
+            r.raise_for_status()
+            return r.json()
 
+# Boucle interne en C sans nouvelle dépendance : la table translate
+# (tout sauf [0-9a-z] -> espace) puis split/join tournent entièrement côté
+# C, seul le strip des crochets reste une passe regex octets.
+_BRACKETS_B_RE = re.compile(rb"\[[^\]]*\]")
+_NORM_TRANS = bytes(c if 0x30 <= c <= 0x39 or 0x61 <= c <= 0x7a else 0x20
+                    for c in range(256))
+
+# Mémoïsation : les mêmes réalisateurs et titres candidats reviennent d'une
+# ligne à l'autre (filmographies, re-runs) — la 2e normalisation est un
+# lookup dict. None et str sont hashables, pas besoin de pré-traitement.
+@lru_cache(maxsize=8192)
 def norm(s: str) -> str:
-    s = (s or "").lower()
-    s = re.sub(r"\[[^\]]*\]", "", s)
-    s = re.sub(r"[^a-z0-9 ]+", " ", s)
-    return re.sub(r"\s+", " ", s).strip()
+    """Crochets supprimés, non-alphanum -> espace, espaces compactés."""
+    b = _BRACKETS_B_RE.sub(b"", (s or "").lower().encode())
+    return b" ".join(b.translate(_NORM_TRANS).split()).decode()
 
 STOP = {"le","la","les","un","une","the","a","an","of"}
+@lru_cache(maxsize=8192)
 def simplify_title(title: str) -> str:
+    """Scanner une passe : crochets ignorés, arrêt au premier séparateur,
+    au plus 5 mots hors stop-words — ni regex ni liste de tous les tokens
+    (l'ancienne version faisait trois passes sur la chaîne)."""
     t = (title or "").lower()
-    t = re.sub(r"\[[^\]]*\]", "", t)
-    t = re.split(r"[:–\-]", t)[0]
-    words = [w for w in re.findall(r"[a-z0-9]+", t) if w not in STOP]
-    return " ".join(words[:5]).strip()
+    n = len(t)
+    out = []
+    buf = ""
+    i = 0
+    while i < n and len(out) < 5:
+        c = t[i]
+        if "a" <= c <= "z" or "0" <= c <= "9":
+            buf += c
+            i += 1
+            continue
+        if c == "[":
+            j = t.find("]", i)
+            if j != -1:
+                # span [..] sauté d'un coup (fermé plus loin, comme l'ancien
+                # motif) ; le token courant continue de part et d'autre
+                i = j + 1
+                continue
+        if c in ":–-":
+            break
+        if buf:
+            if buf not in STOP:
+                out.append(buf)
+            buf = ""
+        i += 1
+    if buf and len(out) < 5 and buf not in STOP:
+        out.append(buf)
+    return " ".join(out)
 
-def get_directors(tmdb_id: int):
-    credits = tmdb_get(f"/movie/{tmdb_id}/credits")
-    return [norm(c.get("name","")) for c in credits.get("crew", []) if c.get("job") == "Director"]
+def score_candidates(cands, title_q, year_q):
+    """Meilleur candidat en une passe ; renvoie (best, best_score).
 
-def main():
+    Boucle locale plutôt que NumPy : sur <= 10 candidats la construction des
+    arrays coûterait plus cher que la boucle, et norm étant mémoïsé le gros
+    du travail par candidat a déjà disparu. str(year) sorti de la boucle.
+    """
+    year_s = str(year_q) if year_q else None
+    # score maximal atteignable avec les infos disponibles : dès qu'un
+    # candidat l'atteint, inutile de scorer les suivants
+    max_possible = 5 + (3 if year_s else 0)
+    best = None
+    best_score = -1
+    for cand in cands:
+        t = norm(cand.get("title"))
+        ot = norm(cand.get("original_title"))
+        if t == title_q or ot == title_q:
+            s = 5
+        elif title_q in t or title_q in ot:
+            s = 2
+        else:
+            s = 0
+        if year_s and (cand.get("release_date") or "").startswith(year_s):
+            s += 3
+        if s > best_score:
+            best_score = s
+            best = cand
+            if best_score == max_possible:
+                break
+    return best, best_score
+
+async def tmdb_get_cached(session, sem, path, params=None):
+    """GET idempotent via le cache disque (clé chemin+params, sans api_key) :
+    re-lancer le script sur un lot partiellement traité ne repaie pas les
+    mêmes /search, le re-run devient un travail local."""
+    ck = TmdbDiskCache.make_key(path, params or {})
+    data = _disk_cache.get(ck)
+    if data is None:
+        data = await tmdb_get(session, sem, path, params)
+        _disk_cache.set(ck, data)
+    return data
+
+async def search_with_fallback(session, sem, raw_title):
+    """2 passes : titre brut puis titre simplifié ; renvoie (results, used_q)."""
+    params = {"language": "fr-FR", "include_adult": "false"}
+    data = await tmdb_get_cached(session, sem, "/search/movie", dict(params, query=raw_title))
+    results = data.get("results", [])
+    used_q = raw_title
+    if not results:
+        q2 = simplify_title(raw_title)
+        # pas de 2e appel si la simplification ne change rien une fois normalisée
+        if q2 and norm(q2) != norm(raw_title):
+            data = await tmdb_get_cached(session, sem, "/search/movie", dict(params, query=q2))
+            results = data.get("results", [])
+            used_q = q2
+    return results, used_q
+
+async def get_directors(session, sem, tmdb_id):
+    # fiche + credits en un seul appel : la même réponse cachée sert aussi
+    # aux scripts apply/inspect qui veulent les détails du film
+    params = {"language": "fr-FR", "append_to_response": "credits"}
+    ck = TmdbDiskCache.make_key(f"/movie/{tmdb_id}", params)
+    details = _disk_cache.get(ck)
+    if details is None:
+        details = await tmdb_get(session, sem, f"/movie/{tmdb_id}", params)
+        _disk_cache.set(ck, details)
+    crew = (details.get("credits") or {}).get("crew", [])
+    # noms bruts TMDb : la normalisation se fait à l'usage
+    return [c["name"] for c in crew if c.get("job") == "Director"]
+
+async def safe_directors(session, sem, tmdb_id):
+    """Les erreurs credits ne doivent pas couler tout le gather : liste vide."""
+    try:
+        return await get_directors(session, sem, tmdb_id)
+    except Exception:
+        return []
+
+def cached_directors(cur, tmdb_ids):
+    """Réalisateurs déjà matérialisés en base ; {tmdb_id: [noms bruts TMDb]}."""
+    if not tmdb_ids:
+        return {}
+    cur.execute("""
+        SELECT tmdb_id, name FROM film_directors WHERE tmdb_id = ANY(%s);
+    """, (list(tmdb_ids),))
+    out = {}
+    for tid, name in cur.fetchall():
+        out.setdefault(tid, []).append(name)
+    return out
+
+def store_directors(cur, dirs_by_id):
+    """Matérialise les réalisateurs fraîchement récupérés (commit via flush)."""
+    rows = [(tid, d) for tid, dirs in dirs_by_id.items() for d in dirs]
+    if rows:
+        execute_values(cur, """
+            INSERT INTO film_directors (tmdb_id, name)
+            VALUES %s
+            ON CONFLICT DO NOTHING;
+        """, rows)
+
+def local_film_index(cur):
+    """Index {titre normalisé: [(tmdb_id, year)]} bâti sur la table film.
+
+    Stratégie « dump local » : les fiches déjà appliquées par les autres
+    pipelines servent de pré-filtre, une ligne connue se résout en mémoire
+    sans appel TMDb."""
+    cur.execute("""
+        SELECT tmdb_id, title, original_title, year
+        FROM film
+        WHERE tmdb_id IS NOT NULL;
+    """)
+    idx = {}
+    for tid, title, otitle, year in cur.fetchall():
+        for t in {norm(title), norm(otitle)}:
+            if t:
+                idx.setdefault(t, []).append((tid, year))
+    return idx
+
+async def resolve_rows(cur, session, sem, items, out, film_idx):
+    """Pipeline par phases : probe locale, recherches groupées (avec repli
+    titre simplifié), scoring local, credits groupés pour les seuls cas
+    encore ambigus, décisions en mémoire."""
+
+    # Phase 0 — probe locale : titre normalisé (+ année si connue) résolu
+    # par la table film -> MATCHED sans HTTP ; le reste part sur /search
+    remaining = []
+    for it in items:
+        # titre vide : NOT_FOUND local, pas de RTT TMDb pour une page vide
+        if not (it["raw_title"] and it["raw_title"].strip()):
+            out["not_found"].append(("empty title", it["import_id"]))
+            continue
+        cands = film_idx.get(norm(it["raw_title"]), [])
+        if it["raw_year"]:
+            cands = [c for c in cands if c[1] == it["raw_year"]]
+        tids = {tid for tid, _ in cands}
+        if len(tids) == 1:
+            # pas de fiche candidate à persister : apply ira la chercher
+            out["matched"].append((tids.pop(), None, "local film match", it["import_id"]))
+        else:
+            remaining.append(it)
+    items = remaining
+
+    # Phase 1 — toutes les recherches en parallèle
+    searches = await asyncio.gather(*(
+        search_with_fallback(session, sem, it["raw_title"]) for it in items
+    ), return_exceptions=True)
+
+    # Phase 2 — scoring local, cas tranchés tout de suite
+    pending = []  # (it, candidats, best, note) à départager via réalisateur
+    for it, res in zip(items, searches):
+        iid = it["import_id"]
+        if isinstance(res, Exception):
+            out["errored"].append((str(res)[:900], iid))
+            continue
+        results, used_q = res
+        if not results:
+            out["not_found"].append((f"no result | q={used_q}", iid))
+            continue
+
+        # pick best with simple scoring
+        title_q = norm(it["raw_title"])
+        director_q = norm(it["raw_directors"])
+        best, best_score = score_candidates(results[:10], title_q, it["raw_year"])
+
+        note = f"score={best_score} | q={used_q}"
+        # score parfait pour les infos disponibles : accepté direct, pas de
+        # départage réalisateur (c'est la plus grosse économie HTTP après
+        # la recherche elle-même)
+        if best_score == 5 + (3 if it["raw_year"] else 0):
+            out["matched"].append((best["id"], Json(best), note, iid))
+        elif len(results) > 1 and director_q:
+            pending.append((it, results[:5], best, note))
+        elif len(results) > 1:
+            out["ambiguous"].append((best["id"], Json(best), note, iid))
+        else:
+            out["matched"].append((best["id"], Json(best), note, iid))
+
+    # Phase 3 — réalisateurs : d'abord film_directors en local, puis credits
+    # TMDb pour les seuls tmdb_id encore inconnus (matérialisés au passage)
+    cand_ids = sorted({c["id"] for _, cands, _, _ in pending for c in cands})
+    dirs_by_id = cached_directors(cur, cand_ids)
+    missing = [cid for cid in cand_ids if cid not in dirs_by_id]
+    fetched = dict(zip(missing, await asyncio.gather(*(
+        safe_directors(session, sem, cid) for cid in missing
+    ))))
+    store_directors(cur, fetched)
+    dirs_by_id.update(fetched)
+
+    # Phase 4 — décisions finales en mémoire
+    for it, cands, best, note in pending:
+        iid = it["import_id"]
+        director_q = norm(it["raw_directors"])
+        # préfiltre ensembliste : sans token commun, inutile de payer les
+        # scans substring (le repli substring gère prénoms/noms tronqués)
+        dq_tokens = frozenset(director_q.split())
+        chosen = best
+        ambiguous = True
+        for cand in cands:
+            dirs = [norm(d) for d in dirs_by_id.get(cand["id"], [])]
+            if any(dq_tokens & frozenset(d.split())
+                   and (director_q in d or d in director_q) for d in dirs):
+                chosen = cand
+                ambiguous = False
+                note += " | director_match"
+                break
+        # fiche candidate persistée : apply la relira sans rappeler TMDb
+        if ambiguous:
+            out["ambiguous"].append((chosen["id"], Json(chosen), note, iid))
+        else:
+            out["matched"].append((chosen["id"], Json(chosen), note, iid))
+
+def flush_updates(conn, cur, out):
+    """Toutes les décisions d'un run en 2 UPDATE-FROM-VALUES + 1 commit."""
+    # candidat retenu (MATCHED / AMBIGUOUS) : le statut voyage dans les VALUES,
+    # un seul statement quel que soit le mélange
+    decided = ([(iid, tid, js, "MATCHED", note) for tid, js, note, iid in out["matched"]]
+               + [(iid, tid, js, "AMBIGUOUS", note) for tid, js, note, iid in out["ambiguous"]])
+    if decided:
+        # template typé : sans le ::jsonb, le littéral de VALUES se résout en
+        # text et l'affectation text -> jsonb est rejetée (42804)
+        execute_values(cur, """
+            UPDATE import_watchlist_sc AS w
+            SET tmdb_id=v.tmdb_id, raw_tmdb_json=v.raw_tmdb_json,
+                match_status=v.status, match_note=v.note
+            FROM (VALUES %s) AS v(import_id, tmdb_id, raw_tmdb_json, status, note)
+            WHERE w.import_id = v.import_id;
+        """, decided, template="(%s, %s, %s::jsonb, %s, %s)", page_size=500)
+    # échecs (NOT_FOUND / ERROR) : pas de tmdb_id à écrire
+    failures = ([(iid, "NOT_FOUND", note) for note, iid in out["not_found"]]
+                + [(iid, "ERROR", note) for note, iid in out["errored"]])
+    if failures:
+        execute_values(cur, """
+            UPDATE import_watchlist_sc AS w
+            SET match_status=v.status, match_note=v.note
+            FROM (VALUES %s) AS v(import_id, status, note)
+            WHERE w.import_id = v.import_id;
+        """, failures, page_size=500)
+    conn.commit()
+
+async def main_async():
     ap = argparse.ArgumentParser()
     ap.add_argument("--limit", type=int, default=200)
-    ap.add_argument("--sleep", type=float, default=0.25)
     args = ap.parse_args()
 
     conn = psycopg2.connect(**DB)
     conn.autocommit = False
 
     with conn, conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute("""
+        # Curseur serveur : mémoire O(CHUNK_SIZE) même avec un très gros
+        # --limit, et le scan Postgres se recouvre avec l'I/O TMDb du paquet.
+        # SKIP LOCKED : plusieurs workers peuvent tourner en parallèle, chacun
+        # réclame un lot disjoint (verrous tenus jusqu'au flush final).
+        read_cur = conn.cursor(name="watchlist_pending", cursor_factory=DictCursor)
+        read_cur.itersize = 100
+        read_cur.execute("""
             SELECT import_id, raw_title, raw_year, raw_directors
             FROM import_watchlist_sc
             WHERE match_status='PENDING'
             ORDER BY import_id
-            LIMIT %s;
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED;
         """, (args.limit,))
-        items = cur.fetchall()
-
-        print(f"[match_watchlist] items: {len(items)}")
-
-        for it in items:
-            iid = it["import_id"]
-            raw_title = it["raw_title"]
-            year_q = it["raw_year"]
-            director_q = norm(it.get("raw_directors"))
-
-            try:
-                # 2 passes: raw title then simplified
-                def do_search(q):
-                    return tmdb_get("/search/movie", {
-                        "query": q,
-                        "language": "fr-FR",
-                        "include_adult": "false",
-                    }).get("results", [])
-
-                results = do_search(raw_title)
-                used_q = raw_title
-                if not results:
-                    q2 = simplify_title(raw_title)
-                    if q2 and q2 != raw_title:
-                        results = do_search(q2)
-                        used_q = q2
-
-                if not results:
-                    cur.execute("""
-                        UPDATE import_watchlist_sc
-                        SET match_status='NOT_FOUND', match_note=%s
-                        WHERE import_id=%s;
-                    """, (f"no result | q={used_q}", iid))
-                    conn.commit()
-                    continue
-
-                # pick best with simple scoring
-                title_q = norm(raw_title)
-                best = None
-                best_score = -1
-                for cand in results[:10]:
-                    s = 0
-                    t = norm(cand.get("title"))
-                    ot = norm(cand.get("original_title"))
-                    if t == title_q or ot == title_q:
-                        s += 5
-                    elif title_q in t or title_q in ot:
-                        s += 2
-                    if year_q and (cand.get("release_date") or "").startswith(str(year_q)):
-                        s += 3
-                    if s > best_score:
-                        best_score = s
-                        best = cand
-
-                chosen_id = best["id"]
-                note = f"score={best_score} | q={used_q}"
-
-                # resolve ambiguity with director
-                ambiguous = len(results) > 1
-                if ambiguous and director_q:
-                    # try top 5 to find director match
-                    picked = None
-                    for cand in results[:5]:
-                        try:
-                            dirs = get_directors(cand["id"])
-                        except Exception:
-                            dirs = []
-                        if any(director_q in d or d in director_q for d in dirs):
-                            picked = cand["id"]
-                            note += " | director_match"
-                            break
-                    if picked:
-                        chosen_id = picked
-                        ambiguous = False
-                    else:
-                        # remain ambiguous
-                        ambiguous = True
-
-                cur.execute("""
-                    UPDATE import_watchlist_sc
-                    SET tmdb_id=%s,
-                        match_status=%s,
-                        match_note=%s
-                    WHERE import_id=%s;
-                """, (chosen_id, "AMBIGUOUS" if ambiguous else "MATCHED", note, iid))
-                conn.commit()
-                time.sleep(args.sleep)
-
-            except Exception as e:
-                conn.rollback()
-                cur.execute("""
-                    UPDATE import_watchlist_sc
-                    SET match_status='ERROR', match_note=%s
-                    WHERE import_id=%s;
-                """, (str(e)[:900], iid))
-                conn.commit()
+
+        out = {"matched": [], "not_found": [], "ambiguous": [], "errored": []}
+        sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+        # index local (phase 0) bâti une seule fois pour tout le run
+        film_idx = local_film_index(cur)
+        processed = 0
+        # HTTP/2 : les requêtes en vol sont multiplexées sur une seule
+        # connexion TLS vers api.themoviedb.org (pas un handshake par flux).
+        limits = httpx.Limits(max_connections=FETCH_CONCURRENCY)
+        # api_key porté par le client : plus de copie de dict params par appel
+        async with httpx.AsyncClient(http2=True, timeout=30, limits=limits,
+                                     base_url=TMDB_BASE,
+                                     params={"api_key": TMDB_KEY}) as session:
+            while True:
+                items = read_cur.fetchmany(CHUNK_SIZE)
+                if not items:
+                    break
+                processed += len(items)
+                await resolve_rows(cur, session, sem, items, out, film_idx)
+        read_cur.close()
+
+        print(f"[match_watchlist] items: {processed}")
+        flush_updates(conn, cur, out)
 
     conn.close()
     print("Done.")
 
+def main():
+    asyncio.run(main_async())
+
 if __name__ == "__main__":
     main()